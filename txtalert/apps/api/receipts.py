@@ -0,0 +1,180 @@
+import json
+import uuid
+
+import redis
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from txtalert.apps.gateway.models import SendSMS
+
+
+# the number of events resolved per query, every event looks up two
+# message ids and sqlite allows 999 query parameters
+LOOKUP_CHUNK_SIZE = 400
+
+DELIVERY_STATUSES = {
+    'pending': 'd',  # sent
+    'failed': 'F',  # failed
+    'delivered': 'D',  # delivered
+}
+
+
+def event_status(event):
+    """The SendSMS status for an ack, nack or delivery report event, None
+    for events of any other type."""
+    event_type = event.get('event_type')
+    if event_type == 'ack':
+        return 'd'  # sent
+    elif event_type == 'nack':
+        return 'F'  # failed
+    elif event_type == 'delivery_report':
+        return DELIVERY_STATUSES.get(event.get('delivery_status'),
+                                     'v')  # unknown
+
+
+def valid_event(event):
+    return isinstance(event, dict) \
+        and isinstance(event.get('user_message_id'), basestring) \
+        and bool(event['user_message_id']) \
+        and event_status(event) is not None
+
+
+def resolve_message_ids(message_ids):
+    """Map the given message ids to SendSMS primary keys, the messages
+    stored with only their 8 character identifier as message id are
+    matched on that."""
+    candidates = set()
+    for message_id in message_ids:
+        candidates.update([message_id, message_id[:8]])
+    candidates = list(candidates)
+    pks = {}
+    for offset in range(0, len(candidates), LOOKUP_CHUNK_SIZE * 2):
+        pks.update(SendSMS.objects.filter(
+            message_id__in=candidates[offset:offset + LOOKUP_CHUNK_SIZE * 2])
+            .values_list('message_id', 'pk'))
+    return dict((message_id, pks.get(message_id, pks.get(message_id[:8])))
+                for message_id in message_ids)
+
+
+def apply_events(events):
+    """Apply a batch of events with one UPDATE per resulting status. If a
+    message has more than one event in the batch the last one wins.
+
+    Returns a result for every event, in order."""
+    results = []
+    valid = []
+    for event in events:
+        message_id = event.get('user_message_id') \
+            if isinstance(event, dict) else None
+        if not valid_event(event):
+            results.append({
+                'user_message_id': message_id,
+                'result': 'invalid',
+            })
+        else:
+            results.append({
+                'user_message_id': message_id,
+                'result': 'not_found',
+            })
+            valid.append((results[-1], event))
+
+    pks = resolve_message_ids(set(result['user_message_id']
+                                  for result, _ in valid))
+    statuses = {}
+    for result, event in valid:
+        pk = pks[result['user_message_id']]
+        if pk is not None:
+            statuses[pk] = event_status(event)
+            result['result'] = 'updated'
+
+    pks_per_status = {}
+    for pk, status in statuses.items():
+        pks_per_status.setdefault(status, []).append(pk)
+    for status, pks in pks_per_status.items():
+        for offset in range(0, len(pks), LOOKUP_CHUNK_SIZE):
+            SendSMS.objects.filter(
+                pk__in=pks[offset:offset + LOOKUP_CHUNK_SIZE]).update(
+                    status=status)
+    return results
+
+
+class ReceiptQueue(object):
+    """Collects events in a Redis hash keyed by their message id, so the
+    latest event of a message replaces the ones before it. The hash is
+    shared by all the web processes and written with `apply_events` by the
+    `flush_receipts` Celery task, `interval` seconds after the first event
+    queued since the last flush."""
+
+    KEY = 'txtalert:receipts'
+    # set while a flush is scheduled, expires in case the task is lost
+    SCHEDULED_KEY = 'txtalert:receipts:scheduled'
+    SCHEDULED_TIMEOUT = 60
+
+    def __init__(self, url=None, interval=None, connection=None):
+        self.url = url
+        self.interval = interval or 0
+        self._connection = connection
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = redis.StrictRedis.from_url(self.url)
+        return self._connection
+
+    def put(self, events):
+        """Queue the valid events, returns a result for every event"""
+        results = []
+        queued = {}
+        for event in events:
+            if valid_event(event):
+                queued[event['user_message_id']] = json.dumps(event)
+                result = 'queued'
+            else:
+                result = 'invalid'
+            results.append({
+                'user_message_id': event.get('user_message_id')
+                    if isinstance(event, dict) else None,
+                'result': result,
+            })
+        if queued:
+            self.connection.hmset(self.KEY, queued)
+            self.schedule()
+        return results
+
+    def schedule(self):
+        """Schedule a flush unless one is scheduled already"""
+        from txtalert.tasks import flush_receipts
+        if self.connection.set(self.SCHEDULED_KEY, 1, nx=True,
+                               ex=self.interval + self.SCHEDULED_TIMEOUT):
+            flush_receipts.apply_async(countdown=self.interval)
+
+    def flush(self):
+        """Write the queued events, returns the number written"""
+        self.connection.delete(self.SCHEDULED_KEY)
+        # take the events queued so far, the ones queued from now on go
+        # to the next flush
+        flushing = '%s:%s' % (self.KEY, uuid.uuid4().hex)
+        try:
+            self.connection.rename(self.KEY, flushing)
+        except redis.ResponseError:
+            # nothing queued
+            return 0
+        queued = self.connection.hgetall(flushing)
+        try:
+            close_old_connections()
+            apply_events([json.loads(event) for event in queued.values()])
+        except:
+            # put them back for the next flush, events queued in the
+            # meantime are newer and win
+            for message_id, event in queued.items():
+                self.connection.hsetnx(self.KEY, message_id, event)
+            self.connection.delete(flushing)
+            self.schedule()
+            raise
+        self.connection.delete(flushing)
+        return len(queued)
+
+
+receipt_queue = ReceiptQueue(settings.API_EVENTS_REDIS_URL,
+                             settings.API_EVENTS_FLUSH_INTERVAL)
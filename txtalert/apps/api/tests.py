@@ -2,8 +2,15 @@ from django.test import TestCase
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Permission
+from django.db import DatabaseError
 from django.db.models.signals import post_save
+from django.test.utils import override_settings
 from django.utils import timezone
+from mock import patch
+import redis
+
+from txtalert.apps.api import receipts
+from txtalert import tasks
 
 from txtalert.apps.gateway.models import PleaseCallMe, SendSMS
 
@@ -125,13 +132,14 @@ class TestEventHandling(TestCase):
             priority='Standard',
             receipt='Y',
             identifier='12345678',
+            message_id='1234567890abcdef',
             user=self.user,
         )
 
     def test_ack(self):
         ack = {
             "event_type": "ack",
-            "user_message_id": self.sms.identifier,
+            "user_message_id": self.sms.message_id,
         }
         resp = self.client.post(
             reverse('api-events'),
@@ -141,10 +149,61 @@ class TestEventHandling(TestCase):
         sms = SendSMS.objects.get(pk=self.sms.pk)
         self.assertEqual(sms.status, 'd')
 
+    def test_ack_before_message_id(self):
+        # messages stored before the full message id was kept have their
+        # identifier as the message id
+        sms = SendSMS.objects.create(
+            msisdn='27123456789',
+            smstext='smstext',
+            delivery=timezone.now(),
+            expiry=timezone.now(),
+            priority='Standard',
+            receipt='Y',
+            identifier='abcdefgh',
+            message_id='abcdefgh',
+            user=self.user,
+        )
+        ack = {
+            "event_type": "ack",
+            "user_message_id": "abcdefgh-1234",
+        }
+        resp = self.client.post(
+            reverse('api-events'),
+            data=json.dumps(ack),
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(SendSMS.objects.get(pk=sms.pk).status, 'd')
+        self.assertEqual(SendSMS.objects.get(pk=self.sms.pk).status, 'v')
+
+    def test_ack_message_id_with_old_identifier_prefix(self):
+        # an old message whose identifier is the prefix of a new message id
+        old = SendSMS.objects.create(
+            msisdn='27123456789',
+            smstext='smstext',
+            delivery=timezone.now(),
+            expiry=timezone.now(),
+            priority='Standard',
+            receipt='Y',
+            identifier='12345678',
+            message_id='12345678',
+            user=self.user,
+        )
+        ack = {
+            "event_type": "ack",
+            "user_message_id": self.sms.message_id,
+        }
+        resp = self.client.post(
+            reverse('api-events'),
+            data=json.dumps(ack),
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(SendSMS.objects.get(pk=self.sms.pk).status, 'd')
+        self.assertEqual(SendSMS.objects.get(pk=old.pk).status, 'v')
+
     def test_nack(self):
         ack = {
             "event_type": "nack",
-            "user_message_id": self.sms.identifier,
+            "user_message_id": self.sms.message_id,
         }
 
         resp = self.client.post(
@@ -159,7 +218,7 @@ class TestEventHandling(TestCase):
         ack = {
             "event_type": "delivery_report",
             "delivery_status": "delivered",
-            "user_message_id": self.sms.identifier,
+            "user_message_id": self.sms.message_id,
         }
 
         resp = self.client.post(
@@ -174,7 +233,7 @@ class TestEventHandling(TestCase):
         ack = {
             "event_type": "delivery_report",
             "delivery_status": "pending",
-            "user_message_id": self.sms.identifier,
+            "user_message_id": self.sms.message_id,
         }
 
         resp = self.client.post(
@@ -189,7 +248,7 @@ class TestEventHandling(TestCase):
         ack = {
             "event_type": "delivery_report",
             "delivery_status": "failed",
-            "user_message_id": self.sms.identifier,
+            "user_message_id": self.sms.message_id,
         }
 
         resp = self.client.post(
@@ -204,7 +263,7 @@ class TestEventHandling(TestCase):
         ack = {
             "event_type": "delivery_report",
             "delivery_status": "foo",
-            "user_message_id": self.sms.identifier,
+            "user_message_id": self.sms.message_id,
         }
 
         resp = self.client.post(
@@ -225,4 +284,210 @@ class TestEventHandling(TestCase):
             reverse('api-events'),
             data=json.dumps(ack),
             content_type='application/json')
-        self.assertEqual(resp.status_code, 400)
\ No newline at end of file
+        self.assertEqual(resp.status_code, 400)
+
+class TestBatchEventHandling(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(
+            username='user', email='user@domain.com', password='password')
+        self.smss = [SendSMS.objects.create(
+            msisdn='27123456789',
+            smstext='smstext',
+            delivery=timezone.now(),
+            expiry=timezone.now(),
+            priority='Standard',
+            receipt='Y',
+            identifier='%08d' % i,
+            message_id='%08d-message-id' % i,
+            user=self.user,
+        ) for i in range(3)]
+
+    def post_events(self, events):
+        return self.client.post(
+            reverse('api-events-batch'),
+            data=json.dumps(events),
+            content_type='application/json')
+
+    def test_batch(self):
+        events = [{
+            "event_type": "ack",
+            "user_message_id": self.smss[0].message_id,
+        }, {
+            "event_type": "nack",
+            "user_message_id": self.smss[1].message_id,
+        }, {
+            "event_type": "ack",
+            "user_message_id": self.smss[2].message_id,
+        }, {
+            "event_type": "delivery_report",
+            "delivery_status": "delivered",
+            "user_message_id": self.smss[2].message_id,
+        }, {
+            "event_type": "ack",
+            "user_message_id": "does-not-exist",
+        }, {
+            "event_type": "ack",
+        }]
+        # one lookup and an UPDATE per status
+        with self.assertNumQueries(4):
+            resp = self.post_events(events)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [result['result'] for result in json.loads(resp.content)],
+            ['updated', 'updated', 'updated', 'updated', 'not_found',
+             'invalid'])
+        self.assertEqual(
+            [SendSMS.objects.get(pk=sms.pk).status for sms in self.smss],
+            ['d', 'F', 'D'])
+
+    def test_batch_invalid_message_ids(self):
+        events = [{
+            "event_type": "ack",
+            "user_message_id": user_message_id,
+        } for user_message_id in [1234567890, ["a", "b"], None,
+                                  self.smss[0].message_id]]
+        resp = self.post_events(events)
+        self.assertTrue(resp.status_code in (200, 202))
+        self.assertEqual(
+            [result['result'] for result in json.loads(resp.content)][:3],
+            ['invalid', 'invalid', 'invalid'])
+
+    def test_batch_not_a_list(self):
+        resp = self.post_events({
+            "event_type": "ack",
+            "user_message_id": self.smss[0].message_id,
+        })
+        self.assertEqual(resp.status_code, 400)
+
+
+class FakeRedis(object):
+    """The few Redis commands the receipt queue uses, in memory"""
+
+    def __init__(self):
+        self.data = {}
+
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def hsetnx(self, key, field, value):
+        self.data.setdefault(key, {}).setdefault(field, value)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def rename(self, key, new_key):
+        if key not in self.data:
+            raise redis.ResponseError('no such key')
+        self.data[new_key] = self.data.pop(key)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+
+@override_settings(API_EVENTS_QUEUE=True)
+class TestQueuedEventHandling(TestBatchEventHandling):
+
+    def setUp(self):
+        super(TestQueuedEventHandling, self).setUp()
+        self.redis = FakeRedis()
+        self.queue = receipts.ReceiptQueue(interval=2,
+                                           connection=self.redis)
+        patcher = patch.object(receipts, 'receipt_queue', self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # the tests flush themselves
+        patcher = patch.object(tasks.flush_receipts, 'apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_queued(self):
+        for event_type in ['ack', 'delivery_report']:
+            resp = self.client.post(
+                reverse('api-events'),
+                data=json.dumps({
+                    "event_type": event_type,
+                    "delivery_status": "delivered",
+                    "user_message_id": self.smss[0].message_id,
+                }),
+                content_type='application/json')
+            self.assertEqual(resp.status_code, 202)
+        self.assertEqual(SendSMS.objects.get(pk=self.smss[0].pk).status, 'v')
+        # coalesced into the latest event
+        with self.assertNumQueries(2):
+            self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual(SendSMS.objects.get(pk=self.smss[0].pk).status, 'D')
+
+    def test_batch(self):
+        events = [{
+            "event_type": "nack",
+            "user_message_id": sms.message_id,
+        } for sms in self.smss] + [{"event_type": "ack"}]
+        resp = self.post_events(events)
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(
+            [result['result'] for result in json.loads(resp.content)],
+            ['queued', 'queued', 'queued', 'invalid'])
+        self.assertEqual(self.queue.flush(), 3)
+        self.assertEqual(
+            [SendSMS.objects.get(pk=sms.pk).status for sms in self.smss],
+            ['F', 'F', 'F'])
+
+    def test_failed_flush_requeued(self):
+        self.queue.put([{
+            "event_type": "ack",
+            "user_message_id": sms.message_id,
+        } for sms in self.smss[:2]])
+        with patch.object(receipts, 'apply_events',
+                          side_effect=DatabaseError('gone away')):
+            self.assertRaises(DatabaseError, self.queue.flush)
+        # a newer event for the first message arrives before the retry
+        self.queue.put([{
+            "event_type": "delivery_report",
+            "delivery_status": "delivered",
+            "user_message_id": self.smss[0].message_id,
+        }])
+        self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(
+            [SendSMS.objects.get(pk=sms.pk).status for sms in self.smss],
+            ['D', 'd', 'v'])
+
+    def test_flush_scheduled(self):
+        event = {
+            "event_type": "ack",
+            "user_message_id": self.smss[0].message_id,
+        }
+        self.queue.put([event])
+        # a second queue on the same Redis stands in for another process
+        other = receipts.ReceiptQueue(interval=2, connection=self.redis)
+        other.put([dict(event, user_message_id=self.smss[1].message_id)])
+        # one flush for both
+        self.apply_async.assert_called_once_with(countdown=2)
+        self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(self.queue.flush(), 0)
+        self.assertEqual(
+            [SendSMS.objects.get(pk=sms.pk).status for sms in self.smss],
+            ['d', 'd', 'v'])
+        # the next event schedules the next flush
+        other.put([event])
+        self.assertEqual(self.apply_async.call_count, 2)
+        tasks.flush_receipts()
+        self.assertEqual(self.redis.hgetall(receipts.ReceiptQueue.KEY), {})
+
+    def test_failed_flush_rescheduled(self):
+        self.queue.put([{
+            "event_type": "ack",
+            "user_message_id": self.smss[0].message_id,
+        }])
+        with patch.object(receipts, 'apply_events',
+                          side_effect=DatabaseError('gone away')):
+            self.assertRaises(DatabaseError, self.queue.flush)
+        self.assertEqual(self.apply_async.call_count, 2)
+        self.assertEqual(self.queue.flush(), 1)
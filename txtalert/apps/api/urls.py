@@ -8,4 +8,6 @@ urlpatterns = patterns(
     '',
     url(r'^pcm\.json$', views.pcm, {}, 'api-pcm'),
     url(r'^events\.json$', views.events, {}, 'api-events'),
+    url(r'^events/batch\.json$', views.events_batch, {},
+        'api-events-batch'),
 )
@@ -4,10 +4,12 @@ import json
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.conf import settings
 from django.http import HttpResponse
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
+from txtalert.apps.api import receipts
 from txtalert.apps.gateway.models import PleaseCallMe, SendSMS
 
 
@@ -67,17 +69,31 @@ def events(request):
     if 'user_message_id' not in event.keys():
         return HttpResponse(status=400, content='No user_message_id provided')
 
-    identifier = event['user_message_id'][:8]
-    sms = SendSMS.objects.get(identifier=identifier)
-    if event['event_type'] == 'ack':
-        sms.status = 'd'  # sent
-    elif event['event_type'] == 'nack':
-        sms.status = 'F'  # failed
-    elif event['event_type'] == 'delivery_report':
-        sms.status = {
-            'pending': 'd',  # sent
-            'failed': 'F',  # failed
-            'delivered': 'D'  # delivered
-        }.get(event['delivery_status'], 'v')  # unknown
+    if settings.API_EVENTS_QUEUE:
+        receipts.receipt_queue.put([event])
+        return HttpResponse(status=202, content='Event queued.')
+
+    sms = SendSMS.objects.for_message_id(event['user_message_id']).get()
+    sms.status = receipts.event_status(event) or sms.status
     sms.save()
     return HttpResponse(status=201, content='Event registered.')
+
+
+@csrf_exempt
+@expect_json
+def events_batch(request):
+
+    events = request.json
+
+    if not isinstance(events, list):
+        return HttpResponse(status=400, content='Expected a list of events')
+
+    if settings.API_EVENTS_QUEUE:
+        return HttpResponse(status=202,
+                            content=json.dumps(
+                                receipts.receipt_queue.put(events)),
+                            content_type='application/json')
+
+    return HttpResponse(status=200,
+                        content=json.dumps(receipts.apply_events(events)),
+                        content_type='application/json')
@@ -1,4 +1,5 @@
 import json
+import uuid
 
 from django.http import HttpResponse
 
@@ -6,7 +7,6 @@ from django.contrib.auth.decorators import permission_required
 import logging
 from txtalert.apps.gateway.models import SendSMS
 
-from txtalert.core.utils import random_string
 from django.utils import timezone
 from datetime import datetime, timedelta
 
@@ -21,6 +21,7 @@ class Gateway(object):
                         priority='standard', receipt='Y'):
         delivery = delivery or timezone.now()
         expiry = expiry or (timezone.now() + timedelta(days=1))
+        message_id = uuid.uuid4().hex
         sms = SendSMS.objects.create(
                                         user=user,
                                         msisdn=msisdn,
@@ -29,7 +30,8 @@ class Gateway(object):
                                         expiry=expiry,
                                         priority=priority,
                                         receipt=receipt,
-                                        identifier=random_string()[:8])
+                                        identifier=message_id[:8],
+                                        message_id=message_id)
         logging.info(sms)
         return sms
 
@@ -1,13 +1,36 @@
 import json
+import threading
+import time
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from django.http import HttpResponse
 from django.conf import settings
 from django.utils import timezone
 
 from txtalert.apps.gateway.models import SendSMS
+from txtalert.core.utils import national_number
+
+
+class RateLimiter(object):
+    """Spaces calls to `wait` at least 1 / `rate` seconds apart, across
+    all the threads sharing the limiter."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
 
 
 class Gateway(object):
@@ -15,46 +38,113 @@ class Gateway(object):
     api_url = ("http://go.vumi.org/api/v1/go/http_api_nostream/"
                "{conversation_key}/messages.json")
 
-    def __init__(self, account_key, conversation_key, access_token):
+    def __init__(self, account_key, conversation_key, access_token,
+                 chunk_size=500, concurrency=1, rate_limit=None):
         self.account_key = account_key
         self.conversation_key = conversation_key
         self.access_token = access_token
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.pool = None
+        # one keep-alive connection per worker, reused across sends
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
-    def send_one_sms(self, user, msisdn, smstext):
+    def put_message(self, msisdn, smstext):
+        if self.rate_limiter:
+            self.rate_limiter.wait()
         url = self.api_url.format(conversation_key=self.conversation_key)
-        response = requests.put(url, data=json.dumps({
+        response = self.session.put(url, data=json.dumps({
             "content": smstext,
             "to_addr": msisdn,
         }), auth=(self.account_key, self.access_token))
-        reply = response.json()
+        return response.json()
+
+    def try_put_message(self, message):
+        msisdn, smstext = message
+        try:
+            return msisdn, smstext, self.put_message(msisdn, smstext), None
+        except Exception, e:
+            return msisdn, smstext, None, e
 
+    def put_messages(self, messages):
+        """Put the messages to the API, concurrently if `concurrency` allows
+        for it. Returns a `(msisdn, smstext, reply, error)` tuple for every
+        message that was attempted."""
+        if self.concurrency > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.concurrency)
+            return self.pool.map(self.try_put_message, messages)
+        results = []
+        for message in messages:
+            results.append(self.try_put_message(message))
+            if results[-1][3] is not None:
+                break
+        return results
+
+    def build_send_sms(self, user, msisdn, smstext, reply):
         send_sms = SendSMS()
         send_sms.user = user
         send_sms.msisdn = msisdn
+        # bulk inserts don't fire the pre_save signal that sets this
+        send_sms.national_number = national_number(msisdn)
         send_sms.smstext = smstext
         send_sms.delivery = timezone.now()
         send_sms.expiry = timezone.now() + timedelta(days=1)
         send_sms.priority = 'standard'
         send_sms.receipt = 'Y'
         send_sms.identifier = reply['message_id'][:8]
+        send_sms.message_id = reply['message_id']
+        return send_sms
+
+    def send_one_sms(self, user, msisdn, smstext):
+        reply = self.put_message(msisdn, smstext)
+        send_sms = self.build_send_sms(user, msisdn, smstext, reply)
         send_sms.save()
         return send_sms
 
     def send_sms(self, user, msisdns, smstexts):
-        responses = []
-        for msisdn, smstext in zip(msisdns, smstexts):
-            send_sms = self.send_one_sms(user, msisdn, smstext)
-            responses.append(send_sms.pk)
-        return SendSMS.objects.filter(pk__in=responses)
+        return self.send_bulk_sms(user, msisdns, smstexts)
+
+    def send_bulk_sms(self, user, msisdns, smstexts, chunk_size=None):
+        """Send the messages and store a SendSMS for each of them with
+        one bulk insert per `chunk_size` messages. The stored objects are
+        returned as a list, they are not read back from the database."""
+        chunk_size = chunk_size or self.chunk_size
+        messages = zip(msisdns, smstexts)
+        send_smss = []
+        for offset in range(0, len(messages), chunk_size):
+            chunk = []
+            errors = []
+            results = self.put_messages(messages[offset:offset + chunk_size])
+            for msisdn, smstext, reply, error in results:
+                if error is None:
+                    chunk.append(
+                        self.build_send_sms(user, msisdn, smstext, reply))
+                else:
+                    errors.append(error)
+            # whatever made it to the API needs to be on record, even
+            # if other messages in this chunk failed
+            SendSMS.objects.bulk_create(chunk)
+            send_smss.extend(chunk)
+            if errors:
+                raise errors[0]
+        return send_smss
 
 gateway = Gateway(settings.VUMIGO_ACCOUNT_KEY,
                   settings.VUMIGO_CONVERSATION_KEY,
-                  settings.VUMIGO_CONVERSATION_ACCESS_TOKEN)
+                  settings.VUMIGO_CONVERSATION_ACCESS_TOKEN,
+                  chunk_size=settings.VUMIGO_SEND_CHUNK_SIZE,
+                  concurrency=settings.VUMIGO_SEND_CONCURRENCY,
+                  rate_limit=settings.VUMIGO_SEND_RATE_LIMIT)
 
 
 def sms_receipt_handler(request, *args, **kwargs):
     data = json.loads(request.body)
-    send_smss = SendSMS.objects.filter(identifier=data['user_message_id'][:8])
+    send_smss = SendSMS.objects.for_message_id(data['user_message_id'])
     send_smss.update(status=data['delivery_status'],
                      delivery_timestamp=data['timestamp'])
     return HttpResponse("ok", status=201)
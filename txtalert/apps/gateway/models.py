@@ -30,6 +30,19 @@ RECEIPT_STATUS_CHOICES = (
     ('A', 'Billing unknown'), # network operator or aggregator failed to acknowledge a billing attempt, so the billing operation may have taken place but probably has not. The customer should not be re-billed without checking with them to see if the network operator has billed them.
 )
 
+class SendSMSManager(models.Manager):
+
+    def for_message_id(self, message_id):
+        """The SendSMSs for a provider's message id. Messages stored before
+        the full message id was kept have their 8 character identifier as
+        the message id, they're only matched if no message has the full
+        message id."""
+        send_smss = self.filter(message_id=message_id)
+        if send_smss.exists():
+            return send_smss
+        return self.filter(message_id=message_id[:8])
+
+
 class SendSMS(models.Model):
     """A local storage of SMS's sent via the SendSMS API, need to keep 
     track of these to be able to process the receipts we receive asynchronously
@@ -51,14 +64,21 @@ class SendSMS(models.Model):
     
     user = models.ForeignKey(User)
     msisdn = models.CharField(max_length=12)
+    # the last 9 digits, for matching differently formatted numbers
+    national_number = models.CharField(max_length=9, null=True, blank=True,
+                                        db_index=True, editable=False)
     smstext = models.TextField()
     delivery = models.DateTimeField()
     expiry = models.DateTimeField()
     priority = models.CharField(max_length=80, choices=PRIORITY_CHOICES)
     receipt = models.CharField(max_length=1, choices=RECEIPT_CHOICES)
     identifier = models.CharField(blank=False, max_length=8)
+    message_id = models.CharField(max_length=255, unique=True, null=True,
+                                    blank=True)
     status = models.CharField(max_length=1, default='v', choices=RECEIPT_STATUS_CHOICES)
     delivery_timestamp = models.DateTimeField(null=True)
+
+    objects = SendSMSManager()
     
     class Meta:
         permissions = (
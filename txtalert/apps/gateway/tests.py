@@ -1,10 +1,25 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from uuid import uuid4
+import json
+import os
+import time
+from unittest import skipUnless
+
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib.auth.models import User
+from mock import Mock, patch
 from txtalert.apps.gateway.backends.dummy import backend
 from txtalert.apps import gateway
 from txtalert.apps.gateway.models import *
 from django.utils import timezone
 from datetime import datetime
 
+# the timing comparisons only hold on an idle machine
+BENCHMARKS = bool(os.environ.get('TXTALERT_BENCHMARKS'))
+
 class GatewayLoadingTestCase(TestCase):
 
     def test_loading_of_dummy_gateway(self):
@@ -48,3 +63,148 @@ class GatewayModelTestCase(TestCase):
             u'PleaseCallMe: 27123456789',
             unicode(pcm)
         )
+
+
+@override_settings(VUMIGO_ACCOUNT_KEY='account-key',
+                   VUMIGO_CONVERSATION_KEY='conversation-key',
+                   VUMIGO_CONVERSATION_ACCESS_TOKEN='access-token')
+class VumiGoGatewayTestCase(TestCase):
+
+    def setUp(self):
+        from txtalert.apps.gateway.backends.vumigo import backend
+        self.gateway = backend.Gateway('account-key', 'conversation-key',
+                                       'access-token', chunk_size=2)
+        self.user = User.objects.create_user('user', 'user@domain.com',
+                                             'password')
+        self.message_ids = iter(['%032x' % i for i in range(1, 100)])
+
+    def mock_put(self, url, data, auth):
+        response = Mock()
+        response.json.return_value = {'message_id': next(self.message_ids)}
+        return response
+
+    def test_send_bulk_sms(self):
+        msisdns = ['2712345678%s' % i for i in range(5)]
+        with patch.object(self.gateway.session, 'put',
+                          side_effect=self.mock_put) as put:
+            # one INSERT per chunk of 2 messages, nothing is read back
+            with self.assertNumQueries(3):
+                send_smss = self.gateway.send_sms(
+                    self.user, msisdns, ['hello'] * len(msisdns))
+        self.assertEqual(put.call_count, 5)
+        self.assertEqual(len(send_smss), 5)
+        self.assertEqual(SendSMS.objects.count(), 5)
+        self.assertEqual(
+            sorted(SendSMS.objects.values_list('msisdn', flat=True)),
+            msisdns)
+        self.assertEqual(send_smss[0].identifier, '00000000')
+        self.assertEqual(send_smss[0].message_id, '%032x' % 1)
+
+    def test_send_bulk_sms_failure(self):
+        responses = [self.mock_put(None, None, None), Exception('timeout')]
+        with patch.object(self.gateway.session, 'put', side_effect=responses):
+            self.assertRaises(
+                Exception, self.gateway.send_sms, self.user,
+                ['27123456780', '27123456781'], ['hello', 'hello'])
+        # the message accepted by the API is still on record
+        self.assertEqual(SendSMS.objects.count(), 1)
+
+
+class StubVumiGoHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep the connection alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(self.client_address)
+        time.sleep(self.server.latency)
+        body = json.dumps({'message_id': uuid4().hex})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubVumiGoServer(ThreadingMixIn, HTTPServer):
+    """A local stand-in for the Vumi Go HTTP API that answers every PUT
+    after `latency` seconds, for benchmarking the gateway's dispatch."""
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubVumiGoHandler)
+        self.latency = latency
+        self.requests = []
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:%s/{conversation_key}/messages.json' % (
+            self.server_address[1],)
+
+    def __enter__(self):
+        Thread(target=self.serve_forever).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+@override_settings(VUMIGO_ACCOUNT_KEY='account-key',
+                   VUMIGO_CONVERSATION_KEY='conversation-key',
+                   VUMIGO_CONVERSATION_ACCESS_TOKEN='access-token')
+class VumiGoDispatchTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@domain.com',
+                                             'password')
+        self.msisdns = ['271234567%02d' % i for i in range(12)]
+
+    def send(self, server, **kwargs):
+        from txtalert.apps.gateway.backends.vumigo import backend
+        gateway = backend.Gateway('account-key', 'conversation-key',
+                                  'access-token', **kwargs)
+        gateway.api_url = server.api_url
+        start = time.time()
+        send_smss = gateway.send_sms(self.user, self.msisdns,
+                                     ['hello'] * len(self.msisdns))
+        return send_smss, time.time() - start
+
+    def test_concurrent_dispatch(self):
+        with StubVumiGoServer() as server:
+            self.send(server)
+            # a single connection is kept alive for all the messages
+            self.assertEqual(len(set(server.requests)), 1)
+            server.requests = []
+            send_smss, _ = self.send(server, concurrency=4)
+            self.assertEqual(len(server.requests), 12)
+            self.assertTrue(len(set(server.requests)) <= 4)
+        self.assertEqual(len(send_smss), 12)
+        self.assertEqual(SendSMS.objects.count(), 24)
+
+    def test_rate_limit(self):
+        from txtalert.apps.gateway.backends.vumigo import backend
+        # a clock that stands still, the calls after the first wait for
+        # their slot
+        clock = Mock()
+        clock.time.return_value = 1000.0
+        with StubVumiGoServer() as server:
+            with patch.object(backend, 'time', clock):
+                send_smss, _ = self.send(server, concurrency=4,
+                                         rate_limit=40)
+        self.assertEqual(len(send_smss), 12)
+        # 12 messages at 40 per second are spaced 1 / 40 seconds apart
+        waits = sorted(call[0][0] for call in clock.sleep.call_args_list)
+        self.assertEqual(len(waits), 11)
+        for i, wait in enumerate(waits):
+            self.assertAlmostEqual(wait, (i + 1) / 40.0)
+
+    @skipUnless(BENCHMARKS, 'set TXTALERT_BENCHMARKS=1 to run benchmarks')
+    def test_concurrent_dispatch_benchmark(self):
+        with StubVumiGoServer(latency=0.05) as server:
+            _, serial = self.send(server)
+            _, concurrent = self.send(server, concurrency=4)
+        self.assertTrue(concurrent < serial / 2)
@@ -1,11 +1,15 @@
 from txtalert.apps.googledoc.reader.spreadsheetReader import SimpleCRUD
 from txtalert.core.models import Patient, MSISDN, Visit, Clinic
+from txtalert.core.signals import queue_visit_counts
+from txtalert.core.utils import national_number
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 import re
 import logging
 import hashlib
+import time
 
 MSISDNS_RE = re.compile(r'^([+]?(0|27)[0-9]{9}/?)+$')
 PHONE_RE = re.compile(r'[0-9]{9}')
@@ -16,17 +20,41 @@ STATUS_RE = re.compile(r'^[a-zA-Z]+$')
 #the amount of time to cache a enrollment status
 CACHE_TIMEOUT = 30
 
+#the number of rows written or looked up per query in batch mode, sqlite
+#allows 999 query parameters
+BATCH_CHUNK_SIZE = 500
+
 def split_file_no(file_no):
     file_nos = [x.strip() for x in file_no.split('/')]
     return file_nos
 
 
+def in_chunks(queryset, field, values):
+    """Filter the queryset on `field__in` per chunk of values"""
+    values = list(values)
+    for offset in range(0, len(values), BATCH_CHUNK_SIZE):
+        for result in queryset.filter(**{
+                '%s__in' % field: values[offset:offset + BATCH_CHUNK_SIZE]}):
+            yield result
+
+
+def history_rows(model, instances, history_type, history_date):
+    """The historical records a save of every instance would write"""
+    fields = [field.attname for field in model._meta.concrete_fields]
+    return [model.history.model(history_type=history_type,
+                                history_date=history_date,
+                                **dict((field, getattr(instance, field))
+                                       for field in fields))
+            for instance in instances]
+
+
 class Importer(object):
-    def __init__(self, owner, email, password):
+    def __init__(self, owner, email, password, batch=False):
         '''
         @arguments:
         email: The user's google email account username.
         password: The user's google account password.
+        batch: reconcile each worksheet as a whole, see `WorksheetBatch`.
 
         Uses google account details to login to the user's account.
         The account details are used by the spreadsheet reader class
@@ -36,6 +64,7 @@ class Importer(object):
         self.owner = owner
         self.email = email
         self.password = password
+        self.batch = batch
         self.reader = SimpleCRUD(self.email, self.password)
         self.enrollment_cache_dict = {}
 
@@ -54,12 +83,35 @@ class Importer(object):
         else:
             return True
 
-    def import_spread_sheet(self, doc_name, start, until):
+    def fetch_spread_sheet(self, doc_name, start, until, reader=None):
         """
         @arguments:
         doc_name: the name of spreadsheet to import data from.
         start: indicates the date to start import data from.
         until: indicates the date import data function must stop at.
+        reader: the SimpleCRUD to read with, a new one if not given.
+
+        Reads the enrollment map and the appointment worksheets of
+        a google spreadsheet without touching the database. A new
+        SimpleCRUD reuses the account's login, so spreadsheets can
+        be fetched from different threads.
+
+        @returns:
+        (enrollment_map, month, seconds) to pass to import_spread_sheet.
+        """
+        started = time.time()
+        reader = reader or SimpleCRUD(self.email, self.password)
+        enrollment_map = reader.get_enrollment_map(doc_name)
+        month = reader.run_appointment(str(doc_name), start, until)
+        return (enrollment_map, month, time.time() - started)
+
+    def import_spread_sheet(self, doc_name, start, until, fetched=None):
+        """
+        @arguments:
+        doc_name: the name of spreadsheet to import data from.
+        start: indicates the date to start import data from.
+        until: indicates the date import data function must stop at.
+        fetched: what fetch_spread_sheet read, fetched now if not given.
 
         This reads data from a google spreadsheet.
         If the data to be read from a spreadsheet is from
@@ -74,9 +126,10 @@ class Importer(object):
         self.until = until
         self.doc_name = str(doc_name)
 
-        self.enrollment_cache_dict[doc_name] = self.reader.get_enrollment_map(doc_name)
-
-        self.month = self.reader.run_appointment(self.doc_name, start, until)
+        if fetched is None:
+            fetched = self.fetch_spread_sheet(doc_name, start, until,
+                                              self.reader)
+        self.enrollment_cache_dict[doc_name], self.month, _ = fetched
         #counts how many enrolled patients where updated correctly
         correct_updates = 0
         #counter for number of patients found on the enrollement worksheet
@@ -126,7 +179,10 @@ class Importer(object):
         and checks if the patient has enrolled to use appointment service.
         If patient was found in the enrollment worksheet then perfom updates
         else log error that the patient needs to be enrolled.
+        In batch mode the worksheet is handed to `WorksheetBatch`.
         """
+        if self.batch:
+            return self.update_patients_in_batch(month_worksheet, doc_name)
         #counts how many enrolled patients where updated correctly
         correct_updates = 0
         #counter for number of patients found on the enrollement worksheet
@@ -168,6 +224,25 @@ class Importer(object):
 
         return (enrolled_counter, correct_updates)
 
+    @transaction.atomic
+    def update_patients_in_batch(self, month_worksheet, doc_name):
+        """
+        @arguments:
+        month_worksheet: store the current month's worksheet from spreadsheet.
+        doc_name: the name of spreadsheet to import data from.
+
+        Does what `update_patients` does for all the rows of the
+        worksheet at once, see `WorksheetBatch`.
+
+        @returns:
+        (enrolled_counter, correct_updates) like `update_patients`.
+        """
+        batch = WorksheetBatch(self, doc_name, month_worksheet)
+        for row in month_worksheet:
+            batch.process(row)
+        batch.save()
+        return (batch.enrolled_counter, batch.correct_updates)
+
     def update_patient(self, patient_row, row, doc_name, start, until):
         '''
         @rguments:
@@ -622,3 +697,276 @@ class Importer(object):
                     except:
                         logging.exception("Appointment failed to update")
                         return curr_visit.status
+
+
+class WorksheetBatch(object):
+    """Reconciles the rows of a worksheet in memory the way
+    `Importer.update_patient` does against the database. The patients,
+    visits and MSISDNs the rows refer to are loaded up front and the
+    changes are written with bulk queries by `save`, together with the
+    historical records and visit counters the saves would have written."""
+
+    def __init__(self, importer, doc_name, month_worksheet):
+        self.importer = importer
+        self.doc_name = doc_name
+        self.enrolled_counter = 0
+        self.correct_updates = 0
+        self.rows = {}
+        for row in month_worksheet:
+            parsed = self.parse_row(row, month_worksheet[row])
+            if parsed:
+                self.rows[row] = parsed
+
+        file_nos = set(parsed[0] for parsed in self.rows.values())
+        phones = set(parsed[1] for parsed in self.rows.values())
+        visit_ids = set(parsed[4] for parsed in self.rows.values())
+
+        # soft deleted patients & visits can't be found but their ids
+        # can't be used again either
+        self.patients = {}
+        self.taken_te_ids = set()
+        for patient in in_chunks(Patient.all_objects.all(), 'te_id',
+                                 file_nos):
+            self.taken_te_ids.add(patient.te_id)
+            if not patient.deleted:
+                self.patients[patient.te_id] = patient
+        patients_by_pk = dict((patient.pk, patient)
+                              for patient in self.patients.values())
+
+        fields = [field.attname for field in Visit._meta.concrete_fields]
+        visit_rows = [dict(zip(fields, row)) for row in in_chunks(
+            Visit.all_objects.values_list(*fields), 'te_visit_id',
+            visit_ids)]
+        # a visit is found by its id alone, it can belong to any patient
+        other_patients = set(row['patient_id'] for row in visit_rows) \
+            - set(patients_by_pk)
+        patients_by_pk.update((patient.pk, patient) for patient in in_chunks(
+            Patient.all_objects.all(), 'pk', other_patients))
+        self.visits = {}
+        self.taken_visit_ids = set()
+        for row in visit_rows:
+            self.taken_visit_ids.add(row['te_visit_id'])
+            if row['deleted']:
+                continue
+            # give it its patient, saves looking it up when the Visit is
+            # initialized
+            row['patient'] = patients_by_pk[row.pop('patient_id')]
+            visit = Visit(**row)
+            visit._state.adding = False
+            visit._state.db = Visit.objects.db
+            self.visits[visit.te_visit_id] = visit
+
+        self.msisdns = dict((msisdn.msisdn, msisdn) for msisdn in in_chunks(
+            MSISDN.objects.all(), 'msisdn', phones))
+
+        self.clinic = None
+        self.new_msisdns = []
+        self.new_patients = []
+        # (patient, msisdn) pairs for `Patient.msisdns`
+        self.new_contacts = []
+        self.new_visits = []
+        self.changed_visits = []
+
+    def parse_row(self, row, patient_row):
+        """Checks a row like `update_patients` and `update_patient` do.
+        Returns the file no, phone, appointment date & status and the visit
+        id for a row of an enrolled patient that has valid formats."""
+        importer = self.importer
+        file_no = patient_row['fileno']
+        if not importer.is_enrolled(self.doc_name, file_no):
+            logging.exception('Cannot send reminder to Patient %s '
+                'since she/he has not been enrolled' % (file_no,))
+            return
+        self.enrolled_counter += 1
+
+        file_no, file_format = importer.check_file_no_format(file_no)
+        phone, phone_format = importer.check_msisdn_format(
+                                                patient_row['phonenumber'])
+        app_date = patient_row['appointmentdate1']
+        app_status, status_format = importer.check_appointment_status(
+                                        patient_row['appointmentstatus1'])
+        if not (file_format and phone_format and status_format):
+            if not file_format:
+                logging.exception("Invalid File No. format (%s) for patient: %s" % (
+                    repr(file_no), file_no))
+            if not phone_format:
+                logging.exception("Invalid Phone No. format (%s) for patient: %s" % (
+                    str(phone), file_no))
+            if not status_format:
+                logging.exception("Invalid Status format (%s) for patient: %s" % (
+                    repr(app_status), file_no))
+            if not app_date:
+                logging.exception("Invalid Date format (%s) for patient: %s" % (
+                    repr(app_date), file_no))
+            return
+        visit_id = '%02d-%s' % (row, file_no)
+        return (file_no, phone, app_date, app_status, visit_id)
+
+    def get_clinic(self):
+        if self.clinic is None:
+            self.clinic = self.importer.get_or_create_clinic(self.doc_name)
+        return self.clinic
+
+    def get_or_create_msisdn(self, phone):
+        """Queue a new MSISDN unless it exists, like
+        `Importer.get_or_create_msisdn`"""
+        if phone in self.msisdns:
+            return (self.msisdns[phone], False)
+        msisdn = MSISDN(msisdn=phone, national_number=national_number(phone))
+        self.msisdns[phone] = msisdn
+        self.new_msisdns.append(msisdn)
+        return (msisdn, True)
+
+    def create_visit(self, visit_id, patient, app_date, status):
+        """Queue a new visit unless its id is taken or it has no status,
+        where `Importer.create_visit` runs into an IntegrityError"""
+        if visit_id in self.taken_visit_ids or status is None:
+            logging.error("Failed to create visit %s." % visit_id)
+            return None
+        visit = Visit(te_visit_id=visit_id, patient=patient, date=app_date,
+                      status=status, clinic=self.get_clinic())
+        self.taken_visit_ids.add(visit_id)
+        self.visits[visit_id] = visit
+        self.new_visits.append(visit)
+        return visit
+
+    def process(self, row):
+        if row not in self.rows:
+            return
+        file_no, phone, app_date, app_status, visit_id = self.rows[row]
+        patient = self.patients.get(file_no)
+        if patient is None:
+            updated = self.create_patient(file_no, phone, app_date,
+                                          app_status, visit_id)
+        else:
+            self.get_clinic()
+            self.update_appointment_status(patient, app_date, app_status,
+                                           visit_id)
+            self.update_msisdn(patient, phone)
+            # `update_msisdn` always reports an update for a valid number
+            updated = True
+        if updated is True:
+            self.correct_updates += 1
+
+    def create_patient(self, file_no, phone, app_date, app_status,
+                       visit_id):
+        """Like `Importer.create_patient`"""
+        msisdn, created = self.get_or_create_msisdn(phone)
+        if file_no in self.taken_te_ids:
+            logging.error("Failed to create patient invalid field")
+            return False
+        patient = Patient(te_id=file_no, active_msisdn=msisdn,
+                          owner=self.importer.owner)
+        self.taken_te_ids.add(file_no)
+        self.patients[file_no] = patient
+        self.new_patients.append(patient)
+        self.new_contacts.append((patient, msisdn))
+        self.get_clinic()
+        status = self.importer.update_needed(app_status)
+        if self.create_visit(visit_id, patient, app_date, status):
+            logging.debug("Created patient's visit")
+            return True
+
+    def update_appointment_status(self, patient, app_date, app_status,
+                                  visit_id):
+        """Like `Importer.update_appointment_status`"""
+        status = self.importer.update_needed(app_status)
+        curr_visit = self.visits.get(visit_id)
+        if curr_visit is None:
+            logging.debug("Creating a new visit for patient")
+            curr_visit = self.create_visit(visit_id, patient, app_date,
+                                           status)
+            if curr_visit is None:
+                return
+        #dont update if the status has not changed
+        if status == curr_visit.status:
+            return
+
+        if curr_visit.date >= app_date:
+            if app_status in ('Attended', 'Missed') and \
+                    curr_visit.status in ('s', 'r'):
+                curr_visit.status = 'a' if app_status == 'Attended' else 'm'
+                self.changed_visits.append(curr_visit)
+        elif app_status == 'Rescheduled' and curr_visit.status == 's':
+            curr_visit.status = 'r'
+            curr_visit.date = app_date
+            self.changed_visits.append(curr_visit)
+
+    def update_msisdn(self, patient, phone):
+        """Like `Importer.update_msisdn`, a new number is added to the
+        patient's numbers. The active number isn't saved there either."""
+        msisdn, created = self.get_or_create_msisdn(phone)
+        if created:
+            self.new_contacts.append((patient, msisdn))
+
+    def save(self):
+        """Write the queued changes with their historical records and count
+        the visits for their patients"""
+        now = timezone.now()
+        if self.new_msisdns:
+            MSISDN.objects.bulk_create(self.new_msisdns,
+                                       batch_size=BATCH_CHUNK_SIZE)
+            # bulk_create doesn't give them their primary keys
+            new_msisdns = dict((msisdn.msisdn, msisdn)
+                               for msisdn in self.new_msisdns)
+            for phone, pk in in_chunks(MSISDN.objects.values_list(
+                    'msisdn', 'pk'), 'msisdn', new_msisdns):
+                new_msisdns[phone].pk = pk
+
+        if self.new_patients:
+            for patient in self.new_patients:
+                # now that it has a primary key
+                patient.active_msisdn = patient.active_msisdn
+            Patient.objects.bulk_create(self.new_patients,
+                                        batch_size=BATCH_CHUNK_SIZE)
+            new_patients = dict((patient.te_id, patient)
+                                for patient in self.new_patients)
+            for te_id, pk in in_chunks(Patient.all_objects.values_list(
+                    'te_id', 'pk'), 'te_id', new_patients):
+                patient = new_patients[te_id]
+                patient.pk = pk
+                patient._state.adding = False
+                patient._state.db = Patient.objects.db
+            Patient.history.model.objects.bulk_create(
+                history_rows(Patient, self.new_patients, '+', now),
+                batch_size=BATCH_CHUNK_SIZE)
+
+        if self.new_contacts:
+            Contact = Patient.msisdns.through
+            Contact.objects.bulk_create([
+                Contact(patient_id=patient.pk, msisdn_id=msisdn.pk)
+                for patient, msisdn in self.new_contacts],
+                batch_size=BATCH_CHUNK_SIZE)
+
+        if self.new_visits:
+            for visit in self.new_visits:
+                visit.patient = visit.patient
+            Visit.objects.bulk_create(self.new_visits,
+                                      batch_size=BATCH_CHUNK_SIZE)
+            new_visits = dict((visit.te_visit_id, visit)
+                              for visit in self.new_visits)
+            for visit_id, pk in in_chunks(Visit.all_objects.values_list(
+                    'te_visit_id', 'pk'), 'te_visit_id', new_visits):
+                visit = new_visits[visit_id]
+                visit.pk = pk
+                visit._state.adding = False
+                visit._state.db = Visit.objects.db
+
+        # new visits never change, they are created with the row's status
+        pks_per_values = {}
+        for visit in self.changed_visits:
+            visit.updated_at = now
+            pks_per_values.setdefault((visit.status, visit.date),
+                                      []).append(visit.pk)
+        for (status, date), pks in pks_per_values.items():
+            for offset in range(0, len(pks), BATCH_CHUNK_SIZE):
+                Visit.all_objects.filter(
+                    pk__in=pks[offset:offset + BATCH_CHUNK_SIZE]).update(
+                        status=status, date=date, updated_at=now)
+
+        if self.new_visits or self.changed_visits:
+            Visit.history.model.objects.bulk_create(
+                history_rows(Visit, self.new_visits, '+', now) +
+                history_rows(Visit, self.changed_visits, '~', now),
+                batch_size=BATCH_CHUNK_SIZE)
+            queue_visit_counts(self.new_visits + self.changed_visits)
@@ -1,8 +1,12 @@
 from datetime import timedelta, date
 from django.core.management.base import BaseCommand
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
 from txtalert.apps.googledoc.importer import Importer
 from txtalert.apps.googledoc.models import SpreadSheet, GoogleAccount
+from gdata.service import BadAuthentication, CaptchaRequired
 import logging
+import time
 
 
 class Command(BaseCommand):
@@ -13,26 +17,68 @@ class Command(BaseCommand):
         with appointment information."""
     help = 'Can run as Cron job or directly to import google spreadsheet data.'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', dest='batch', action='store_true',
+                    help=('Reconcile each worksheet as a whole with bulk '
+                          'queries instead of row by row.')),
+        make_option('--workers', dest='workers', default=1, type='int',
+                    help=('The number of threads fetching the spreadsheets '
+                          'of all the accounts concurrently, the changes '
+                          'are still written one spreadsheet at a time.')),
+    )
+
     def handle(self, *args, **kwargs):
+        midnight = date.today()
+        start = midnight - timedelta(days=1)
+        # until 14 days later
+        until = midnight + timedelta(days=14)
+
+        spreadsheets = []
         try:
             for account in GoogleAccount.objects.all():
-                importer = Importer(
-                    owner=account.user,
-                    email=account.username,
-                    password=account.password
-                )
+                try:
+                    importer = Importer(
+                        owner=account.user,
+                        email=account.username,
+                        password=account.password,
+                        batch=kwargs.get('batch', False)
+                    )
+                except (BadAuthentication, CaptchaRequired):
+                    # logged by the reader, the other accounts can go ahead
+                    continue
                 for spreadsheet in SpreadSheet.objects.filter(account=account):
-                    midnight = date.today()
-                    start = midnight - timedelta(days=1)
-                    # until 14 days later
-                    until = midnight + timedelta(days=14)
-                    try:
-                        importer.import_spread_sheet(spreadsheet.spreadsheet,
-                                                     start, until)
-                    except:
-                        logging.exception("Update error for: %s" % (
-                            spreadsheet.spreadsheet,))
-                        logging.exception("Error while updating patient")
+                    spreadsheets.append((importer, spreadsheet.spreadsheet))
         except GoogleAccount.DoesNotExist:
             logging.exception("Google Account does not exists")
             return
+
+        pool = None
+        fetches = [None] * len(spreadsheets)
+        workers = kwargs.get('workers') or 1
+        if workers > 1:
+            # start fetching everything, the spreadsheets are written in
+            # order from this thread as they come in
+            pool = ThreadPool(workers)
+            fetches = [pool.apply_async(importer.fetch_spread_sheet,
+                                        (doc_name, start, until))
+                       for importer, doc_name in spreadsheets]
+
+        for (importer, doc_name), fetch in zip(spreadsheets, fetches):
+            try:
+                if fetch is None:
+                    fetched = importer.fetch_spread_sheet(
+                        doc_name, start, until, importer.reader)
+                else:
+                    fetched = fetch.get()
+                started = time.time()
+                importer.import_spread_sheet(doc_name, start, until,
+                                             fetched=fetched)
+                print "%s: fetched in %.2fs, written in %.2fs" % (
+                    doc_name, fetched[-1], time.time() - started)
+            except:
+                logging.exception("Update error for: %s" % (doc_name,))
+                logging.exception("Error while updating patient")
+
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -21,9 +21,25 @@ import gdata.spreadsheet.service
 from gdata.service import BadAuthentication, CaptchaRequired
 import gdata.service
 import gdata.spreadsheet
+from django.conf import settings
+from django.core.cache import cache
 import datetime
+import hashlib
 import logging
-from collections import defaultdict
+import threading
+
+
+#the ClientLogin tokens of the accounts, every account logs in once per
+#process and the clients made after that reuse its token
+login_tokens = {}
+login_lock = threading.Lock()
+
+
+def cache_key(*parts):
+    """Key for the Django cache, hashed since memcached does not allow
+    spaces in keys and spreadsheet names can have them."""
+    key = u':'.join([unicode(part) for part in parts]).encode('utf-8')
+    return 'googledoc:%s' % (hashlib.md5(key).hexdigest(),)
 
 
 def try_remove_non_ascii(s):
@@ -54,6 +70,75 @@ def try_clean_dict(d):
         d[k] = try_remove_non_ascii(v)
 
 
+#the bytes `try_remove_non_ascii` drops from a str
+NON_ASCII_BYTES = ''.join(chr(i) for i in range(128, 256))
+
+
+def remove_non_ascii(s):
+    """What `try_remove_non_ascii` does without rebuilding the string
+    character by character."""
+    if isinstance(s, unicode):
+        return s.encode('ascii', 'ignore').decode('ascii')
+    elif isinstance(s, str):
+        return s.translate(None, NON_ASCII_BYTES)
+    return try_remove_non_ascii(s)
+
+
+class RowDecoder(object):
+    """Turns the rows of a worksheet's list feed into the rows
+    `SimpleCRUD.database_record` makes of them, with a converter per
+    column looked up once for the worksheet's columns. Dates are parsed
+    once per worksheet."""
+
+    #left out of the row, like a date that can't be parsed
+    SKIP = object()
+
+    def __init__(self, columns, parse_date):
+        self.parse_date = parse_date
+        self.dates = {}
+        self.converters = [(column, getattr(self, 'convert_%s' % column))
+                           for column in columns
+                           if hasattr(self, 'convert_%s' % column)]
+
+    def __call__(self, row):
+        logging.debug('Importing %s', row)
+        record = {}
+        for column, convert in self.converters:
+            if column in row:
+                value = convert(remove_non_ascii(row[column]), row)
+                if value is not self.SKIP:
+                    record[column] = value
+        return record
+
+    def convert_fileno(self, value, row):
+        return str(value)
+
+    def convert_phonenumber(self, value, row):
+        try:
+            return int(value)
+        except (ValueError, TypeError):
+            return TypeError
+
+    def convert_appointmentdate1(self, value, row):
+        if not value:
+            logging.error('No date given in %s' % row)
+            return self.SKIP
+        try:
+            return self.dates[value]
+        except KeyError:
+            pass
+        try:
+            app_date = self.parse_date(value)
+        except (ValueError, TypeError):
+            logging.exception('Error parsing date in %s' % row)
+            return self.SKIP
+        self.dates[value] = app_date
+        return app_date
+
+    def convert_appointmentstatus1(self, value, row):
+        return value
+
+
 class SimpleCRUD:
     def __init__(self, email, password):
         """
@@ -62,23 +147,34 @@ class SimpleCRUD:
         password: google email account password.
 
         Authenticates the user and sets the
-        Gdata Auth token.
+        Gdata Auth token. The token of an account
+        is kept for the life of the process, a
+        SimpleCRUD made for an account that has
+        logged in before reuses it.
         """
         self.gd_client = gdata.spreadsheet.service.SpreadsheetsService()
         self.gd_client.email = email
         self.gd_client.password = password
         self.gd_client.source = 'Import Google SpreadSheet to Database'
-        try:
-            self.gd_client.ProgrammaticLogin()
-        except (BadAuthentication, CaptchaRequired):
-            logging.exception("Invalid loggin values or captcha error.")
-            raise
+        with login_lock:
+            token = login_tokens.get((email, password))
+            if token:
+                self.gd_client.SetClientLoginToken(token)
+            else:
+                try:
+                    self.gd_client.ProgrammaticLogin()
+                except (BadAuthentication, CaptchaRequired):
+                    logging.exception("Invalid loggin values or captcha error.")
+                    raise
+                login_tokens[(email, password)] = \
+                    self.gd_client.GetClientLoginToken()
         self.curr_key = ''
         self.wksht_id = ''
+        self.wksht_updated = ''
         self.list_feed = None
-        self.spreadsheet_cache = {}
-        self.worksheet_cache = defaultdict(dict)
-        self.listfeed_cache = {}
+        #worksheets of each spreadsheet, fetched once per SimpleCRUD
+        self.worksheet_cache = {}
+        self.cache_timeout = settings.GOOGLEDOC_CACHE_TIMEOUT
 
     def get_spreadsheet(self, doc_name):
         """
@@ -88,10 +184,14 @@ class SimpleCRUD:
         Use Auth token to get the spreadsheet
         specified by doc_name. Gets a key which
         is used as a unique idenfier for the spreadsheet.
+        The key is kept in the Django cache for
+        GOOGLEDOC_CACHE_TIMEOUT seconds.
         """
         logging.info("Getting %s" % (doc_name,))
+        self.doc_name = doc_name
 
-        cached_value = self.spreadsheet_cache.get(doc_name)
+        key = self.spreadsheet_cache_key(doc_name)
+        cached_value = cache.get(key)
         if cached_value:
             self.curr_key = cached_value
             return True
@@ -103,15 +203,16 @@ class SimpleCRUD:
         try:
             self.curr_key = feed.entry[0].id.text.rsplit('/', 1)[1]
             found = True
-            # self.spreadsheet_cache[doc_name] = '%s' % (self.curr_key,)
+            cache.set(key, self.curr_key, self.cache_timeout)
             return found
         except IndexError:
             logging.exception("Spreadsheet name is invalid")
             found = False
-            # if doc_name in self.spreadsheet_cache:
-            #     del self.spreadsheet_cache[doc_name]
             return found
 
+    def spreadsheet_cache_key(self, doc_name):
+        return cache_key('spreadsheet', self.gd_client.email, doc_name)
+
     def get_worksheet_data(self, worksheet_type, start, until):
         """
         @rguments:
@@ -136,7 +237,7 @@ class SimpleCRUD:
         #check if the requested worksheet is the enrollment sheet
         elif worksheet_type == 'enrollment worksheet':
             #get worksheet name used for patient enrollment in spreadsheet
-            self.get_worksheet('enrollment sheet')
+            return self.get_worksheet('enrollment sheet')
 
     def get_worksheet_name(self, start, until):
         """
@@ -192,39 +293,50 @@ class SimpleCRUD:
         start: indicates the date to start import data from.
         until: indicates the date import data function must stop at.
 
-        Send a query using worksheet_name to get a worksheet feed.
-        Get wksht_id which is the permanent unique ID for the
-        worksheet within the spreadsheet. If the worksheet
+        Look up worksheet_name in the worksheets feed of the
+        spreadsheet to get wksht_id which is the permanent unique
+        ID for the worksheet within the spreadsheet. If the worksheet
         contains appointment data call method to access this data.
 
         @returns:
         app_worksheet: Stores the worksheet contents.
         """
-
-        cache_dict = self.worksheet_cache.get(self.curr_key, {})
-        cached_value = cache_dict.get(worksheet_name)
-        if cached_value:
-            wksht_id, app_worksheet = cached_value
-            self.wksht_id = wksht_id
-            return app_worksheet
-
-        q = gdata.spreadsheet.service.DocumentQuery()
-        q['title'] = worksheet_name
-        q['title-exact'] = 'true'
-        feed = self.gd_client.GetWorksheetsFeed(self.curr_key, query=q)
         try:
-            self.wksht_id = feed.entry[0].id.text.rsplit('/', 1)[1]
-            #if worksheet is not enrollement sheet get data
-            if worksheet_name != 'enrollment sheet':
-                app_worksheet = self.prompt_for_list_action()
-                cache_dict[worksheet_name] = ('%s' % (self.wksht_id,),
-                    app_worksheet)
-                # self.worksheet_cache[self.curr_key] = cache_dict
-                return app_worksheet
-
-        except IndexError:
+            self.wksht_id, self.wksht_updated = \
+                self.get_worksheets()[worksheet_name]
+        except KeyError:
             worksheet_found = False
             return worksheet_found
+        #if worksheet is not enrollement sheet get data
+        if worksheet_name != 'enrollment sheet':
+            app_worksheet = self.prompt_for_list_action()
+            return app_worksheet
+
+    def get_worksheets(self):
+        """
+        Gets the worksheets of the current spreadsheet in one
+        request instead of querying for every worksheet by name.
+        The `updated` timestamps decide whether a cached list feed
+        of a worksheet is still current, so these are fetched once
+        for every SimpleCRUD and not kept between runs.
+
+        @returns:
+        worksheets: (wksht_id, updated) for every worksheet name.
+        """
+        if self.curr_key not in self.worksheet_cache:
+            try:
+                feed = self.gd_client.GetWorksheetsFeed(self.curr_key)
+            except gdata.service.RequestError:
+                #the cached spreadsheet key could be stale, look it up again
+                logging.exception("Unable to get the worksheets of %s" % (
+                    self.doc_name,))
+                cache.delete(self.spreadsheet_cache_key(self.doc_name))
+                raise
+            self.worksheet_cache[self.curr_key] = dict(
+                (entry.title.text, (entry.id.text.rsplit('/', 1)[1],
+                                    entry.updated.text))
+                for entry in feed.entry)
+        return self.worksheet_cache[self.curr_key]
 
     def appointment_rows(self, worksheet, start, until):
         """
@@ -234,9 +346,8 @@ class SimpleCRUD:
         until: indicates the date import data function must stop at.
 
         Looks at data from the provideed worksheet that falls
-        within the start and until date. Creates a loop of dates from
-        start to until, for each day search the worksheet to see if
-        the is a patient record with the same date if true get it.
+        within the start and until date. Makes a single pass over the
+        rows and keeps every patient record with a date in that range.
 
         @returns:
         patients_worksheet: store the patient rows that are
@@ -244,35 +355,22 @@ class SimpleCRUD:
         """
         #stores the rows in the worksheet that are with the period date
         patients_worksheet = {}
-        #Used to indicate the days to get patient data from
-        period = until - start
-        #get patient info for each day in period
-        for day in range(period.days + 1):
-            #the day to check from the worksheet
-            curr_date = start + datetime.timedelta(days=day)
-            #access the rows inside the worksheet
-            for row in worksheet:
-                try:
-                    #check if the worksheet has a patient with this date
-                    if worksheet[row]:
-                        if worksheet[row]['appointmentdate1'] == curr_date:
-                            #test if the current date is in month range
-                            date_range = worksheet[row]['appointmentdate1']
-                            if type(date_range) == datetime.date:
-                                #row for final worksheet
-                                patient_row = {row: worksheet[row]}
-                                #update the new worksheet
-                                patients_worksheet.update(patient_row)
-                                #clear temp locations
-                                patient_row = {}
-                    else:
-                        logging.error('Empty row %s at %s' % (
-                                                         worksheet[row], row)
-                        )
-                except KeyError, e:
-                    logging.error('Error reading row %s at %s in %s' % (
-                                               worksheet[row], row, period))
-                    logging.error(e)
+        #access the rows inside the worksheet
+        for row, patient_row in worksheet.iteritems():
+            try:
+                #check if the worksheet has a patient row
+                if patient_row:
+                    app_date = patient_row['appointmentdate1']
+                    #only real dates, datetimes never matched a day before
+                    if type(app_date) == datetime.date and \
+                            start <= app_date <= until:
+                        patients_worksheet[row] = patient_row
+                else:
+                    logging.error('Empty row %s at %s' % (patient_row, row))
+            except KeyError, e:
+                logging.error('Error reading row %s at %s in %s' % (
+                                       patient_row, row, until - start))
+                logging.error(e)
         return patients_worksheet
 
     def prompt_for_list_action(self):
@@ -282,76 +380,62 @@ class SimpleCRUD:
 
     def list_get_action(self):
         """Gets the list feed for the worksheet and sends it to be processed"""
-        cache_key = ':'.join([self.curr_key, self.wksht_id])
-        cache_value = self.listfeed_cache.get(cache_key)
-        if cache_value:
-            return cache_value
-
-        list_feed = self.gd_client.GetListFeed(self.curr_key, self.wksht_id)
-        #get the enrollment worksheet
-        sheet = self.process_file(feed=list_feed)
-
-        # self.listfeed_cache[cache_key] = sheet
-
+        sheet = self.process_file(rows=self.get_list_rows())
         return sheet
 
-    def process_file(self, feed):
+    def get_list_rows(self):
+        """
+        Gets the rows of the current worksheet's list feed as
+        dictionaries of column name to cell text. These are kept
+        in the Django cache for GOOGLEDOC_CACHE_TIMEOUT seconds
+        under the worksheet's `updated` timestamp, a worksheet that
+        changed is fetched again.
+
+        @returns:
+        rows: the rows of the worksheet.
+        """
+        key = cache_key('listfeed', self.curr_key, self.wksht_id,
+                        self.wksht_updated)
+        rows = cache.get(key)
+        if rows is None:
+            list_feed = self.gd_client.GetListFeed(self.curr_key,
+                                                   self.wksht_id)
+            rows = [dict((column, entry.custom[column].text)
+                         for column in entry.custom)
+                    for entry in list_feed.entry]
+            cache.set(key, rows, self.cache_timeout)
+        return rows
+
+    def process_file(self, rows):
         """
         @rguments:
-        feed: the feed that contains the row(s) from a worksheet.
+        rows: the row(s) from a worksheet's list feed.
 
-        Checks if the incoming feed is a list feed.
-        if True access the contents of a row and
+        Access the contents of a row and
         construct a dictionary to store it in.
         Use the row number of the row in the
-        worksheet as the key. Send the row to a
-        method that ensures the contents of the
-        row a proper for database storage.
+        worksheet as the key. The rows are made
+        proper for database storage by a RowDecoder
+        for the worksheet's columns, the same way
+        database_record does it.
         Use rows to construct a dictionary
         to store the entire worksheet.
 
         @returns:
         proper_worksheet: contains entire worksheet in a proper format.
         """
-        #process enrollment worksheet
-        if isinstance(feed, gdata.spreadsheet.SpreadsheetsListFeed):
-            worksheet_data = {}
-            proper_worksheet = {}
-            temp_dic = {}
-            rowdic = {}
-            copydic = {}
-            #loop through all the rows in the datak
-            for i, entry in enumerate(feed.entry):
-                row_no = i
-                for key in entry.custom:
-                    #dictionary to store a single column from row
-                    temp_dic = {key: entry.custom[key].text}
-                    #dictionary to store a single row
-                    rowdic.update(temp_dic)
-                    #clear column dictionary for next usage
-                    temp_dic = {}
-                #store row as value an row number as the key
-                copydic = {row_no: rowdic}
-                #stores the entire worksheet
-                worksheet_data.update(copydic)
-                #clear for next worksheet row
-                copydic = {}
-                rowdic = {}
-            #for each row get proper type for each one of its contents
-            for k in worksheet_data:
-                #make row number coresponds to worksheet row number
-                row_no = k + 2
-                #get proper values for each key in row dictionary
-                enrol_p = self.database_record(dic=worksheet_data[k])
-                #store row as value an row number as the key
-                enroltemp = {row_no: enrol_p}
-                #clear for next row excess
-                enrol_p = {}
-                #dictionary that stores a row number as a key to the row data
-                proper_worksheet.update(enroltemp)
-                enroltemp = {}
-                row_no = 0
+        proper_worksheet = {}
+        if not rows:
             return proper_worksheet
+        columns = set()
+        for row in rows:
+            columns.update(row)
+        decode = RowDecoder(columns, self.date_object_creator)
+        #for each row get proper type for each one of its contents
+        for i, row in enumerate(rows):
+            #make row number coresponds to worksheet row number
+            proper_worksheet[i + 2] = decode(row)
+        return proper_worksheet
 
     def date_object_creator(self, datestring):
         """
@@ -470,15 +554,15 @@ class SimpleCRUD:
         #get the spread sheet to be worked on
         self.get_spreadsheet(doc_name)
         #get the enrolment worksheet on the spreadsheet
-        self.get_worksheet_data('enrollment worksheet', None, None)
-        rows = self.gd_client.GetListFeed(self.curr_key, self.wksht_id).entry
+        found = self.get_worksheet_data('enrollment worksheet', None, None)
+        if found is False:
+            logging.error("No enrollment sheet in %s" % (doc_name,))
+            return {}
+        rows = self.get_list_rows()
         # build up a list of Patient IDs keyed by each possible
         # variant of the Patient File No
         enrollment_map = {}
-        for row in rows:
-            row_dict = {}
-            for key in row.custom:
-                row_dict[key] = row.custom[key].text
+        for row_dict in rows:
             #print row_dict
             file_no = row_dict.get('patientfileno')
             patient_id = row_dict.get('patientid')
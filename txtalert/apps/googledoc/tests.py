@@ -0,0 +1,403 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from txtalert.apps.googledoc.models import GoogleAccount
+from txtalert.apps.googledoc.importer import Importer
+from txtalert.apps.googledoc.reader import spreadsheetReader
+from txtalert.apps.googledoc.reader.spreadsheetReader import SimpleCRUD
+from txtalert.core.models import Patient, MSISDN, Visit, Clinic
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.db import transaction
+from datetime import datetime, timedelta, date
+from mock import patch, Mock
+from StringIO import StringIO
+from unittest import skipUnless
+import os
+import sys
+import time
+
+# the timing comparisons only hold on an idle machine
+BENCHMARKS = bool(os.environ.get('TXTALERT_BENCHMARKS'))
+
+
+def benchmark_worksheet(rows=10000, start=date(2011, 8, 1), days=50):
+    """A worksheet as returned by `SimpleCRUD.process_file` with
+    appointments spread over `days` days from `start`."""
+    statuses = ['Scheduled', 'Missed', 'Attended', 'Rescheduled']
+    worksheet = {}
+    for row_no in range(2, rows + 2):
+        worksheet[row_no] = {
+            'appointmentdate1': start + timedelta(days=row_no % days),
+            'fileno': str(1000000 + row_no),
+            'appointmentstatus1': statuses[row_no % len(statuses)],
+            'phonenumber': 820000000 + row_no,
+        }
+    return worksheet
+
+
+def benchmark_list_rows(rows=10000, start=date(2011, 8, 1), days=50):
+    """The list feed rows of the `benchmark_worksheet`, as read from a
+    worksheet"""
+    return [dict((column, unicode(value)) for column, value in [
+                ('fileno', row['fileno']),
+                ('appointmentdate1', row['appointmentdate1'].strftime(
+                    '%d/%m/%Y')),
+                ('appointmentstatus1', row['appointmentstatus1']),
+                ('phonenumber', '0%s' % (row['phonenumber'],)),
+                ('comments', u'n\xe4chste Woche'),
+            ])
+            for _, row in sorted(benchmark_worksheet(rows, start,
+                                                     days).items())]
+
+
+class AppointmentRowsBenchmarkTestCase(TestCase):
+    """Filtering a large worksheet on the appointment dates"""
+
+    def setUp(self):
+        with patch('gdata.spreadsheet.service.SpreadsheetsService'
+                    '.ProgrammaticLogin'):
+            self.reader = SimpleCRUD('txtalert@byteorbit.com', 'testtest')
+        self.worksheet = benchmark_worksheet()
+        self.start = date(2011, 8, 10)
+        self.until = date(2011, 8, 24)
+
+    def per_day_rows(self, worksheet, start, until):
+        """the day by day scan `appointment_rows` used to do"""
+        rows = {}
+        for day in range((until - start).days + 1):
+            curr_date = start + timedelta(days=day)
+            for row in worksheet:
+                if worksheet[row]['appointmentdate1'] == curr_date:
+                    rows[row] = worksheet[row]
+        return rows
+
+    def test_appointment_rows_single_pass(self):
+        rows = self.reader.appointment_rows(self.worksheet, self.start,
+                                            self.until)
+        expected = self.per_day_rows(self.worksheet, self.start, self.until)
+        self.assertEqual(rows, expected)
+        # 15 of the 50 days
+        self.assertEqual(len(rows), 3000)
+
+    @skipUnless(BENCHMARKS, 'set TXTALERT_BENCHMARKS=1 to run benchmarks')
+    def test_appointment_rows_benchmark(self):
+        started = time.time()
+        self.reader.appointment_rows(self.worksheet, self.start, self.until)
+        single_pass = time.time() - started
+
+        started = time.time()
+        self.per_day_rows(self.worksheet, self.start, self.until)
+        per_day = time.time() - started
+
+        self.assertTrue(single_pass < per_day)
+
+    def test_appointment_rows_skips_bad_rows(self):
+        worksheet = {
+            2: {'appointmentdate1': self.start},
+            3: {'appointmentdate1': datetime(2011, 8, 12, 10, 0)},
+            4: {'fileno': '1234567'},
+            5: {},
+            6: {'appointmentdate1': self.until + timedelta(days=1)},
+            7: {'appointmentdate1': self.until},
+        }
+        rows = self.reader.appointment_rows(worksheet, self.start, self.until)
+        self.assertEqual(sorted(rows), [2, 7])
+
+
+def feed_entry(title, id, updated='2011-08-01T10:00:00.000Z', **custom):
+    return Mock(title=Mock(text=title), id=Mock(text='https://feeds/%s' % id),
+                updated=Mock(text=updated),
+                custom=dict((key, Mock(text=value))
+                            for key, value in custom.items()))
+
+
+class SpreadSheetCacheTestCase(TestCase):
+    """Spreadsheet metadata and rows kept between SimpleCRUDs"""
+
+    def setUp(self):
+        self.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+        self.cache.clear()
+        self.cache_patch = patch.object(spreadsheetReader, 'cache',
+                                        self.cache)
+        self.cache_patch.start()
+        self.updated = '2011-08-01T10:00:00.000Z'
+
+    def tearDown(self):
+        self.cache_patch.stop()
+
+    def reader(self):
+        with patch('gdata.spreadsheet.service.SpreadsheetsService'
+                    '.ProgrammaticLogin'):
+            reader = SimpleCRUD('txtalert@byteorbit.com', 'testtest')
+        client = reader.gd_client
+        client.GetSpreadsheetsFeed = Mock(return_value=Mock(
+            entry=[feed_entry('Praekelt', 'key1')]))
+        client.GetWorksheetsFeed = Mock(side_effect=lambda key: Mock(entry=[
+            feed_entry('enrollment sheet', 'od6', self.updated),
+            feed_entry('August 2011', 'od7', self.updated),
+        ]))
+        client.GetListFeed = Mock(side_effect=lambda key, wksht_id: Mock(
+            entry={
+                'od6': [feed_entry('', '', patientfileno='63601',
+                                   patientid='1')],
+                'od7': [feed_entry('', '', fileno='63601',
+                                   appointmentdate1='02/08/2011',
+                                   appointmentstatus1='Scheduled',
+                                   phonenumber='969577542')],
+            }[wksht_id]))
+        return reader
+
+    def run_import(self, reader):
+        enrollment_map = reader.get_enrollment_map('Praekelt')
+        month = reader.run_appointment('Praekelt', date(2011, 8, 1),
+                                       date(2011, 8, 14))
+        return enrollment_map, month
+
+    def test_repeat_runs(self):
+        first = self.reader()
+        enrollment_map, month = self.run_import(first)
+        self.assertEqual(enrollment_map, {'63601': '1'})
+        self.assertEqual(month['August 2011'][2]['appointmentdate1'],
+                         date(2011, 8, 2))
+        self.assertEqual(first.gd_client.GetSpreadsheetsFeed.call_count, 1)
+        self.assertEqual(first.gd_client.GetWorksheetsFeed.call_count, 1)
+        self.assertEqual(first.gd_client.GetListFeed.call_count, 2)
+
+        # the next run only checks the worksheet timestamps
+        second = self.reader()
+        self.assertEqual(self.run_import(second), (enrollment_map, month))
+        self.assertEqual(second.gd_client.GetSpreadsheetsFeed.call_count, 0)
+        self.assertEqual(second.gd_client.GetWorksheetsFeed.call_count, 1)
+        self.assertEqual(second.gd_client.GetListFeed.call_count, 0)
+
+    def test_updated_worksheets_are_fetched(self):
+        self.run_import(self.reader())
+        self.updated = '2011-08-02T10:00:00.000Z'
+        reader = self.reader()
+        self.run_import(reader)
+        self.assertEqual(reader.gd_client.GetSpreadsheetsFeed.call_count, 0)
+        self.assertEqual(reader.gd_client.GetListFeed.call_count, 2)
+
+
+class WorksheetBatchTestCase(TestCase):
+    """Reconciling a worksheet in batch mode"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='googledoc')
+        clinic = Clinic.objects.create(te_id='01', name='Praekelt',
+                                       user=self.user)
+        for te_id, msisdn, visit_id, visit_date in [
+                ('1111111', '27123456789', '01-1111111', date(2011, 8, 1)),
+                ('9999999', '27987654321', '02-9999999', date(2011, 8, 10))]:
+            msisdn = MSISDN.objects.create(msisdn=msisdn)
+            patient = Patient.objects.create(te_id=te_id, owner=self.user,
+                                             active_msisdn=msisdn)
+            patient.msisdns.add(msisdn)
+            patient.visit_set.create(te_visit_id=visit_id, date=visit_date,
+                                     status='s', clinic=clinic)
+        Patient.objects.create(te_id='7777777', owner=self.user,
+                               deleted=True)
+        self.doc_name = 'Praekelt'
+        self.worksheet = {
+            # a missed visit and a rescheduled one with a new number
+            1: self.row('1111111', date(2011, 8, 1), 'Missed', 123456789),
+            2: self.row('9999999', date(2011, 8, 12), 'Rescheduled',
+                        '0821234567'),
+            # a new patient with two visits
+            3: self.row('5555555', date(2011, 8, 3), 'Attended', 821111111),
+            4: self.row('5555555', date(2011, 8, 20), 'Scheduled',
+                        822222222),
+            # not enrolled and a wrong number
+            5: self.row('4444444', date(2011, 8, 4), 'Scheduled', 823333333),
+            6: self.row('3333333', date(2011, 8, 4), 'Scheduled', '123'),
+            # a new visit
+            12: self.row('1111111', date(2011, 8, 22), 'Scheduled',
+                         123456789),
+        }
+
+    def row(self, file_no, app_date, status, phone):
+        return {
+            'fileno': file_no,
+            'appointmentdate1': app_date,
+            'appointmentstatus1': status,
+            'phonenumber': phone,
+        }
+
+    def importer(self, batch):
+        with patch('gdata.spreadsheet.service.SpreadsheetsService'
+                    '.ProgrammaticLogin'):
+            importer = Importer(self.user, 'txtalert@byteorbit.com',
+                                'testtest', batch=batch)
+        importer.enrollment_cache_dict[self.doc_name] = dict(
+            (file_no, file_no) for file_no in
+            ['1111111', '9999999', '5555555', '3333333', '7777777'])
+        return importer
+
+    def state(self):
+        patients = set(
+            (patient.te_id, patient.active_msisdn_id and
+                patient.active_msisdn.msisdn,
+             tuple(sorted(patient.msisdns.values_list('msisdn', flat=True))),
+             patient.missed_visits, patient.attended_visits,
+             patient.risk_profile, patient.last_clinic_id)
+            for patient in Patient.all_objects.all())
+        visits = set(Visit.all_objects.values_list(
+            'te_visit_id', 'patient__te_id', 'clinic', 'date', 'status'))
+        msisdns = set(MSISDN.objects.values_list('msisdn',
+                                                 'national_number'))
+        history = sorted(Visit.history.values_list('te_visit_id', 'status',
+                                                   'history_type'))
+        return patients, visits, msisdns, history
+
+    def test_same_as_row_by_row(self):
+        class Rollback(Exception):
+            pass
+
+        try:
+            with transaction.atomic():
+                result = self.importer(False).update_patients(
+                    self.worksheet, self.doc_name, None, None)
+                expected = self.state()
+                raise Rollback()
+        except Rollback:
+            pass
+        self.assertEqual(result, (6, 5))
+
+        batch_result = self.importer(True).update_patients(
+            self.worksheet, self.doc_name, None, None)
+        self.assertEqual(batch_result, result)
+        self.assertEqual(self.state(), expected)
+
+    def test_integrity_errors(self):
+        """The rows that run into an IntegrityError row by row"""
+        worksheet = {
+            # a deleted patient and a status that isn't recognised
+            7: self.row('7777777', date(2011, 8, 4), 'Scheduled', 824444444),
+            13: self.row('1111111', date(2011, 8, 23), 'attended',
+                         123456789),
+        }
+        result = self.importer(True).update_patients(
+            worksheet, self.doc_name, None, None)
+        self.assertEqual(result, (2, 1))
+        # the number is created before the patient fails to save
+        self.assertTrue(MSISDN.objects.filter(msisdn='27824444444').exists())
+        self.assertFalse(Visit.all_objects.filter(
+            te_visit_id__in=['07-7777777', '13-1111111']).exists())
+
+
+class RowDecoderTestCase(TestCase):
+    """Making the list feed rows proper for database storage"""
+
+    def setUp(self):
+        with patch('gdata.spreadsheet.service.SpreadsheetsService'
+                    '.ProgrammaticLogin'):
+            self.reader = SimpleCRUD('txtalert@byteorbit.com', 'testtest')
+
+    def database_records(self, rows):
+        return dict((i + 2, self.reader.database_record(dict(row)))
+                    for i, row in enumerate(rows))
+
+    def test_same_as_database_record(self):
+        rows = [
+            {'fileno': u'63601', 'appointmentdate1': u'02/09/2011',
+             'appointmentstatus1': u'Scheduled',
+             'phonenumber': u'0969577542'},
+            {'fileno': u'636\xe902', 'appointmentdate1': u'2/9/2011 ',
+             'appointmentstatus1': u'Missed\xa0', 'phonenumber': u'abc'},
+            {'fileno': '63603', 'appointmentdate1': '31/02/2011',
+             'appointmentstatus1': 'Attended', 'phonenumber': None},
+            {'fileno': None, 'appointmentdate1': None,
+             'appointmentstatus1': None, 'phonenumber': '969577542\xc2'},
+            {'fileno': u'63605', 'appointmentstatus1': u'Attended'},
+            {},
+        ]
+        self.assertEqual(self.reader.process_file(rows),
+                         self.database_records(rows))
+
+    def test_benchmark_rows(self):
+        rows = benchmark_list_rows()
+        worksheet = self.reader.process_file(rows)
+        self.assertEqual(worksheet, self.database_records(rows))
+        self.assertEqual(worksheet[2], {
+            'fileno': '1000002',
+            'appointmentdate1': date(2011, 8, 3),
+            'appointmentstatus1': u'Attended',
+            'phonenumber': 820000002,
+        })
+
+    @skipUnless(BENCHMARKS, 'set TXTALERT_BENCHMARKS=1 to run benchmarks')
+    def test_benchmark(self):
+        rows = benchmark_list_rows()
+        started = time.time()
+        self.reader.process_file(rows)
+        decoded = time.time() - started
+
+        started = time.time()
+        self.database_records(rows)
+        per_record = time.time() - started
+
+        self.assertTrue(decoded < per_record)
+
+
+class ConcurrentImportTestCase(TestCase):
+    """Importing the spreadsheets of all the accounts at once"""
+
+    def setUp(self):
+        spreadsheetReader.login_tokens.clear()
+        self.file_nos = {}
+        for username, doc_names in [('one', ['Sheet A', 'Sheet B']),
+                                    ('two', ['Sheet C', 'Broken'])]:
+            user = User.objects.create(username=username)
+            account = GoogleAccount.objects.create(
+                user=user, username='%s@example.org' % (username,),
+                password='secret')
+            for doc_name in doc_names:
+                account.spreadsheet_set.create(spreadsheet=doc_name)
+                Clinic.objects.create(te_id=doc_name[-2:], name=doc_name,
+                                      user=user)
+                self.file_nos[doc_name] = str(1000000 + len(self.file_nos))
+
+    def tearDown(self):
+        spreadsheetReader.login_tokens.clear()
+
+    def enrollment_map(self, doc_name):
+        return {self.file_nos[doc_name]: '1'}
+
+    def run_appointment(self, doc_name, start, until):
+        if doc_name == 'Broken':
+            raise IOError('Unable to read %s' % (doc_name,))
+        return {'%s %s' % (start.strftime('%B'), start.year): {
+            2: {
+                'fileno': self.file_nos[doc_name],
+                'appointmentdate1': start,
+                'appointmentstatus1': 'Scheduled',
+                'phonenumber': 821234567,
+            },
+        }}
+
+    def test_concurrent_import(self):
+        stdout = StringIO()
+        login = Mock()
+        with patch('gdata.spreadsheet.service.SpreadsheetsService'
+                   '.ProgrammaticLogin', login), \
+                patch('gdata.spreadsheet.service.SpreadsheetsService'
+                      '.GetClientLoginToken', lambda client: client.email), \
+                patch.object(SimpleCRUD, 'get_enrollment_map',
+                             lambda reader, *args: self.enrollment_map(
+                                 *args)), \
+                patch.object(SimpleCRUD, 'run_appointment',
+                             lambda reader, *args: self.run_appointment(
+                                 *args)), \
+                patch.object(sys, 'stdout', stdout):
+            call_command('gd_import_data', workers=3, batch=True)
+
+        # every account logged in once, the readers in the threads reused
+        # their tokens
+        self.assertEqual(login.call_count, 2)
+        for doc_name in ['Sheet A', 'Sheet B', 'Sheet C']:
+            patient = Patient.objects.get(te_id=self.file_nos[doc_name])
+            self.assertEqual(patient.visit_set.get().clinic.name, doc_name)
+            self.assertTrue('%s: fetched in' % (doc_name,)
+                            in stdout.getvalue())
+        self.assertFalse('Broken:' in stdout.getvalue())
@@ -1,10 +1,18 @@
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from txtalert.apps.therapyedge.models import RecordFingerprint
 from txtalert.apps.therapyedge.xmlrpc.client import Client
 from txtalert.core.models import Patient, MSISDN, Visit, Clinic
+from txtalert.core.signals import queue_risk_profiles, keep_deferred_counters
+from txtalert.core.utils import national_number
 
+import hashlib
 import iso8601
 import re
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, date
 
 logger = logging.getLogger("importer")
@@ -22,6 +30,13 @@ MSISDN_RE = re.compile(r'[+]?(0|27)([0-9]{9})')
 IMPORT_CUTOFF = datetime(2009, 01, 01)
 IMPORT_DAY_INTERVAL = 10
 
+# the number of values per `__in` lookup when prefetching in batched mode
+PREFETCH_CHUNK_SIZE = 500
+
+# the remote feeds in the order they're written, patients before visits
+FEEDS = ['updated_patients', 'coming_visits', 'missed_visits', 'done_visits',
+         'deleted_visits']
+
 MESSAGE_PATIENTID_INCONSISTENT = "Patient ID '%s' is inconsistent with previous ID '%s' for visit '%s'."
 MESSAGE_PATIENT_NOTFOUND = "Patient with the ID '%s' could not be found for visit '%s'."
 MESSAGE_VISIT_NOTFOUND = "Visit with the ID '%s' could not be found."
@@ -81,6 +96,11 @@ class VisitException(Exception):
     pass
 
 
+class ChunkFailed(Exception):
+    """An IntegrityError aborted the transaction a chunk is written in"""
+    pass
+
+
 class Update(object):
     def __init__(self, klass):
         self.klass = klass
@@ -92,6 +112,11 @@ class Update(object):
             self.instance, self.created, self.updated = self.klass(*args, **kwargs), True, True
         return self
 
+    def found(self, instance, created):
+        """Use an instance that was looked up already"""
+        self.instance, self.created, self.updated = instance, created, created
+        return self
+
     def update_attributes(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self.instance, key, value)
@@ -106,10 +131,185 @@ class Update(object):
         return self.instance, self.created, self.updated
 
 
+def fingerprint(record):
+    """A hash of all the fields of a remote record"""
+    return hashlib.sha1(repr(sorted(record._asdict().items()))).hexdigest()
+
+
+def record_key(feed, record):
+    if feed == 'updated_patients':
+        return record.te_id
+    return record.key_id
+
+
+def chunked(iterable, size):
+    """Iterate over the iterable in lists of `size` items"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def in_chunks(queryset, field, values):
+    """Filter the queryset on `field__in` per chunk of values"""
+    values = list(values)
+    for offset in range(0, len(values), PREFETCH_CHUNK_SIZE):
+        for result in queryset.filter(**{
+                '%s__in' % field: values[offset:offset + PREFETCH_CHUNK_SIZE]}):
+            yield result
+
+
 class Importer(object):
 
-    def __init__(self, uri=None, verbose=False):
-        self.client = Client(uri, verbose)
+    def __init__(self, uri=None, verbose=False, batched=False,
+                    streaming=False, skip_unchanged=False, chunk_size=None):
+        self.uri = uri
+        self.verbose = verbose
+        self.streaming = streaming
+        self.client = Client(uri, verbose, streaming)
+        # the clients of the threads fetching concurrently
+        self.local = threading.local()
+        # In batched mode the patients & visits the remote records refer to
+        # are loaded for a whole result set at once and looked up in these
+        self.batched = batched
+        self.patients = None
+        self.patients_by_pk = None
+        self.visits = None
+        # With skip_unchanged the records that are the same as when they
+        # were last imported are skipped, the fingerprints of the records
+        # that are imported are kept here until they've been written
+        self.skip_unchanged = skip_unchanged
+        self.fingerprints = None
+        self.skipped = {}
+        # With a chunk_size the feeds are written in a transaction per
+        # chunk of records instead of in autocommit mode, see `write_chunk`
+        self.chunk_size = chunk_size
+        self.savepoints = None
+
+    def prefetch(self, owner, remote_records, **visit_filters):
+        """Read the remote records and load the patients & visits they
+        refer to with a query (per chunk) each. The visits are read as rows
+        and only turned into Visits when looked up."""
+        remote_records = list(remote_records)
+        te_ids = set(record.te_id for record in remote_records
+                        if getattr(record, 'te_id', None))
+        key_ids = set(record.key_id for record in remote_records
+                        if getattr(record, 'key_id', None))
+        self.patients = dict((patient.te_id, patient) for patient in
+            in_chunks(Patient.objects.filter(owner=owner), 'te_id', te_ids))
+        self.patients_by_pk = dict((patient.pk, patient)
+                                    for patient in self.patients.values())
+        fields = [field.name for field in Visit._meta.concrete_fields]
+        self.visits = {}
+        rows = in_chunks(Visit.objects.filter(**visit_filters)
+                            .values_list(*fields), 'te_visit_id', key_ids)
+        for row in rows:
+            row = dict(zip(fields, row))
+            self.visits[row['te_visit_id']] = row
+        return remote_records
+
+    def prefetched(self, owner, remote_records, **visit_filters):
+        """Iterate over the remote records, prefetched if batched"""
+        if not self.batched:
+            for record in remote_records:
+                yield record
+            return
+        try:
+            for record in self.prefetch(owner, remote_records,
+                                        **visit_filters):
+                yield record
+        finally:
+            self.patients = self.patients_by_pk = self.visits = None
+
+    def changed(self, feed, user, clinic, remote_records):
+        """Iterate over the remote records that changed since they were
+        last imported, counting the ones that didn't in `self.skipped`."""
+        known = dict(RecordFingerprint.objects.filter(
+            user=user, clinic=clinic, feed=feed).values_list('key',
+                                                            'fingerprint'))
+        self.fingerprints = {}
+        self.skipped[feed] = 0
+        for record in remote_records:
+            key, value = record_key(feed, record), fingerprint(record)
+            if known.get(key) == value:
+                self.skipped[feed] += 1
+                continue
+            self.fingerprints[record] = (key, value)
+            yield record
+
+    def forget(self, remote_record):
+        """Don't remember a record that failed to import as imported"""
+        if self.fingerprints is not None:
+            self.fingerprints.pop(remote_record, None)
+
+    def save_fingerprints(self, feed, user, clinic):
+        fingerprints, self.fingerprints = self.fingerprints.values(), None
+        for offset in range(0, len(fingerprints), PREFETCH_CHUNK_SIZE):
+            chunk = fingerprints[offset:offset + PREFETCH_CHUNK_SIZE]
+            RecordFingerprint.objects.filter(user=user, clinic=clinic,
+                feed=feed, key__in=[key for key, _ in chunk]).delete()
+            RecordFingerprint.objects.bulk_create([
+                RecordFingerprint(user=user, clinic=clinic, feed=feed,
+                                  key=key, fingerprint=value)
+                for key, value in chunk])
+
+    @contextmanager
+    def row(self):
+        """Write the changes for a single remote record. When writing a
+        chunk an IntegrityError fails the whole chunk, when writing it
+        again it only rolls back to the savepoint of the record."""
+        if self.savepoints is None:
+            yield
+        elif self.savepoints:
+            with transaction.atomic():
+                yield
+        else:
+            try:
+                yield
+            except IntegrityError, e:
+                raise ChunkFailed(e)
+
+    def get_patient(self, owner, te_id):
+        if self.patients is None:
+            return Patient.objects.get(te_id=te_id, owner=owner)
+        try:
+            return self.patients[te_id]
+        except KeyError:
+            raise Patient.DoesNotExist('Patient matching te_id %s does '
+                                        'not exist.' % te_id)
+
+    def get_visit(self, te_visit_id, **filters):
+        """Returns the visit with the given id and whether it was created
+        (unsaved) because it doesn't exist yet."""
+        if self.visits is None:
+            try:
+                return Visit.objects.get(te_visit_id=te_visit_id,
+                                            **filters), False
+            except Visit.DoesNotExist:
+                return Visit(te_visit_id=te_visit_id), True
+        visit = self.visits.get(te_visit_id)
+        if visit is None:
+            visit = self.visits[te_visit_id] = Visit(te_visit_id=te_visit_id)
+            return visit, True
+        if isinstance(visit, dict):
+            visit = self.visits[te_visit_id] = self.visit_from_row(visit)
+        return visit, visit.pk is None
+
+    def visit_from_row(self, row):
+        row = dict((Visit._meta.get_field(name).attname, value)
+                    for name, value in row.items())
+        # give it its patient if we have it, saves looking it up when the
+        # Visit is initialized
+        if row['patient_id'] in self.patients_by_pk:
+            row['patient'] = self.patients_by_pk[row.pop('patient_id')]
+        visit = Visit(**row)
+        visit._state.adding = False
+        visit._state.db = Visit.objects.db
+        return visit
 
     def import_all_patients(self, clinic):
         # all_patients = self.client.get_all_patients(clinic.te_id)
@@ -129,25 +329,54 @@ class Importer(object):
         return self.update_local_patients(user, updated_patients)
 
     def update_local_patients(self, user, remote_patients):
-        for remote_patient in remote_patients:
+        # in batched mode the MSISDNs are reconciled for all patients at once
+        msisdns = [] if self.batched else None
+        for remote_patient in self.prefetched(user, remote_patients):
             try:
-                yield self.update_local_patient(user, remote_patient)
+                with self.row():
+                    local_patient = self.update_local_patient(user, remote_patient, msisdns)
+                yield local_patient
             except IntegrityError, e:
                 logger.exception('Failed to create Patient for: %s' % (remote_patient,))
-
-    def update_local_patient(self, owner, remote_patient):
-        logger.info('Processing: %s' % remote_patient._asdict())
-        patient, created, updated = Update(Patient)\
-            .get(te_id=remote_patient.te_id, owner=owner)\
-            .update_attributes(
-                age=int(Age(remote_patient.age)),
-                sex=Sex(remote_patient.sex)
-            ).save()
-        if created:
-            logger.info('Patient created: %s' % patient)
-        elif updated:
-            logger.info('Update for existing patient: %s' % patient)
-
+                self.forget(remote_patient)
+        if msisdns:
+            self.update_local_msisdns(msisdns)
+
+    def update_local_msisdns(self, patients_msisdns):
+        """Make sure the patients have the given phone numbers with a few
+        bulk queries, `patients_msisdns` is a list of (patient, numbers)."""
+        phone_numbers = set()
+        for patient, numbers in patients_msisdns:
+            phone_numbers.update(numbers)
+        existing = dict(in_chunks(MSISDN.objects.order_by().values_list('msisdn', 'pk'),
+                                    'msisdn', phone_numbers))
+        missing = phone_numbers - set(existing)
+        if missing:
+            # bulk inserts don't fire the pre_save signal that sets this
+            MSISDN.objects.bulk_create([MSISDN(msisdn=phone_number,
+                    national_number=national_number(phone_number))
+                for phone_number in missing])
+            existing.update(in_chunks(
+                MSISDN.objects.order_by().values_list('msisdn', 'pk'), 'msisdn', missing))
+
+        Through = Patient.msisdns.through
+        patient_ids = set(patient.pk for patient, _ in patients_msisdns)
+        links = set(in_chunks(
+            Through.objects.values_list('patient', 'msisdn'), 'patient',
+            patient_ids))
+        new_links = set()
+        for patient, numbers in patients_msisdns:
+            for phone_number in numbers:
+                link = (patient.pk, existing[phone_number])
+                if link not in links:
+                    new_links.add(link)
+        if new_links:
+            Through.objects.bulk_create([
+                Through(patient_id=patient_id, msisdn_id=msisdn_id)
+                for patient_id, msisdn_id in new_links])
+        return new_links
+
+    def phone_numbers(self, remote_patient):
         # `celphone` typo is TherapyEdge's
         # keeping it here because we might still run into it on
         # older installations
@@ -156,11 +385,40 @@ class Importer(object):
         else:
             msisdns = remote_patient.cellphone
 
+        phone_numbers = []
         for msisdn in msisdns.split('/'):
             # FIXME: this normalization seems sketchy at best
             match = MSISDN_RE.match(msisdn)
             if match:
-                phone_number = '27' + match.groups()[1]
+                phone_numbers.append('27' + match.groups()[1])
+        return phone_numbers
+
+    def update_local_patient(self, owner, remote_patient, msisdns=None):
+        logger.info('Processing: %s' % remote_patient._asdict())
+        try:
+            update = Update(Patient).found(
+                self.get_patient(owner, remote_patient.te_id), False)
+        except Patient.DoesNotExist:
+            update = Update(Patient).found(
+                Patient(te_id=remote_patient.te_id, owner=owner), True)
+        patient, created, updated = update\
+            .update_attributes(
+                age=int(Age(remote_patient.age)),
+                sex=Sex(remote_patient.sex)
+            ).save()
+        if created:
+            logger.info('Patient created: %s' % patient)
+            if self.patients is not None:
+                # the same patient can be in the feed again
+                self.patients[patient.te_id] = patient
+                self.patients_by_pk[patient.pk] = patient
+        elif updated:
+            logger.info('Update for existing patient: %s' % patient)
+
+        if msisdns is not None:
+            msisdns.append((patient, self.phone_numbers(remote_patient)))
+        else:
+            for phone_number in self.phone_numbers(remote_patient):
                 msisdn, created = MSISDN.objects.get_or_create(msisdn=phone_number)
                 if msisdn not in patient.msisdns.all():
                     patient.msisdns.add(msisdn)
@@ -179,31 +437,30 @@ class Importer(object):
             user, clinic, coming_visits)
 
     def update_local_coming_visits(self, user, clinic, visits):
-        for visit in visits:
+        for visit in self.prefetched(user, visits):
             logger.info('Processing coming Visit %s' % visit._asdict())
             try:
-                yield self.update_local_coming_visit(user, clinic, visit)
+                with self.row():
+                    local_visit = self.update_local_coming_visit(user, clinic, visit)
+                yield local_visit
             except IntegrityError, e:
                 logger.exception('Failed to create upcoming Visit')
+                self.forget(visit)
             except Patient.DoesNotExist, e:
                 logger.exception('Could not find Patient for Visit.te_id')
+                self.forget(visit)
 
     def update_local_coming_visit(self, owner, clinic, remote_visit):
         # I'm assuming we'll always have the patient being referenced
         # in the Visit object, if not - raise hell
-        patient = Patient.objects.get(te_id=remote_visit.te_id, owner=owner)
+        patient = self.get_patient(owner, remote_visit.te_id)
         coming_date = iso8601.parse_date(remote_visit.scheduled_visit_date)
 
         # FIXME:    a lot of duplication between update_local_coming_visit and
         #           update_local_missed_visits with regard to the status of
         #           of the messages.
 
-        try:
-            visit = Visit.objects.get(te_visit_id=remote_visit.key_id)
-            created = False
-        except Visit.DoesNotExist:
-            visit = Visit(te_visit_id=remote_visit.key_id)
-            created = True
+        visit, created = self.get_visit(remote_visit.key_id)
 
         # check if something actually changed in the visit, if not, immediately
         # return the visit - no use continuing
@@ -247,28 +504,28 @@ class Importer(object):
         return self.update_local_missed_visits(user, clinic, missed_visits)
 
     def update_local_missed_visits(self, user, clinic, missed_visits):
-        for visit in missed_visits:
+        for visit in self.prefetched(user, missed_visits):
             logger.info('Processing missed Visit: %s' % visit._asdict())
             try:
-                yield self.update_local_missed_visit(user, clinic, visit)
+                with self.row():
+                    local_visit = self.update_local_missed_visit(user, clinic, visit)
+                yield local_visit
             except IntegrityError, e:
                 logger.exception('Failed to create Visit')
+                self.forget(visit)
             except Patient.DoesNotExist, e:
                 logger.exception('Could not find Patient for Visit.te_id')
+                self.forget(visit)
             except VisitException, e:
                 logger.exception('VisitException')
+                self.forget(visit)
 
     def update_local_missed_visit(self, owner, clinic, remote_visit):
         # get the patient or raise error
-        patient = Patient.objects.get(te_id=remote_visit.te_id, owner=owner)
+        patient = self.get_patient(owner, remote_visit.te_id)
         missed_date = iso8601.parse_date(remote_visit.missed_date).date()
 
-        try:
-            visit = Visit.objects.get(te_visit_id=remote_visit.key_id)
-            created = False
-        except Visit.DoesNotExist:
-            visit = Visit(te_visit_id=remote_visit.key_id)
-            created = True
+        visit, created = self.get_visit(remote_visit.key_id)
 
         # check if something actually changed in the visit, if not, immediately
         # return the visit - no use continuing
@@ -315,22 +572,26 @@ class Importer(object):
         return self.update_local_done_visits(user, clinic, done_visits)
 
     def update_local_done_visits(self, user, clinic, remote_visits):
-        for remote_visit in remote_visits:
+        for remote_visit in self.prefetched(user, remote_visits):
             logger.info('Processing done Visit: %s' % remote_visit._asdict())
             try:
-                yield self.update_local_done_visit(user, clinic, remote_visit)
+                with self.row():
+                    local_visit = self.update_local_done_visit(user, clinic, remote_visit)
+                yield local_visit
             except IntegrityError, e:
                 logger.exception('Failed to create visit')
+                self.forget(remote_visit)
             except Patient.DoesNotExist, e:
                 logger.exception('Could not find Patient for Visit.te_id')
+                self.forget(remote_visit)
 
     def update_local_done_visit(self, owner, clinic, remote_visit):
         # get patient or raise error
-        patient = Patient.objects.get(te_id=remote_visit.te_id, owner=owner)
+        patient = self.get_patient(owner, remote_visit.te_id)
         done_date = iso8601.parse_date(remote_visit.done_date).date()
 
         visit, created, updated = Update(Visit) \
-            .get(te_visit_id=remote_visit.key_id) \
+            .found(*self.get_visit(remote_visit.key_id)) \
             .update_attributes(
                 clinic=clinic,
                 patient=patient,
@@ -362,27 +623,203 @@ class Importer(object):
         return self.update_local_deleted_visits(user, deleted_visits)
 
     def update_local_deleted_visits(self, user, remote_visits):
-        for remote_visit in remote_visits:
+        if self.batched:
+            for visit in self.delete_local_visits(user, remote_visits):
+                yield visit
+            return
+        for remote_visit in self.prefetched(user, remote_visits,
+                                            patient__owner=user):
             logger.info('Processing deleted Visit: %s' % remote_visit._asdict())
             try:
-                yield self.update_local_deleted_visit(user, remote_visit)
+                with self.row():
+                    local_visit = self.update_local_deleted_visit(user, remote_visit)
+                yield local_visit
             except Visit.DoesNotExist, e:
                 logger.exception('Could not find Visit to delete')
+                self.forget(remote_visit)
+
+    def delete_local_visits(self, owner, remote_visits):
+        """Soft delete the visits of all the remote records with an UPDATE
+        per chunk instead of saving every visit. The historical records
+        are created in bulk and the risk profiles of the patients are
+        recalculated once, the status of the visits doesn't change so
+        their counters stay the same."""
+        remote_visits = list(remote_visits)
+        fields = [field.attname for field in Visit._meta.concrete_fields]
+        rows = {}
+        for row in in_chunks(Visit.objects.filter(patient__owner=owner)
+                                .values_list(*fields), 'te_visit_id',
+                                set(remote_visit.key_id
+                                    for remote_visit in remote_visits)):
+            row = dict(zip(fields, row))
+            rows[row['te_visit_id']] = row
+        deleted = []
+        for remote_visit in remote_visits:
+            logger.info('Processing deleted Visit: %s' % remote_visit._asdict())
+            row = rows.get(remote_visit.key_id)
+            if row is None:
+                logger.error('Could not find Visit to delete: %s' % (
+                    remote_visit.key_id,))
+                self.forget(remote_visit)
+                continue
+            if row['deleted']:
+                # listed more than once
+                continue
+            row['deleted'] = True
+            deleted.append(row)
+        if not deleted:
+            return []
+
+        pks = [row['id'] for row in deleted]
+        for offset in range(0, len(pks), PREFETCH_CHUNK_SIZE):
+            Visit.objects.filter(
+                pk__in=pks[offset:offset + PREFETCH_CHUNK_SIZE]).update(
+                    deleted=True)
+        # changed, like the save of a soft delete
+        history_date = timezone.now()
+        Visit.history.model.objects.bulk_create([
+            Visit.history.model(history_type='~', history_date=history_date,
+                                **row)
+            for row in deleted], batch_size=PREFETCH_CHUNK_SIZE)
+        patient_ids = set(row['patient_id'] for row in deleted)
+        queue_risk_profiles(patient_ids)
+
+        # give the visits their patients, saves looking them up when the
+        # Visits are initialized
+        patients = dict((patient.pk, patient) for patient in
+            in_chunks(Patient.all_objects.all(), 'pk', patient_ids))
+        visits = []
+        for row in deleted:
+            row['patient'] = patients[row.pop('patient_id')]
+            visit = Visit(**row)
+            visit._state.adding = False
+            visit._state.db = Visit.objects.db
+            logger.info('Deleted Visit: %s' % visit.id)
+            visits.append(visit)
+        return visits
 
     def update_local_deleted_visit(self, owner, remote_visit):
-        visit = Visit.objects.get(te_visit_id=remote_visit.key_id, patient__owner=owner)
+        visit, created = self.get_visit(remote_visit.key_id,
+                                        patient__owner=owner)
+        if created:
+            raise Visit.DoesNotExist('Visit matching te_visit_id %s does '
+                                        'not exist.' % remote_visit.key_id)
         visit.delete()
         logger.info('Deleted Visit: %s' % visit.id)
         return visit
 
-    def import_all_changes(self, user, clinic, since, until, visit_type):
-        # I set these because they all are generators, listing them forces
-        # them to be iterated over
-        return {
-            # 'all_patients': list(self.import_all_patients(clinic)),
-            'updated_patients': filter(None, self.import_updated_patients(user, clinic, since, until)),
-            'coming_visits': filter(None, self.import_coming_visits(user, clinic, since, until, visit_type)),
-            'missed_visits': filter(None, self.import_missed_visits(user, clinic, since, visit_type)),
-            'done_visits': filter(None, self.import_done_visits(user, clinic, since, until, visit_type)),
-            'deleted_visits': filter(None, self.import_deleted_visits(user, clinic, since, until, visit_type))
-        }
\ No newline at end of file
+    def fetch(self, client, feed, since, until, visit_type, stream=False):
+        """Fetch the remote records of one of the FEEDS with the given
+        client, returns the records and the seconds it took. With `stream`
+        the records are returned as they are read from a streaming
+        client, the time it takes to read them counts as writing time."""
+        start = time.time()
+        if feed == 'updated_patients':
+            records = client.get_updated_patients(since)
+        elif feed == 'missed_visits':
+            records = client.get_missed_visits(since, visit_type)
+        else:
+            records = getattr(client, 'get_%s' % feed)(since, until,
+                                                        visit_type)
+        if not stream:
+            records = list(records)
+        return records, time.time() - start
+
+    def thread_client(self):
+        """The XML-RPC client for the current thread, ServerProxy instances
+        can't be shared between threads."""
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client(self.uri, self.verbose,
+                                        self.streaming)
+        return self.local.client
+
+    def fetch_in_thread(self, feed, since, until, visit_type):
+        return self.fetch(self.thread_client(), feed, since, until,
+                            visit_type)
+
+    def fetch_all_changes(self, pool, since, until, visit_type):
+        """Start fetching all the FEEDS in the pool's worker threads,
+        returns the pending results to pass to `import_all_changes`."""
+        return dict((feed, pool.apply_async(self.fetch_in_thread,
+                                            (feed, since, until, visit_type)))
+                    for feed in FEEDS)
+
+    def write(self, feed, user, clinic, records):
+        if feed == 'updated_patients':
+            changes = self.update_local_patients(user, records)
+        elif feed == 'deleted_visits':
+            changes = self.update_local_deleted_visits(user, records)
+        else:
+            changes = getattr(self, 'update_local_%s' % feed)(user, clinic,
+                                                                records)
+        # these are all generators, filtering them forces them to be
+        # iterated over
+        return filter(None, changes)
+
+    def write_chunk(self, feed, user, clinic, records):
+        """Write a chunk of remote records in a single transaction. If one
+        of them fails with an IntegrityError the chunk is rolled back and
+        written again with a savepoint per record, so only the records
+        that fail are lost."""
+        try:
+            self.savepoints = False
+            with transaction.atomic():
+                with keep_deferred_counters():
+                    return self.write(feed, user, clinic, records)
+        except ChunkFailed, e:
+            logger.warning('Writing %s %s again a record at a time: %s' % (
+                len(records), feed, e))
+        finally:
+            self.savepoints = None
+        try:
+            self.savepoints = True
+            with transaction.atomic():
+                return self.write(feed, user, clinic, records)
+        finally:
+            self.savepoints = None
+
+    def reconcile(self, feed, user, clinic, records):
+        """Write the remote records of one of the FEEDS to the database,
+        returns the changed instances and the seconds it took."""
+        start = time.time()
+        if self.skip_unchanged:
+            # patients aren't imported per clinic
+            fingerprint_clinic = None if feed == 'updated_patients' \
+                else clinic
+            records = self.changed(feed, user, fingerprint_clinic, records)
+        if self.chunk_size:
+            changes = []
+            for chunk in chunked(records, self.chunk_size):
+                changes.extend(self.write_chunk(feed, user, clinic, chunk))
+        else:
+            changes = self.write(feed, user, clinic, records)
+        if self.skip_unchanged:
+            self.save_fingerprints(feed, user, fingerprint_clinic)
+        return changes, time.time() - start
+
+    def import_all_changes(self, user, clinic, since, until, visit_type,
+                            fetched=None):
+        """Import all the FEEDS for the clinic, in order. `fetched` has the
+        pending results of `fetch_all_changes` if the feeds are being
+        fetched concurrently, otherwise every feed is fetched right before
+        it is written. The (fetch, write) seconds per feed end up in
+        `self.timings` and the number of unchanged records that were
+        skipped in `self.skipped`."""
+        changes = {}
+        self.timings = {}
+        self.skipped = {}
+        for feed in FEEDS:
+            if fetched is None:
+                records, fetch_time = self.fetch(self.client, feed, since,
+                                                    until, visit_type,
+                                                    stream=self.streaming)
+            else:
+                records, fetch_time = fetched[feed].get()
+            changes[feed], write_time = self.reconcile(feed, user, clinic,
+                                                        records)
+            self.timings[feed] = (fetch_time, write_time)
+            logger.info('%s for %s: fetched in %.2fs, wrote %s in %.2fs, '
+                        'skipped %s unchanged' % (
+                feed, clinic.name, fetch_time, len(changes[feed]),
+                write_time, self.skipped.get(feed, 0)))
+        return changes
@@ -3,10 +3,12 @@ from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 from txtalert.apps.general.settings.models import Setting
 from txtalert.apps.therapyedge.importer import Importer
 from txtalert.core.models import Clinic
+from txtalert.core.signals import defer_risk_profiles
 from xml.parsers.expat import ExpatError
 import sys
 import traceback
@@ -36,6 +38,23 @@ class Command(BaseCommand):
         make_option('--verbose', dest='verbose', action='store_true'),
         make_option('--visit-type', dest='visit_type', default=3, type=int,
                     help='The visit type to import, defaults to Medical Visit (3)'),
+        make_option('--batched', dest='batched', action='store_true',
+                    help=('Load the patients & visits referred to by a '
+                          'whole result set at once.')),
+        make_option('--workers', dest='workers', default=1, type='int',
+                    help=('The number of threads fetching the feeds of the '
+                          'clinics concurrently, the changes are still '
+                          'written one clinic & feed at a time.')),
+        make_option('--streaming', dest='streaming', action='store_true',
+                    help=('Parse the XML-RPC responses while they are '
+                          'being read instead of loading them whole.')),
+        make_option('--skip-unchanged', dest='skip_unchanged',
+                    action='store_true',
+                    help=('Skip the records that have not changed since '
+                          'they were last imported.')),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    help=('Commit the changes in a transaction per this '
+                          'many records instead of one per change.')),
     )
 
     def handle(self, *args, **options):
@@ -44,7 +63,11 @@ class Command(BaseCommand):
             username=Setting.objects.get(name='THERAPYEDGE_USERNAME').value,
             password=Setting.objects.get(name='THERAPYEDGE_PASSWORD').value)
 
-        importer = Importer(uri=url, verbose=options['verbose'])
+        importer = Importer(uri=url, verbose=options['verbose'],
+                            batched=options['batched'],
+                            streaming=options['streaming'],
+                            skip_unchanged=options['skip_unchanged'],
+                            chunk_size=options['chunk_size'])
 
         username = options.get('username')
         if not username:
@@ -58,21 +81,47 @@ class Command(BaseCommand):
         visit_type = options['visit_type']
 
         user = User.objects.get(username=username)
-        for clinic in Clinic.objects.filter(active=True, user=user):
-            # from midnight
-            midnight = start_date.replace(hour=0, minute=0, second=0,
-                                          microsecond=0)
-            since = midnight - timedelta(days=1)
-            # until 30 days later
-            until = midnight + timedelta(days=options['days'])
-            logging.info("%s from %s until %s" % (clinic.name, since, until))
-            try:
-                for key, value in importer.import_all_changes(
+        clinics = list(Clinic.objects.filter(active=True, user=user))
+        # from midnight
+        midnight = start_date.replace(hour=0, minute=0, second=0,
+                                      microsecond=0)
+        since = midnight - timedelta(days=1)
+        # until 30 days later
+        until = midnight + timedelta(days=options['days'])
+
+        pool = None
+        fetches = [None] * len(clinics)
+        if options['workers'] > 1:
+            # start fetching everything, the results are written in order
+            # as they come in
+            pool = ThreadPool(options['workers'])
+            fetches = [importer.fetch_all_changes(pool, since, until,
+                                                  visit_type)
+                       for clinic in clinics]
+
+        # the risk profiles are calculated in bulk after the import
+        with defer_risk_profiles():
+            for clinic, fetched in zip(clinics, fetches):
+                logging.info("%s from %s until %s" % (clinic.name, since, until))
+                try:
+                    changes = importer.import_all_changes(
                         user,
                         clinic,
                         since=since,
                         until=until,
-                        visit_type=visit_type).items():
-                    print "\t%s: %s" % (key, len(value))
-            except ExpatError, e:
-                logging.error("Exception during processing XML for clinic %s %s" % (clinic, traceback.print_exc()))
\ No newline at end of file
+                        visit_type=visit_type,
+                        fetched=fetched)
+                    for key, value in changes.items():
+                        print "\t%s: %s" % (key, len(value))
+                    for key, (fetch_time, write_time) in \
+                            importer.timings.items():
+                        print "\t%s: fetched in %.2fs, written in %.2fs" % (
+                            key, fetch_time, write_time)
+                    for key, skipped in importer.skipped.items():
+                        print "\t%s: %s unchanged skipped" % (key, skipped)
+                except ExpatError, e:
+                    logging.error("Exception during processing XML for clinic %s %s" % (clinic, traceback.print_exc()))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
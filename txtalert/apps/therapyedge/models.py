@@ -1 +1,22 @@
-# empty on purpose
\ No newline at end of file
+from django.db import models
+from django.contrib.auth.models import User
+from txtalert.core.models import Clinic
+
+
+class RecordFingerprint(models.Model):
+    """A hash of a remote TherapyEdge record as it was last imported, the
+    importer skips the records that haven't changed since."""
+    user = models.ForeignKey(User)
+    # patients aren't imported per clinic
+    clinic = models.ForeignKey(Clinic, null=True)
+    feed = models.CharField(max_length=50)
+    # the key_id of a visit, the te_id of a patient
+    key = models.CharField(max_length=50)
+    fingerprint = models.CharField(max_length=40)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'clinic', 'feed', 'key')
+
+    def __unicode__(self):
+        return u'%s %s: %s' % (self.feed, self.key, self.fingerprint)
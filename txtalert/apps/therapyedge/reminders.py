@@ -20,10 +20,12 @@ from django.utils import timezone
 from django.conf import settings
 from django.core import mail
 from django.contrib.auth.models import Group, User
+from django.db.models import Q
 
 from txtalert.apps.general.settings.models import Setting
 from txtalert.apps.gateway.models import SendSMS
-from txtalert.core.models import Visit, MessageType
+from txtalert.core.models import Visit, MessageType, Patient, Clinic
+from txtalert.core.caches import message_types
 import logging
 import pytz
 
@@ -128,8 +130,14 @@ def send_stats_for_group(gateway, today, group):
 
 def send_messages(gateway, clinic, user, message_key, patients,
                     message_formatter=lambda x: x):
+    return send_messages_per_language(gateway, clinic, user, message_key,
+        group_by_language(patients), message_formatter)
+
+def send_messages_per_language(gateway, clinic, user, message_key,
+                                patients_per_language,
+                                message_formatter=lambda x: x):
     send_sms_per_language = {}
-    for language, patients in group_by_language(patients).items():
+    for language, patients in patients_per_language.items():
         # We only can send messages to patients with an active msisdn
         patients = filter(lambda p:p.active_msisdn, patients)
         # print 'querying', {
@@ -137,8 +145,7 @@ def send_messages(gateway, clinic, user, message_key, patients,
         #     'message_key': message_key,
         #     'language': language,
         # }
-        message_type = MessageType.objects.get(clinic=clinic, name=message_key,
-            language=language)
+        message_type = message_types.get(clinic, message_key, language)
         message = message_formatter(message_type.message)
         # we make a set out of it to avoid having duplicate MSISDNs, this can
         # happen if a patient has two different visits on the same day
@@ -205,22 +212,84 @@ def missed(gateway, clinic, user, visits, today):
     )
 
 
+# the order in which the reminders are sent for every clinic
+REMINDER_KEYS = ('tomorrow_message', 'twoweeks_message', 'attended_message',
+                    'missed_message')
+
+def reminder_candidates(group_names, today, clinic_name=None):
+    """All the visits of the groups' users' clinics that need a reminder sent
+    on `today`, as a single (unevaluated) queryset."""
+    yesterday = today - timedelta(days=1)
+    tomorrow = today + timedelta(days=1)
+    twoweeks = today + timedelta(weeks=2)
+    users = User.objects.filter(groups__name__in=group_names)
+    visits = Visit.objects.filter(patient__opted_in=True,
+                                    clinic__user__in=users)
+    # If given a clinic name limit the filter to that clinic only
+    if clinic_name:
+        visits = visits.filter(clinic__name=clinic_name)
+    return visits.filter(
+        Q(date__in=[tomorrow, twoweeks]) |
+        Q(date=yesterday, status__in=['a', 'm'])
+    )
+
+def reminder_key(date, status, today):
+    """The message key of the reminder a candidate visit is due for"""
+    if date == today + timedelta(days=1):
+        return 'tomorrow_message'
+    elif date == today + timedelta(weeks=2):
+        return 'twoweeks_message'
+    elif status == 'a':
+        return 'attended_message'
+    return 'missed_message'
+
+def partition_reminders(visits, today):
+    """Partition the candidate visits into patients per language, per clinic
+    and message key: {(clinic, message_key): {language: [patient, ...]}}
+
+    The visits are read as plain rows and their patients & clinics are
+    loaded once each, so this takes three queries however many clinics
+    and visits there are."""
+    patients = Patient.all_objects.filter(pk__in=visits.values('patient')) \
+                .select_related('active_msisdn', 'language')
+    patients = dict((patient.pk, patient) for patient in patients)
+    clinics = Clinic.objects.filter(pk__in=visits.values('clinic')) \
+                .select_related('user')
+    clinics = dict((clinic.pk, clinic) for clinic in clinics)
+    partitions = {}
+    rows = visits.values_list('patient', 'clinic', 'date', 'status')
+    for patient_id, clinic_id, date, status in rows:
+        patient = patients[patient_id]
+        patients_per_language = partitions.setdefault(
+            (clinics[clinic_id], reminder_key(date, status, today)), {})
+        patients_per_language.setdefault(patient.language, []).append(patient)
+    return partitions
+
 def all(gateway, group_names, date=None, clinic_name=None):
-    users = User.objects.filter(groups__name__in=group_names).distinct()
-    for user in users:
-        for clinic in user.clinic.all():
-            visits = Visit.objects.filter(patient__opted_in=True,
-                                            clinic=clinic)
-            # If given a clinic name limit the filter to that clinic only
-            if clinic_name:
-                visits = visits.filter(clinic__name=clinic_name)
-
-            today = date or timezone.now().date()
-            logger.debug('Sending reminders for %s: tomorrow' % user)
-            tomorrow(gateway, clinic, user, visits, today)
-            logger.debug('Sending reminders for %s: two weeks' % user)
-            two_weeks(gateway, clinic, user, visits, today)
-            logger.debug('Sending reminders for %s: attended yesterday' % user)
-            attended(gateway, clinic, user, visits, today)
-            logger.debug('Sending reminders for %s: missed yesterday' % user)
-            missed(gateway, clinic, user, visits, today)
+    today = date or timezone.now().date()
+    twoweeks = today + timedelta(weeks=2)
+    message_formatters = {
+        'twoweeks_message': \
+            lambda msg: msg % {'date': twoweeks.strftime('%A %d %b')},
+    }
+    partitions = partition_reminders(
+        reminder_candidates(group_names, today, clinic_name), today)
+    # the cache is only cleared by the process that changes a template,
+    # start every run afresh in a long lived worker
+    message_types.clear()
+    message_types.preload(set(clinic for clinic, _ in partitions))
+    ordering = lambda key: (
+        key[0].user_id, key[0].pk, REMINDER_KEYS.index(key[1]))
+    for clinic, message_key in sorted(partitions, key=ordering):
+        logger.debug('Sending reminders for %s: %s' % (clinic.user,
+                                                        message_key))
+        send_messages_per_language(
+            gateway,
+            clinic,
+            clinic.user,
+            message_key,
+            partitions[(clinic, message_key)],
+            message_formatters.get(message_key, lambda msg: msg)
+        )
+    logger.debug('Message type cache: %(hits)s hits, %(misses)s misses' %
+                    message_types.stats())
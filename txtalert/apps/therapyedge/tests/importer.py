@@ -1,15 +1,20 @@
 from django.test import TestCase
+from django.db import IntegrityError
 from django.utils import timezone
 from django.contrib.auth.models import User
-from txtalert.apps.therapyedge.importer import Importer, SEX_MAP
+from txtalert.apps.therapyedge.importer import Importer, SEX_MAP, FEEDS
+from txtalert.apps.therapyedge.models import RecordFingerprint
 from txtalert.apps.therapyedge.xmlrpc import client
 from txtalert.core.models import Patient, MSISDN, Visit, Clinic
 from txtalert.apps.therapyedge.tests.utils import (PatientUpdate, ComingVisit, MissedVisit,
                                         DoneVisit, DeletedVisit, create_instance)
 from datetime import datetime, timedelta, date
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 import random
 import logging
 import iso8601
+import xmlrpclib
 
 class ImporterTestCase(TestCase):
     """Testing the TherapyEdge import loop"""
@@ -440,6 +445,7 @@ class ImporterXmlRpcClientTestCase(TestCase):
         )
         # monkey patching
         self.importer.client.server.patients_data = patched_client.mocked_patients_data
+        self.patched_client = patched_client
 
         self.clinic = Clinic.objects.all()[0] # make sure we have a clinic
         self.assertTrue(Patient.objects.count()) # make sure our fixtures aren't empty
@@ -520,3 +526,144 @@ class ImporterXmlRpcClientTestCase(TestCase):
         self.assertTrue(isinstance(deleted_visits[0], Visit))
 
 
+
+    def test_import_all_changes_concurrently(self):
+        # the worker threads get the patched client too
+        self.importer.thread_client = lambda: self.importer.client
+        pool = ThreadPool(3)
+        fetched = self.importer.fetch_all_changes(
+            pool,
+            since=(timezone.now() - timedelta(days=1)),
+            until=timezone.now(),
+            visit_type=3  # Medical Visit
+        )
+        changes = self.importer.import_all_changes(
+            user=self.user,
+            clinic=self.clinic,
+            since=(timezone.now() - timedelta(days=1)),
+            until=timezone.now(),
+            visit_type=3,  # Medical Visit
+            fetched=fetched
+        )
+        pool.close()
+        pool.join()
+        self.assertEquals(set(changes.keys()), set(FEEDS))
+        self.assertEquals(set(self.importer.timings.keys()), set(FEEDS))
+        for feed in FEEDS:
+            self.assertEquals(len(changes[feed]), Patient.objects.count())
+        # the coming visits were written before they were deleted
+        self.assertFalse(Visit.objects.filter(
+            te_visit_id__in=[visit.te_visit_id
+                             for visit in changes['deleted_visits']]).exists())
+
+    def test_skip_unchanged(self):
+        self.importer.skip_unchanged = True
+        def import_all_changes():
+            return self.importer.import_all_changes(
+                user=self.user,
+                clinic=self.clinic,
+                since=(timezone.now() - timedelta(days=1)),
+                until=timezone.now(),
+                visit_type=3  # Medical Visit
+            )
+        import_all_changes()
+        self.assertEquals(RecordFingerprint.objects.count(),
+                          len(FEEDS) * Patient.objects.count())
+        # nothing changed remotely, nothing is imported
+        changes = import_all_changes()
+        for feed in FEEDS:
+            self.assertEquals(changes[feed], [])
+            self.assertEquals(self.importer.skipped[feed],
+                              Patient.objects.count())
+        # only the changed record is
+        missed_visit = self.patched_client.patches['missedvisits'][0]
+        missed_visit['missed_date'] = str(timezone.now() - timedelta(days=3))
+        changes = import_all_changes()
+        self.assertEquals([visit.te_visit_id
+                           for visit in changes['missed_visits']],
+                          [missed_visit['key_id']])
+        self.assertEquals(self.importer.skipped['missed_visits'],
+                          Patient.objects.count() - 1)
+
+    def test_chunked_writes(self):
+        self.importer.chunk_size = 2
+        failing_key_id = self.patched_client.patches['comingvisits'][1]['key_id']
+        update_local_coming_visit = self.importer.update_local_coming_visit
+        def failing_update_local_coming_visit(owner, clinic, remote_visit):
+            visit = update_local_coming_visit(owner, clinic, remote_visit)
+            if remote_visit.key_id == failing_key_id:
+                raise IntegrityError('duplicate key')
+            return visit
+        self.importer.update_local_coming_visit = \
+            failing_update_local_coming_visit
+
+        changes = self.importer.import_all_changes(
+            user=self.user,
+            clinic=self.clinic,
+            since=(timezone.now() - timedelta(days=1)),
+            until=timezone.now(),
+            visit_type=3  # Medical Visit
+        )
+        # only the failing visit is lost, not the rest of its chunk
+        self.assertEquals(len(changes['coming_visits']),
+                          Patient.objects.count() - 1)
+        self.assertFalse(Visit.all_objects.filter(
+            te_visit_id=failing_key_id).exists())
+        self.assertEquals(Visit.all_objects.filter(te_visit_id__in=[
+            visit.te_visit_id for visit in changes['coming_visits']]).count(),
+            Patient.objects.count() - 1)
+        for feed in ['updated_patients', 'missed_visits', 'done_visits']:
+            self.assertEquals(len(changes[feed]), Patient.objects.count())
+
+
+class FakeResponse(object):
+    """Just enough of an httplib.HTTPResponse to parse an XML-RPC
+    response from"""
+
+    def __init__(self, body, headers={}):
+        self.body = StringIO(body)
+        self.headers = headers
+
+    def read(self, amount):
+        return self.body.read(amount)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class StreamingClientTestCase(TestCase):
+
+    def setUp(self):
+        self.visits = [{
+                'dr_site_name': '',
+                'dr_site_id': '',
+                'dr_status': '',
+                'scheduled_visit_date': '2014-01-01 00:00:00',
+                'key_id': '02-1234%s' % i,
+                'te_id': '01-1234%s' % i,
+            } for i in range(500)]
+        self.body = xmlrpclib.dumps((self.visits,), methodresponse=True)
+
+    def test_records_are_parsed_while_reading(self):
+        response = FakeResponse(self.body)
+        records = client.StreamingTransport().iter_records(response)
+        self.assertEquals(records.next(), self.visits[0])
+        # the first record is handed out before the response is read whole
+        self.assertTrue(response.body.tell() < len(self.body))
+        self.assertEquals([records.next()] + list(records), self.visits[1:])
+
+    def test_gzipped_response(self):
+        response = FakeResponse(xmlrpclib.gzip_encode(self.body),
+                                {'Content-Encoding': 'gzip'})
+        records = client.StreamingTransport().iter_records(response)
+        self.assertEquals(list(records), self.visits)
+
+    def test_streaming_client(self):
+        te_client = client.Client(streaming=True)
+        te_client.transport.request = lambda *args, **kwargs: \
+            te_client.transport.iter_records(FakeResponse(self.body))
+        coming_visits = list(te_client.get_coming_visits(
+            timezone.now() - timedelta(days=1), timezone.now(), 3))
+        self.assertEquals([visit.key_id for visit in coming_visits],
+                          [visit['key_id'] for visit in self.visits])
+        self.assertEquals(type(coming_visits[0]).__name__, 'ComingVisit')
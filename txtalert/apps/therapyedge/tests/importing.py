@@ -19,6 +19,8 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 from django.utils import timezone
 from txtalert.core.models import *
+from txtalert.core.signals import (defer_risk_profiles,
+    calculate_risk_profiles, rebuild_visit_counters)
 from txtalert.apps.therapyedge.importer import Importer, InvalidValueException
 from txtalert.apps.therapyedge.tests.utils import create_instance
 from txtalert.apps.therapyedge.tests.utils import (PatientUpdate, ComingVisit, MissedVisit,
@@ -104,6 +106,29 @@ class PatientImportTestCase(TestCase):
         self.assertEquals(patient.msisdns.latest('id').msisdn, '27821234321')
         self.assertEquals(patient.history.count(), original_history_count + 1) # this is an update, should have a new history item
 
+    def testBatchedRepeatedPatientImport(self):
+        """a new 'te_id' more than once in a batched import"""
+        importer = Importer(batched=True)
+        patients = filter(None, importer.update_local_patients(self.user, [
+            create_instance(PatientUpdate, {
+                'te_id': '03-12345',
+                'age': '25',
+                'sex': 'Male',
+                'celphone': '0821231234'
+            }),
+            create_instance(PatientUpdate, {
+                'te_id': '03-12345',
+                'age': '26',
+                'sex': 'Male',
+                'celphone': '0821234321'
+            })]))
+        self.assertEquals(len(patients), 2)
+        patient = Patient.objects.get(te_id='03-12345')
+        self.assertEquals(patient.age, 26)
+        self.assertEquals(
+            sorted(patient.msisdns.values_list('msisdn', flat=True)),
+            ['27821231234', '27821234321'])
+
     def testDuplicateMsisdnImport(self):
         """duplicate 'msisdn' import"""
         # new patient, not in fixtures
@@ -177,6 +202,40 @@ class PatientImportTestCase(TestCase):
         self.assertEqual(msisdns[1].msisdn, '27821231111')
 
 
+    def testBatchedMsisdnImport(self):
+        """MSISDNs reconciled for a whole batch of patients"""
+        existing = Patient.objects.get(te_id='02-12345')
+        existing.msisdns.add(
+            MSISDN.objects.get_or_create(msisdn='27821111111')[0])
+        self.importer.batched = True
+        remote_patients = [create_instance(PatientUpdate, {
+                'te_id': te_id,
+                'age': '30',
+                'sex': 'Male',
+                'celphone': celphone
+            }) for te_id, celphone in [
+                ('03-12345', '0821111111/0822222222'),
+                ('02-12345', '0821111111/0823333333'),
+            ]]
+        patients = filter(None, self.importer.update_local_patients(
+            self.user, remote_patients))
+        self.assertEqual(len(patients), 2)
+        self.assertEqual(
+            sorted(Patient.objects.get(te_id='03-12345').msisdns
+                        .values_list('msisdn', flat=True)),
+            ['27821111111', '27822222222'])
+        self.assertTrue(set(['27821111111', '27823333333']).issubset(
+            existing.msisdns.values_list('msisdn', flat=True)))
+        self.assertEqual(
+            MSISDN.objects.get(msisdn='27823333333').national_number,
+            '823333333')
+
+        # nothing left to do the second time around, in two queries
+        with self.assertNumQueries(2):
+            self.assertEqual(self.importer.update_local_msisdns([
+                (existing, ['27821111111', '27823333333'])]), set())
+
+
 class VisitImportTestCase(TestCase):
     fixtures = ['patients.json', 'clinics.json', 'visits.json',]
 
@@ -325,6 +384,85 @@ class VisitImportTestCase(TestCase):
                         )
 
 
+class BatchedVisitImportTestCase(TestCase):
+    fixtures = ['patients.json', 'clinics.json', 'visits.json',]
+
+    def setUp(self):
+        self.clinic = Clinic.objects.get(te_id='01')
+        self.importer = Importer(batched=True)
+        self.user = User.objects.get(username='kumbu')
+
+    def test_unchanged_visits(self):
+        remote_visits = [create_instance(ComingVisit, {
+            'key_id': '01-123456789',
+            'te_id': '01-12345',
+            'scheduled_visit_date': '2100-06-01 00:00:00'
+        })] * 10
+        # the patients & visits are loaded once, nothing is written
+        with self.assertNumQueries(2):
+            visits = filter(None, self.importer.update_local_coming_visits(
+                self.user, self.clinic, remote_visits))
+        self.assertEqual(visits, [])
+
+    def test_batched_import(self):
+        remote_visits = [create_instance(ComingVisit, {
+            'key_id': '01-123456789',
+            'te_id': '01-12345',
+            'scheduled_visit_date': '2200-06-01 00:00:00'
+        }), create_instance(ComingVisit, {
+            'key_id': '02-123456789',
+            'te_id': '01-12345',
+            'scheduled_visit_date': '2100-06-01 00:00:00'
+        }), create_instance(ComingVisit, {
+            'key_id': '02-123456790',
+            'te_id': '01-1245',
+            'scheduled_visit_date': '2100-06-01 00:00:00'
+        })]
+        history = Visit.history.filter(te_visit_id='01-123456789').count()
+        visits = filter(None, self.importer.update_local_coming_visits(
+            self.user, self.clinic, remote_visits))
+        self.assertEqual([visit.te_visit_id for visit in visits],
+                            ['01-123456789', '02-123456789'])
+        rescheduled = Visit.objects.get(te_visit_id='01-123456789')
+        self.assertEqual(rescheduled.status, 'r')
+        self.assertEqual(rescheduled.date, date(2200, 6, 1))
+        self.assertEqual(rescheduled.history.count(), history + 1)
+        self.assertEqual(
+            Visit.objects.get(te_visit_id='02-123456789').patient.te_id,
+            '01-12345')
+        # the unknown patient's visit isn't imported
+        self.assertFalse(
+            Visit.objects.filter(te_visit_id='02-123456790').exists())
+
+    def test_batched_delete(self):
+        visit = Visit.objects.get(te_visit_id='01-123456789')
+        history = visit.history.count()
+        with defer_risk_profiles():
+            # the visits, an UPDATE, the history & the patients, the risk
+            # profiles are calculated when the import is done
+            with self.assertNumQueries(4):
+                deleted = filter(None,
+                    self.importer.update_local_deleted_visits(
+                        self.user, [create_instance(DeletedVisit, {
+                            'key_id': '01-123456789',
+                            'te_id': '01-12345'
+                        }), create_instance(DeletedVisit, {
+                            'key_id': '01-000000000',
+                            'te_id': '01-12345'
+                        })]))
+        self.assertEqual([visit.te_visit_id for visit in deleted],
+                            ['01-123456789'])
+        # the last clinic is recalculated
+        patient = Patient.objects.get(pk=visit.patient_id)
+        self.assertEqual(patient.last_clinic, patient.get_last_clinic())
+        self.assertFalse(
+            Visit.objects.filter(te_visit_id='01-123456789').exists())
+        self.assertEqual(visit.history.count(), history + 1)
+        self.assertEqual(visit.history.latest().deleted, True)
+        self.assertEqual(visit.history.latest().get_history_type_display(),
+                            'Changed')
+
+
 class PatientRiskProfileTestCase(TestCase):
     fixtures = ['clinics.json', 'patients.json',]
 
@@ -398,3 +536,117 @@ class PatientRiskProfileTestCase(TestCase):
             }))
         # attended two out of 4, 50% risk
         self.assertAlmostEquals(self.reload_patient().risk_profile, 0.50, places=2)
+
+    def test_deferred_risk_profile_calculation(self):
+        risk_profile = self.reload_patient().risk_profile
+        with defer_risk_profiles():
+            for key_id, done_date in [('02-123456701', '2100-07-01'),
+                                      ('02-123456702', '2100-07-02')]:
+                self.importer.update_local_done_visit(
+                    self.user,
+                    self.clinic,
+                    create_instance(DoneVisit, {
+                        'key_id': key_id,
+                        'te_id': self.patient.te_id,
+                        'done_date': '%s 00:00:00' % done_date
+                    }))
+            self.importer.update_local_missed_visit(
+                self.user,
+                self.clinic,
+                create_instance(MissedVisit, {
+                    'key_id': '02-123456703',
+                    'te_id': self.patient.te_id,
+                    'missed_date': (timezone.now() - timedelta(days=1))
+                                    .strftime('%Y-%m-%d 00:00:00')
+                }))
+            # not calculated until the end of the block
+            self.assertEquals(self.reload_patient().risk_profile,
+                                risk_profile)
+        patient = self.reload_patient()
+        self.assertAlmostEquals(patient.risk_profile, 0.33, places=2)
+        self.assertEquals(patient.last_clinic, self.clinic)
+        # the same as the per visit calculation, nothing left to update
+        self.assertEquals(calculate_risk_profiles([self.patient.pk]), 0)
+
+    def test_deferred_risk_profile_calculation_on_error(self):
+        def import_and_fail():
+            with defer_risk_profiles():
+                self.importer.update_local_missed_visit(
+                    self.user,
+                    self.clinic,
+                    create_instance(MissedVisit, {
+                        'key_id': '02-123456789',
+                        'te_id': self.patient.te_id,
+                        'missed_date': (timezone.now() - timedelta(days=1))
+                                        .strftime('%Y-%m-%d 00:00:00')
+                    }))
+                raise InvalidValueException('broken feed')
+        self.assertRaises(InvalidValueException, import_and_fail)
+        # the visit saved before the error is counted
+        patient = self.reload_patient()
+        self.assertEquals(patient.missed_visits, 1)
+        self.assertEquals(patient.risk_profile, 1.0)
+
+    def test_visit_counters(self):
+        visit = self.importer.update_local_missed_visit(
+            self.user,
+            self.clinic,
+            create_instance(MissedVisit, {
+                'key_id': '02-123456789',
+                'te_id': self.patient.te_id,
+                'missed_date': (timezone.now() - timedelta(days=1))
+                                .strftime('%Y-%m-%d 00:00:00')
+            }))
+        # saving without a status change doesn't count
+        visit.comment = 'Called the patient'
+        visit.save()
+        visit.status = 'a'
+        visit.save()
+        patient = self.reload_patient()
+        self.assertEquals((patient.missed_visits, patient.attended_visits),
+                            (1, 1))
+        self.assertEquals(patient.risk_profile, 0.5)
+
+        Patient.all_objects.update(missed_visits=0, attended_visits=0)
+        self.assertEquals(rebuild_visit_counters(), 1)
+        patient = self.reload_patient()
+        self.assertEquals((patient.missed_visits, patient.attended_visits),
+                            (1, 1))
+
+    def test_visit_counters_with_stale_patients(self):
+        patient = self.reload_patient()
+        visits = [Visit.objects.create(patient=patient, clinic=self.clinic,
+                                        te_visit_id='02-12345678%s' % idx,
+                                        date=date(2100, 7, idx), status='s')
+                    for idx in range(1, 3)]
+        # every visit loads its own copy of the patient before either one
+        # is saved, as concurrent imports would
+        visits = [Visit.objects.get(pk=visit.pk) for visit in visits]
+        for visit in visits:
+            self.assertEquals(visit.patient.missed_visits,
+                                patient.missed_visits)
+        for visit in visits:
+            visit.status = 'm'
+            visit.save()
+        patient = self.reload_patient()
+        self.assertEquals((patient.missed_visits, patient.attended_visits),
+                            (2, 0))
+        self.assertEquals(patient.risk_profile, 1.0)
+
+    def test_stale_patient_save_keeps_visit_counters(self):
+        stale = self.reload_patient()
+        self.importer.update_local_missed_visit(
+            self.user,
+            self.clinic,
+            create_instance(MissedVisit, {
+                'key_id': '02-123456789',
+                'te_id': self.patient.te_id,
+                'missed_date': (timezone.now() - timedelta(days=1))
+                                .strftime('%Y-%m-%d 00:00:00')
+            }))
+        # like the admin or an import saving the patient it loaded before
+        stale.age = 40
+        stale.save()
+        patient = self.reload_patient()
+        self.assertEquals(patient.age, 40)
+        self.assertEquals(patient.missed_visits, stale.missed_visits + 1)
@@ -5,6 +5,7 @@ from datetime import datetime, date, timedelta
 from txtalert.apps.therapyedge import reminders
 from txtalert.core.models import *
 from txtalert.core.utils import random_string
+from txtalert.core.caches import message_types
 from txtalert.apps.gateway.models import SendSMS
 import hashlib
 from txtalert.apps import gateway
@@ -22,6 +23,7 @@ class RemindersI18NTestCase(TestCase):
         self.user = User.objects.get(username='kumbu')
         self.user.groups.add(self.group)
         gateway.load_backend('txtalert.apps.gateway.backends.dummy')
+        message_types.clear()
 
     def tearDown(self):
         pass
@@ -91,6 +93,63 @@ class RemindersI18NTestCase(TestCase):
         sms_set = missed_sms_set[self.language]
         self.assertTrue(self.patient.active_msisdn.msisdn in [sms.msisdn for sms in sms_set])
 
+    def test_reminder_candidates(self):
+        other_clinic = Clinic.objects.create(te_id='02', name='Other Clinic',
+                                                user=self.user)
+        today = timezone.now().date()
+        for clinic in (self.clinic, other_clinic):
+            for days, status in [(1, 's'), (14, 's'), (-1, 'a'), (-1, 'm'),
+                                    # these don't need reminders
+                                    (-1, 's'), (3, 's'), (0, 'a')]:
+                self.schedule_visits_for(self.calculate_date(days=days),
+                                            clinic=clinic, status=status)
+
+        # the same queries, no matter how many clinics there are
+        with self.assertNumQueries(3):
+            partitions = reminders.partition_reminders(
+                reminders.reminder_candidates(['Temba Lethu'], today), today)
+
+        self.assertEqual(set(partitions.keys()), set(
+            [(clinic, message_key) for clinic in (self.clinic, other_clinic)
+                for message_key in reminders.REMINDER_KEYS]))
+        for patients_per_language in partitions.values():
+            self.assertEqual(patients_per_language,
+                                {self.language: [self.patient]})
+
+    def test_message_type_cache(self):
+        tomorrow = self.calculate_date(days=1)
+        self.schedule_visits_for(tomorrow)
+        self.send_reminders('tomorrow')
+        hits = message_types.hits
+        # the template is served from the cache the second time around
+        with self.assertNumQueries(0):
+            message_types.get(self.clinic, 'tomorrow_message', self.language)
+        self.assertEqual(message_types.hits, hits + 1)
+
+        # and dropped when it changes
+        message_type = message_types.get(self.clinic, 'tomorrow_message',
+                                            self.language)
+        message_type.message = 'Changed'
+        message_type.save()
+        self.assertEqual(message_types.stats()['size'], 0)
+        tomorrow_sms_set = self.send_reminders('tomorrow')
+        self.assertTrue(all([sms.smstext == 'Changed'
+                                for sms in tomorrow_sms_set[self.language]]))
+
+    def test_message_type_cache_cleared_per_run(self):
+        tomorrow = self.calculate_date(days=1)
+        self.schedule_visits_for(tomorrow)
+        message_type = MessageType.objects.get(clinic=self.clinic,
+            name='tomorrow_message', language=self.language)
+        message_type.delete()
+        # as cached by a worker that didn't see the template being deleted
+        message_types.templates[message_types.key(
+            self.clinic, 'tomorrow_message', self.language)] = message_type
+        self.assertRaises(MessageType.DoesNotExist, reminders.all,
+                          gateway.gateway, ['Temba Lethu'])
+        self.assertFalse(SendSMS.objects.filter(
+            smstext=message_type.message).exists())
+
     def test_send_stats(self):
         today = timezone.now()
         one_day = timedelta(days=1)
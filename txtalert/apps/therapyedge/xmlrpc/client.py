@@ -1,13 +1,85 @@
-from xmlrpclib import ServerProxy, Error, ProtocolError
+from xmlrpclib import (ServerProxy, Error, ProtocolError, Transport,
+                       SafeTransport, Unmarshaller, ExpatParser, dumps)
 from datetime import datetime, timedelta
 from collections import namedtuple
 from django.utils import timezone
+import urllib
+import zlib
+
+# the number of bytes of a streamed response read & parsed at a time
+STREAM_READ_SIZE = 16 * 1024
 
 
 class IllegalDateRange(Exception):
     pass
 
 
+class RecordUnmarshaller(Unmarshaller):
+    """Collects the structs of the array a response returns in `records`
+    as soon as they're parsed, instead of building the whole array."""
+
+    def __init__(self, *args, **kwargs):
+        Unmarshaller.__init__(self, *args, **kwargs)
+        self.records = []
+
+    def end_struct(self, data):
+        Unmarshaller.end_struct(self, data)
+        # one mark for the top level array and one for the struct
+        if len(self._marks) == 1:
+            self.records.append(self._stack.pop())
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+    dispatch = dict(Unmarshaller.dispatch)
+    dispatch['struct'] = end_struct
+
+
+class StreamingTransportMixin:
+    """Makes the transport return a generator of the records in the
+    response, parsed while the response is read."""
+
+    def parse_response(self, response):
+        return self.iter_records(response)
+
+    def iter_records(self, response):
+        unmarshaller = RecordUnmarshaller(use_datetime=self._use_datetime)
+        parser = ExpatParser(unmarshaller)
+        decoder = None
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        finished = False
+        try:
+            while True:
+                data = response.read(STREAM_READ_SIZE)
+                if not data:
+                    break
+                if decoder:
+                    data = decoder.decompress(data)
+                parser.feed(data)
+                for record in unmarshaller.drain():
+                    yield record
+            parser.close()
+            # raises the Fault, if any
+            unmarshaller.close()
+            finished = True
+            for record in unmarshaller.drain():
+                yield record
+        finally:
+            # a partially read response leaves the connection unusable
+            if not finished:
+                self.close()
+
+
+class StreamingTransport(StreamingTransportMixin, Transport):
+    pass
+
+
+class SafeStreamingTransport(StreamingTransportMixin, SafeTransport):
+    pass
+
+
 class Client(object):
     """A class abstracting the TherapyEdge XML-RPC away into something more
     approachable and less temperamental"""
@@ -27,8 +99,21 @@ class Client(object):
     # cache for the generated classes
     CLASS_CACHE = {}
 
-    def __init__(self, uri=None, verbose=False):
-        self.server = ServerProxy(uri or self.DEFAULT_SERVICE_URL, verbose=verbose)
+    def __init__(self, uri=None, verbose=False, streaming=False):
+        uri = uri or self.DEFAULT_SERVICE_URL
+        self.server = ServerProxy(uri, verbose=verbose)
+        self.verbose = verbose
+        # In streaming mode the records are yielded while the response is
+        # being read, the response is never held in memory as a whole
+        self.streaming = streaming
+        if streaming:
+            scheme, rest = urllib.splittype(uri)
+            self.host, self.handler = urllib.splithost(rest)
+            self.handler = self.handler or '/RPC2'
+            if scheme == 'https':
+                self.transport = SafeStreamingTransport()
+            else:
+                self.transport = StreamingTransport()
 
     def dict_to_class(self, name, dict):
         """
@@ -61,6 +146,8 @@ class Client(object):
 
     def call_method(self, request, *args, **kwargs):
         """Call a method on the XML-RPC service, returning them as named tuples"""
+        if self.streaming:
+            return self.stream_method(request, *args)
         # result_list = self.rpc_range_call(request, *args, **kwargs)
         result_list = self.server.patients_data(request, *args, **kwargs)
         if result_list:
@@ -72,6 +159,19 @@ class Client(object):
             return self.create_instances_of(klass, result_list)
         return result_list
 
+    def stream_method(self, request, *args):
+        """Call a method on the XML-RPC service, yielding the named tuples
+        while the response is being read."""
+        body = dumps((request,) + args, 'patients_data')
+        records = self.transport.request(self.host, self.handler, body,
+                                         verbose=self.verbose)
+        klass = None
+        for item in records:
+            if klass is None:
+                klass = self.dict_to_class(self.TYPE_MAP[request], item)
+            instance = klass._make(klass._fields)
+            yield instance._replace(**item)
+
     def get_all_patients(self):
         """Get a list of all patients available at the clinic"""
         return self.call_method('patientlist')
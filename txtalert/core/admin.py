@@ -21,6 +21,7 @@ from django.shortcuts import render
 
 from txtalert.apps.general.jquery import AutoCompleteWidget, FilteredSelectWidget
 from txtalert.apps.gateway.models import SendSMS
+from txtalert.core.utils import national_number
 
 from models import *
 
@@ -74,7 +75,8 @@ class PatientAdmin(admin.ModelAdmin):
     list_display = ('te_id', 'sex', 'age', 'last_clinic', 'active_msisdn')
     list_filter = ('last_clinic',)
     search_fields = ['msisdns__msisdn', 'te_id', 'name', 'surname']
-    readonly_fields = ('owner', 'last_clinic',)
+    readonly_fields = ('owner', 'last_clinic', 'missed_visits',
+                       'attended_visits',)
 
     def get_urls(self):
         urls = super(PatientAdmin, self).get_urls()
@@ -87,8 +89,13 @@ class PatientAdmin(admin.ModelAdmin):
 
     def schedule_view(self, request, pk):
         patient = Patient.objects.get(pk=pk)
-        smss = SendSMS.objects.filter(
-            msisdn__endswith=patient.active_msisdn.msisdn[-9:])
+        msisdn = patient.active_msisdn.msisdn
+        number = national_number(msisdn)
+        # short codes have no national number, only match them exactly
+        if number is None:
+            smss = SendSMS.objects.filter(msisdn=msisdn)
+        else:
+            smss = SendSMS.objects.filter(national_number=number)
         opts = patient._meta
         return render(request, 'admin/core/patient/schedule.html', {
             'title': 'Patient schedule',
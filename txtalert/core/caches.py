@@ -0,0 +1,146 @@
+#  This file is part of TxtAlert.
+#
+#  TxtALert is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  TxtAlert is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with TxtAlert.  If not, see <http://www.gnu.org/licenses/>.
+
+from txtalert.core.models import MessageType, ClinicNameMapping
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+class MessageTypeCache(object):
+    """In-process cache of the MessageType templates, keyed by
+    (clinic, name, language). Cleared by the post_save & post_delete
+    signals on MessageType."""
+
+    def __init__(self):
+        self.templates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, clinic, name, language):
+        return (getattr(clinic, 'pk', clinic), name,
+                getattr(language, 'pk', language))
+
+    def preload(self, clinics):
+        """Load the message types of all the given clinics in one query"""
+        seen = set()
+        message_types = MessageType.objects.filter(clinic__in=clinics)
+        for message_type in message_types:
+            key = self.key(message_type.clinic_id, message_type.name,
+                            message_type.language_id)
+            # leave ambiguous templates to `get` so it raises like
+            # `MessageType.objects.get` would
+            if key in seen:
+                self.templates.pop(key, None)
+            else:
+                seen.add(key)
+                self.templates[key] = message_type
+
+    def get(self, clinic, name, language):
+        key = self.key(clinic, name, language)
+        if key in self.templates:
+            self.hits += 1
+            return self.templates[key]
+        self.misses += 1
+        message_type = MessageType.objects.get(clinic=clinic, name=name,
+                                                language=language)
+        self.templates[key] = message_type
+        return message_type
+
+    def clear(self):
+        self.templates.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.templates),
+        }
+
+
+class ClinicNameCache(object):
+    """In-process cache of the ClinicNameMappings, keyed by their case
+    folded WRHI clinic name. Unknown names are matched to a known name
+    that is the same once punctuation and whitespace are ignored, the
+    outcome is remembered, also when nothing matches. Cleared by the
+    post_save & post_delete signals on ClinicNameMapping."""
+
+    def __init__(self):
+        self.mappings = None
+        self.normalised = None
+        self.unknown = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, clinic_name):
+        return clinic_name.lower()
+
+    def normalise(self, clinic_name):
+        # "Zola_Clinic-1" & "zola clinic 1" are the same clinic but
+        # "zola clinic 2" is not, so nothing looser than this
+        return re.sub(r'[\W_]+', ' ', clinic_name.lower(),
+                      flags=re.UNICODE).strip()
+
+    def load(self):
+        mappings = {}
+        normalised = {}
+        for clinic_map in ClinicNameMapping.objects.select_related() \
+                .order_by('pk'):
+            # the first one, like `.first()` would find
+            mappings.setdefault(self.key(clinic_map.wrhi_clinic_name),
+                                clinic_map)
+            normalised.setdefault(
+                self.normalise(clinic_map.wrhi_clinic_name), clinic_map)
+        self.mappings = mappings
+        self.normalised = normalised
+
+    def get(self, clinic_name):
+        if clinic_name is None:
+            return None
+        if self.mappings is None:
+            self.load()
+        key = self.key(clinic_name)
+        if key in self.mappings:
+            self.hits += 1
+            return self.mappings[key]
+        if key in self.unknown:
+            self.hits += 1
+            return self.unknown[key]
+        self.misses += 1
+        clinic_map = self.normalised.get(self.normalise(clinic_name))
+        if clinic_map:
+            logger.warning('Matched unknown WRHI clinic %s to %s' % (
+                clinic_name, clinic_map.wrhi_clinic_name))
+        else:
+            logger.warning('No mapping for WRHI clinic %s' % (clinic_name,))
+        self.unknown[key] = clinic_map
+        return clinic_map
+
+    def clear(self):
+        self.mappings = None
+        self.normalised = None
+        self.unknown.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.mappings or {}) + len(self.unknown),
+        }
+
+
+message_types = MessageTypeCache()
+clinic_names = ClinicNameCache()
@@ -82,7 +82,7 @@ class PatientAdmin(ModelAdmin):
 
     search_fields = ['te_id', 'active_msisdn__msisdn', 'msisdns__msisdn']
     exclude = ['age', 'regiment', 'sex', 'disclosed', 'risk_profile',
-               'deceased', 'deleted']
+               'missed_visits', 'attended_visits', 'deceased', 'deleted']
 
     list_display = [
         'te_id',
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from txtalert.core.models import MSISDN
+from txtalert.core.utils import national_number
+from txtalert.apps.gateway.models import SendSMS
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', default=1000, dest='chunk_size',
+            type='int', help='The number of rows read per query.'),
+    )
+    help = ("Set the national number of the MSISDNs and SendSMSs stored "
+            "before it was kept.")
+
+    def handle(self, *args, **options):
+        for model in [MSISDN, SendSMS]:
+            updated = self.backfill(model, options['chunk_size'])
+            self.stdout.write('Updated %s %s records\n' % (updated,
+                                model._meta.object_name))
+
+    def backfill(self, model, chunk_size):
+        updated = 0
+        last_pk = 0
+        while True:
+            rows = list(model.objects.filter(national_number__isnull=True,
+                            pk__gt=last_pk).order_by('pk')
+                            .values_list('pk', 'msisdn')[:chunk_size])
+            if not rows:
+                return updated
+            last_pk = rows[-1][0]
+            pks_per_number = {}
+            for pk, msisdn in rows:
+                number = national_number(msisdn)
+                if number:
+                    pks_per_number.setdefault(number, []).append(pk)
+            for number, pks in pks_per_number.items():
+                updated += model.objects.filter(pk__in=pks).update(
+                    national_number=number)
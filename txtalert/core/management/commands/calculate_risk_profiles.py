@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from txtalert.core.signals import calculate_risk_profiles
+
+class Command(BaseCommand):
+
+    help = ("Can be run as a cronjob or directly to recalculate the risk "
+            "profiles and last clinics of all patients.")
+
+    def handle(self, *args, **options):
+        updated = calculate_risk_profiles()
+        self.stdout.write('Updated %s patients\n' % updated)
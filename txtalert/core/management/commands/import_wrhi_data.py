@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from optparse import make_option
 from txtalert.core.wrhi_automation import import_patients, import_visits
+from txtalert.core.signals import defer_risk_profiles
 from django.conf import settings
 import sys
 
@@ -9,6 +10,11 @@ class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--endpoint', default=None, dest='endpoint',
             help='Specifies the endpoint to send the data to'),
+        make_option('--workers', default=3, type='int', dest='workers',
+            help='The number of visit feeds fetched concurrently'),
+        make_option('--full', action='store_true', dest='full',
+            help=('Fetch all the visits within three weeks of today instead '
+                  'of only the ones since the last import')),
     )
     help = "Can be run as a cronjob or directly to fetch and sync wrhi patient information."
 
@@ -27,4 +33,7 @@ class Command(BaseCommand):
             sys.exit('Invalid endpoint type provided. Options are qa and prod.')
 
         import_patients(endpoint)
-        import_visits(endpoint)
\ No newline at end of file
+        # the risk profiles are calculated in bulk after the import
+        with defer_risk_profiles():
+            import_visits(endpoint, workers=options['workers'],
+                          full=options['full'])
\ No newline at end of file
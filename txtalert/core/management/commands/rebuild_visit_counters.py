@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from txtalert.core.signals import rebuild_visit_counters, \
+    calculate_risk_profiles
+
+class Command(BaseCommand):
+
+    help = ("Rebuild the missed & attended visit counters of all patients "
+            "from the visit history and recalculate their risk profiles.")
+
+    def handle(self, *args, **options):
+        self.stdout.write('Rebuilt the counters of %s patients\n' %
+                            rebuild_visit_counters())
+        self.stdout.write('Updated the risk profiles of %s patients\n' %
+                            calculate_risk_profiles())
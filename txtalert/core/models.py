@@ -16,7 +16,7 @@
 
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, post_delete
 from dirtyfields import DirtyFieldsMixin
 from history.models import HistoricalRecords
 from datetime import date, timedelta
@@ -31,6 +31,9 @@ VISIT_STATUS_CHOICES = (
 
 class MSISDN(models.Model):
     msisdn = models.CharField('MSISDN', max_length=32, unique=True)
+    # the last 9 digits, for matching differently formatted numbers
+    national_number = models.CharField(max_length=9, null=True, blank=True,
+                                        db_index=True, editable=False)
 
     class Meta:
         verbose_name = 'Mobile Number'
@@ -159,6 +162,10 @@ class Patient(DirtyFieldsMixin, SoftDeleteMixin, models.Model):
     last_clinic = models.ForeignKey(Clinic, verbose_name='Clinic',
                                     blank=True, null=True)
     risk_profile = models.FloatField('Risk Profile', blank=True, null=True)
+    # the number of times a visit of this patient was marked as missed or
+    # attended, the risk profile is calculated from these
+    missed_visits = models.IntegerField(default=0)
+    attended_visits = models.IntegerField(default=0)
     language = models.ForeignKey(Language, verbose_name='Language',
                                  default=1, null=True, blank=True)
 
@@ -178,6 +185,10 @@ class Patient(DirtyFieldsMixin, SoftDeleteMixin, models.Model):
     # history of all patients
     history = HistoricalRecords()
 
+    # only changed with F() updates as visits are saved, a save of a stale
+    # patient mustn't undo them
+    VISIT_COUNTERS = ('missed_visits', 'attended_visits')
+
     class Meta:
         ordering = ['created_at']
         verbose_name = 'Patient'
@@ -186,6 +197,16 @@ class Patient(DirtyFieldsMixin, SoftDeleteMixin, models.Model):
     def __unicode__(self):
         return self.te_id
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        if update_fields is None and not force_insert and \
+                not self._state.adding and self.pk is not None:
+            update_fields = [field.name for field in self._meta.local_fields
+                             if not field.primary_key and
+                             field.name not in self.VISIT_COUNTERS]
+        return super(Patient, self).save(force_insert, force_update, using,
+                                         update_fields)
+
     def clinics(self):
         return set([visit.clinic for visit in
                     Visit.objects.filter(patient=self).order_by('-date')])
@@ -382,9 +403,17 @@ class ClinicNameMapping(models.Model):
 # signals
 from txtalert.core import signals
 from txtalert.apps.gateway.models import PleaseCallMe as GatewayPleaseCallMe
+from txtalert.apps.gateway.models import SendSMS as GatewaySendSMS
 
 pre_save.connect(signals.check_for_opt_in_changes_handler, sender=Patient)
 pre_save.connect(signals.find_clinic_for_please_call_me_handler, sender=PleaseCallMe)
 pre_save.connect(signals.update_active_msisdn_handler, sender=Patient)
+pre_save.connect(signals.track_visit_status_changes_handler, sender=Visit)
+pre_save.connect(signals.set_national_number_handler, sender=MSISDN)
+pre_save.connect(signals.set_national_number_handler, sender=GatewaySendSMS)
 post_save.connect(signals.track_please_call_me_handler, sender=GatewayPleaseCallMe)
 post_save.connect(signals.calculate_risk_profile_handler, sender=Visit)
+post_save.connect(signals.clear_message_type_cache_handler, sender=MessageType)
+post_delete.connect(signals.clear_message_type_cache_handler, sender=MessageType)
+post_save.connect(signals.clear_clinic_name_cache_handler, sender=ClinicNameMapping)
+post_delete.connect(signals.clear_clinic_name_cache_handler, sender=ClinicNameMapping)
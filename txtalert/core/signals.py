@@ -1,47 +1,64 @@
 from txtalert.core.models import PleaseCallMe, MSISDN, Visit, Patient
 from django.utils import timezone
 from datetime import datetime
-from django.db.models import Q
+from django.db.models import Q, F, Max, Count
+from txtalert.core.utils import national_number
+from contextlib import contextmanager
+import threading
 import logging
+import sys
+
+# the number of patients the deferred risk profiles are calculated for
+# per query
+RISK_PROFILE_CHUNK_SIZE = 500
+
+_deferred = threading.local()
 
 def track_please_call_me_handler(sender, **kwargs):
     if kwargs.get('created', False):
         return track_please_call_me(kwargs['instance'])
 
 def sloppy_get_or_create_possible_msisdn(sloppy_formatted_msisdn):
-    # if the msisdn is of fewer characters than 9 then don't normalize
+    # Assume the MSISDNs are always formatted as +27761234567, normalize
+    # to 761234567. It could be formatted as 27761234567,+27761234567 or
+    # 0761234567, the national number is the same for all of them.
+    number = national_number(sloppy_formatted_msisdn)
+    # if the msisdn has fewer digits than 9 then don't normalize
     # as it's a shortcode or a special number like 121 / voicemail.
-    if len(sloppy_formatted_msisdn) < 9:
+    if number is None:
         msisdn, created = MSISDN.objects.get_or_create(msisdn=sloppy_formatted_msisdn)
         return msisdn
 
-    # Assume the MSISDNs are always formatted as +27761234567, normalize
-    # to 761234567
-    end_of_msisdn = sloppy_formatted_msisdn[-9:]
-
-    # it could be formatted as 27761234567,+27761234567 or 0761234567
-    possible_msisdns = MSISDN.objects.filter(msisdn__endswith=end_of_msisdn)
-    if possible_msisdns.exists():
+    possible_msisdns = list(MSISDN.objects.filter(
+        national_number=number).annotate(
+            patients=Count('patient', distinct=True),
+            contacts_count=Count('contacts', distinct=True)))
+    if possible_msisdns:
         # priority for an MSISDN with a patient set
         for msisdn in possible_msisdns:
-            if msisdn.patient_set.exists():
+            if msisdn.patients:
                 return msisdn # just so you know what's going on
         # otherwise we'll settle for a patient that has used this MSISDN
         # previously
         for msisdn in possible_msisdns:
-            if msisdn.contacts.exists():
+            if msisdn.contacts_count:
                 return msisdn
 
         # all possible MSISDNs have no patients linked to them
         # if that's the case then just default to the most recent
         # MSISDN registered for that given number.
-        return possible_msisdns.latest('id')
+        return max(possible_msisdns, key=lambda msisdn: msisdn.id)
     # nothing matches, so create one
     else:
         msisdn, created = MSISDN.objects.get_or_create(msisdn=sloppy_formatted_msisdn)
         return msisdn
 
 
+def set_national_number_handler(sender, **kwargs):
+    instance = kwargs['instance']
+    instance.national_number = national_number(instance.msisdn)
+
+
 def track_please_call_me(opera_pcm):
     """Track a MSISDN we receive from a PCM back to a specific contact. This is
     tricky because MSISDNs in txtAlert are involved in all sorts of ManyToMany
@@ -87,23 +104,232 @@ def track_please_call_me(opera_pcm):
         logging.info("track_please_call_me: More than one contact found for MSISDN: %s" % msisdn)
 
 
+# the Patient counter kept for every counted visit status
+VISIT_STATUS_COUNTERS = {
+    'm': 'missed_visits',
+    'a': 'attended_visits',
+}
+
+def track_visit_status_changes_handler(sender, **kwargs):
+    return track_visit_status_changes(kwargs['instance'])
+
+def track_visit_status_changes(visit):
+    """Flag whether the visit's status changes with this save. This MUST be a
+    pre_save signal handler otherwise the dirty state tells us nothing."""
+    visit._status_changed = visit._state.adding or \
+                                'status' in visit.get_dirty_fields()
+
+
 def calculate_risk_profile_handler(sender, **kwargs):
     return calculate_risk_profile(kwargs['instance'])
 
 def calculate_risk_profile(visit):
-    """Calculate the risk profile of the patient after the latest visit has been
-    saved to the database. This MUST be a post_save signal handler otherwise
-    the calculation will always be one visit short."""
+    """Count the visit's status change on the patient and calculate the risk
+    profile of the patient after the latest visit has been saved to the
+    database. This MUST be a post_save signal handler otherwise the
+    calculation will always be one visit short."""
+    counter = None
+    if getattr(visit, '_status_changed', False):
+        counter = VISIT_STATUS_COUNTERS.get(visit.status)
+    visit._status_changed = False
+    # the next status change is relative to what was saved now
+    visit._reset_state()
+
+    deferred_counters = getattr(_deferred, 'counters', None)
+    if deferred_counters is not None:
+        counters = deferred_counters.setdefault(visit.patient_id,
+                        dict.fromkeys(VISIT_STATUS_COUNTERS.values(), 0))
+        if counter:
+            counters[counter] += 1
+        return
+    # increment in the database, the patient loaded with the visit is stale
+    # when other visits of the same patient are saved concurrently and its
+    # save leaves the counters out
+    patients = Patient.all_objects.filter(pk=visit.patient_id)
+    if counter:
+        patients.update(**{counter: F(counter) + 1})
     patient = visit.patient
+    patient.missed_visits, patient.attended_visits = patients.values_list(
+        'missed_visits', 'attended_visits').get()
     patient.last_clinic = patient.get_last_clinic()
-    missed_visits = Visit.history.filter(patient=patient, status='m').count()
-    attended_visits = Visit.history.filter(patient=patient, status='a').count()
+    patient.risk_profile = risk_profile(patient.missed_visits,
+                                        patient.attended_visits)
+    patient.save()
+
+def risk_profile(missed_visits, attended_visits):
     total_visits = missed_visits + attended_visits
     if total_visits == 0:
-        patient.risk_profile = 0
-    else:
-        patient.risk_profile =  float(missed_visits) / total_visits
-    patient.save()
+        return 0
+    return float(missed_visits) / total_visits
+
+
+@contextmanager
+def defer_risk_profiles():
+    """Only count the status changes of the visits saved in this block and
+    update the counters & risk profiles of their patients in bulk at the
+    end, for imports. The visits saved before an exception are counted
+    too."""
+    if getattr(_deferred, 'counters', None) is not None:
+        # nested, the outermost block does the calculation
+        yield
+        return
+    _deferred.counters = {}
+    try:
+        yield
+    except:
+        exc_info = sys.exc_info()
+        try:
+            apply_deferred_counters()
+        except Exception:
+            logging.exception('Unable to update the deferred risk profiles')
+        raise exc_info[0], exc_info[1], exc_info[2]
+    apply_deferred_counters()
+
+def apply_deferred_counters():
+    deferred_counters, _deferred.counters = _deferred.counters, None
+    increment_counters(deferred_counters)
+    calculate_risk_profiles(deferred_counters.keys())
+
+def increment_counters(counters_per_patient):
+    """Add the counts to the patients' visit counters with an UPDATE per
+    distinct set of increments"""
+    pks_per_increments = {}
+    for patient_id, counters in counters_per_patient.items():
+        increments = tuple(sorted(counters.items()))
+        if any(count for _, count in increments):
+            pks_per_increments.setdefault(increments, []).append(patient_id)
+    for increments, pks in pks_per_increments.items():
+        for offset in range(0, len(pks), RISK_PROFILE_CHUNK_SIZE):
+            Patient.all_objects.filter(
+                pk__in=pks[offset:offset + RISK_PROFILE_CHUNK_SIZE]).update(
+                    **dict((counter, F(counter) + count)
+                            for counter, count in increments))
+
+@contextmanager
+def keep_deferred_counters():
+    """Restore the deferred counters if the block raises, for when the
+    visits saved in it are rolled back."""
+    deferred_counters = getattr(_deferred, 'counters', None)
+    if deferred_counters is None:
+        yield
+        return
+    saved = dict((patient_id, dict(counters))
+                    for patient_id, counters in deferred_counters.items())
+    try:
+        yield
+    except:
+        _deferred.counters = saved
+        raise
+
+def queue_risk_profiles(patient_ids):
+    """Recalculate the risk profiles of patients whose visits were written
+    without signals, at the end of the `defer_risk_profiles` block if
+    there is one and right away otherwise."""
+    deferred_counters = getattr(_deferred, 'counters', None)
+    if deferred_counters is None:
+        return calculate_risk_profiles(patient_ids)
+    for patient_id in patient_ids:
+        deferred_counters.setdefault(patient_id,
+                        dict.fromkeys(VISIT_STATUS_COUNTERS.values(), 0))
+
+def queue_visit_counts(visits):
+    """Count the statuses of visits created without signals, with
+    `bulk_create`, for their patients and recalculate their risk profiles,
+    at the end of the `defer_risk_profiles` block if there is one and
+    right away otherwise."""
+    counted = {}
+    for visit in visits:
+        counters = counted.setdefault(visit.patient_id,
+                        dict.fromkeys(VISIT_STATUS_COUNTERS.values(), 0))
+        counter = VISIT_STATUS_COUNTERS.get(visit.status)
+        if counter:
+            counters[counter] += 1
+    deferred_counters = getattr(_deferred, 'counters', None)
+    if deferred_counters is None:
+        increment_counters(counted)
+        return calculate_risk_profiles(counted.keys())
+    for patient_id, counters in counted.items():
+        deferred = deferred_counters.setdefault(patient_id,
+                        dict.fromkeys(VISIT_STATUS_COUNTERS.values(), 0))
+        for counter, count in counters.items():
+            deferred[counter] += count
+
+def calculate_risk_profiles(patient_ids=None):
+    """Calculate the risk profiles & last clinics the same way
+    `calculate_risk_profile` does, for the given patients or for all of them,
+    with a few queries per chunk of patients. Only the changed patients
+    are written, with an UPDATE per distinct pair of values and without
+    historical records. Returns the number of patients updated."""
+    if patient_ids is None:
+        patient_ids = Patient.all_objects.values_list('pk', flat=True)
+    patient_ids = sorted(patient_ids)
+    updated = 0
+    for offset in range(0, len(patient_ids), RISK_PROFILE_CHUNK_SIZE):
+        chunk = patient_ids[offset:offset + RISK_PROFILE_CHUNK_SIZE]
+        latest_visits = Visit.objects.filter(patient__in=chunk) \
+                            .values('patient').annotate(latest=Max('id')) \
+                            .values_list('latest', flat=True).order_by()
+        last_clinics = dict(Visit.objects.filter(pk__in=list(latest_visits))
+                                .values_list('patient', 'clinic'))
+        pks_per_values = {}
+        current = Patient.all_objects.filter(pk__in=chunk) \
+                    .values_list('pk', 'risk_profile', 'last_clinic',
+                                    'missed_visits', 'attended_visits')
+        for (patient_id, current_risk_profile, last_clinic_id,
+                missed_visits, attended_visits) in current:
+            values = (risk_profile(missed_visits, attended_visits),
+                        last_clinics.get(patient_id))
+            if values != (current_risk_profile, last_clinic_id):
+                pks_per_values.setdefault(values, []).append(patient_id)
+        for (profile, last_clinic_id), pks in pks_per_values.items():
+            updated += Patient.all_objects.filter(pk__in=pks).update(
+                risk_profile=profile, last_clinic=last_clinic_id)
+    return updated
+
+def rebuild_visit_counters():
+    """Rebuild the missed & attended counters of all patients from the
+    visit history, reading it once in order. Every change of a visit's
+    status to missed or attended counts, the same as when the counters
+    are kept up to date on save. Returns the number of patients updated."""
+    history = Visit.history.order_by('id', 'history_id') \
+                .values_list('id', 'patient', 'status').iterator()
+    counts = {}
+    last_visit_id = last_status = None
+    for visit_id, patient_id, status in history:
+        if visit_id != last_visit_id:
+            last_visit_id, last_status = visit_id, None
+        if status != last_status and status in VISIT_STATUS_COUNTERS:
+            counters = counts.setdefault(patient_id,
+                            dict.fromkeys(VISIT_STATUS_COUNTERS.values(), 0))
+            counters[VISIT_STATUS_COUNTERS[status]] += 1
+        last_status = status
+
+    pks_per_counters = {}
+    current = Patient.all_objects.values_list('pk', 'missed_visits',
+                                                'attended_visits').iterator()
+    for patient_id, missed_visits, attended_visits in current:
+        counters = counts.get(patient_id, {})
+        values = (counters.get('missed_visits', 0),
+                    counters.get('attended_visits', 0))
+        if values != (missed_visits, attended_visits):
+            pks_per_counters.setdefault(values, []).append(patient_id)
+    updated = 0
+    for (missed_visits, attended_visits), pks in pks_per_counters.items():
+        for offset in range(0, len(pks), RISK_PROFILE_CHUNK_SIZE):
+            updated += Patient.all_objects.filter(
+                pk__in=pks[offset:offset + RISK_PROFILE_CHUNK_SIZE]).update(
+                    missed_visits=missed_visits,
+                    attended_visits=attended_visits)
+    return updated
+
+
+def clear_message_type_cache_handler(sender, **kwargs):
+    from txtalert.core.caches import message_types
+    message_types.clear()
+
+def clear_clinic_name_cache_handler(sender, **kwargs):
+    from txtalert.core.caches import clinic_names
+    clinic_names.clear()
 
 
 def check_for_opt_in_changes_handler(sender, **kwargs):
@@ -3,9 +3,13 @@ from uuid import uuid4
 from django.contrib.admin.sites import AdminSite
 from django.contrib.auth.models import User, Group
 from django.test import RequestFactory
+from django.utils import timezone
+from mock import patch
 
 from txtalert.core.clinic_admin import VisitAdmin, PatientAdmin
-from txtalert.core.models import Visit, Clinic, Patient
+from txtalert.core.admin import PatientAdmin as CorePatientAdmin
+from txtalert.core.models import Visit, Clinic, Patient, MSISDN
+from txtalert.apps.gateway.models import SendSMS
 from txtalert.core.tests.base import BaseTxtAlertTestCase
 
 
@@ -159,3 +163,42 @@ class PatientAdminTestCase(ClinicAdminTestCase):
 
         patient = Patient.objects.get(pk=patient.pk)
         self.assertEqual(patient.owner, self.clinic1.user)
+
+
+class PatientScheduleTestCase(BaseTxtAlertTestCase):
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            'admin', 'admin@admin.com', password='admin')
+        self.model_admin = CorePatientAdmin(Patient, AdminSite())
+
+    def send_sms(self, msisdn):
+        return SendSMS.objects.create(
+            msisdn=msisdn, smstext='smstext', delivery=timezone.now(),
+            expiry=timezone.now(), priority='Standard', receipt='Y',
+            identifier=uuid4().hex[:8], user=self.admin_user)
+
+    def scheduled_smss(self, patient):
+        request = RequestFactory().get('/')
+        request.user = self.admin_user
+        with patch('txtalert.core.admin.render') as render:
+            self.model_admin.schedule_view(request, patient.pk)
+        return set(render.call_args[0][2]['smss'])
+
+    def test_schedule_short_code(self):
+        smss = [self.send_sms(msisdn)
+                for msisdn in ['*120*321#', '*121*3210#', '27123456789']]
+        msisdn = MSISDN.objects.create(msisdn='*121*3210#')
+        patient = Patient.objects.create(owner=self.admin_user,
+                                         te_id=uuid4().hex,
+                                         active_msisdn=msisdn)
+        self.assertEqual(self.scheduled_smss(patient), set([smss[1]]))
+
+    def test_schedule_national_number(self):
+        smss = [self.send_sms(msisdn)
+                for msisdn in ['0123456789', '27123456789', '27987654321']]
+        msisdn = MSISDN.objects.create(msisdn='+27123456789')
+        patient = Patient.objects.create(owner=self.admin_user,
+                                         te_id=uuid4().hex,
+                                         active_msisdn=msisdn)
+        self.assertEqual(self.scheduled_smss(patient), set(smss[:2]))
@@ -1,6 +1,7 @@
 from django.test import TestCase
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import Group, User
 from django.utils import timezone
+from django.db import DatabaseError
 from datetime import datetime
 from txtalert.core.models import *
 from mock import patch
@@ -181,6 +182,45 @@ class PleaseCallMeTestCase(TestCase):
             '27123456121'
         )
 
+    def test_sloppy_get_or_create_possible_msisdn_few_digits(self):
+        from txtalert.core.signals import sloppy_get_or_create_possible_msisdn
+        # shortcodes have no national number, they don't match each other
+        MSISDN.objects.create(msisdn='*120*321#')
+        msisdn = sloppy_get_or_create_possible_msisdn('*121*3210#')
+        self.assertEquals(msisdn.msisdn, '*121*3210#')
+        self.assertEquals(msisdn.national_number, None)
+        self.assertEquals(
+            sloppy_get_or_create_possible_msisdn('*121*3210#'), msisdn)
+
+    def test_sloppy_get_or_create_possible_msisdn_priority(self):
+        from txtalert.core.signals import sloppy_get_or_create_possible_msisdn
+        contact = MSISDN.objects.create(msisdn='0123456122')
+        self.patient.msisdns.add(contact)
+        MSISDN.objects.create(msisdn='+27123456122')
+        # a contact before the most recent number, in one query
+        with self.assertNumQueries(1):
+            self.assertEquals(
+                sloppy_get_or_create_possible_msisdn('27123456122'), contact)
+        active = MSISDN.objects.create(msisdn='27123456122')
+        self.patient.active_msisdn = active
+        self.patient.save()
+        self.assertEquals(
+            sloppy_get_or_create_possible_msisdn('0123456122'), active)
+
+    def test_backfill_national_numbers(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        MSISDN.objects.create(msisdn='+27123456123')
+        MSISDN.objects.update(national_number=None)
+        call_command('backfill_national_numbers', chunk_size=2,
+                        stdout=StringIO())
+        self.assertEquals(
+            MSISDN.objects.get(msisdn='+27123456123').national_number,
+            '123456123')
+        self.assertFalse(MSISDN.objects.filter(national_number__isnull=True,
+                                                msisdn__startswith='27')
+                                        .exists())
+
 
 class ClinicMappingTestCase(TestCase):
     fixtures = ['clinics']
@@ -197,6 +237,60 @@ class ClinicMappingTestCase(TestCase):
 
         self.assertEquals(clinic.pk, db_clinic.pk)
 
+    def test_clinic_name_cache(self):
+        from txtalert.core.caches import clinic_names
+        from txtalert.core.wrhi_automation import map_clinic
+        clinic = Clinic.objects.get(name='Test Clinic')
+        clinic_map = ClinicNameMapping.objects.create(
+            wrhi_clinic_name='Test_Clinic_External',
+            clinic=clinic)
+
+        self.assertEquals(map_clinic('test_clinic_external'), clinic_map)
+        with self.assertNumQueries(0):
+            self.assertEquals(map_clinic('TEST_CLINIC_EXTERNAL'), clinic_map)
+            # the same once punctuation & whitespace are ignored
+            self.assertEquals(map_clinic('Test Clinic  External'),
+                              clinic_map)
+            # and the unknown ones are remembered
+            self.assertEquals(map_clinic('Elsewhere'), None)
+            self.assertEquals(map_clinic('Elsewhere'), None)
+        self.assertEquals(clinic_names.stats()['size'], 3)
+
+        # new mappings are picked up
+        other_map = ClinicNameMapping.objects.create(
+            wrhi_clinic_name='Elsewhere', clinic=clinic)
+        self.assertEquals(map_clinic('elsewhere'), other_map)
+
+    def test_clinic_name_cache_sister_clinics(self):
+        from txtalert.core.caches import clinic_names
+        from txtalert.core.wrhi_automation import map_clinic
+        clinic = Clinic.objects.get(name='Test Clinic')
+        clinic_names.clear()
+        clinic_map = ClinicNameMapping.objects.create(
+            wrhi_clinic_name='Zola Clinic 1', clinic=clinic)
+
+        self.assertEquals(map_clinic('zola-clinic-1'), clinic_map)
+        self.assertEquals(map_clinic('Zola Clinic 2'), None)
+        self.assertEquals(map_clinic('Zola Clinic 12'), None)
+        self.assertEquals(map_clinic('Zola Clinics 1'), None)
+
+    def test_clinic_name_cache_cleared_per_import(self):
+        from txtalert.core.caches import clinic_names
+        from txtalert.core.wrhi_automation import map_clinic, import_visits
+        clinic = Clinic.objects.get(name='Test Clinic')
+        clinic_names.clear()
+        self.assertEquals(map_clinic('Elsewhere'), None)
+        # mapped by another process, the signal doesn't reach this one
+        with patch.object(clinic_names, 'clear'):
+            clinic_map = ClinicNameMapping.objects.create(
+                wrhi_clinic_name='Elsewhere', clinic=clinic)
+        self.assertEquals(map_clinic('Elsewhere'), None)
+
+        with patch('txtalert.core.wrhi_automation.fetch_visit_data',
+                   return_value=[]):
+            import_visits('test')
+        self.assertEquals(map_clinic('Elsewhere'), clinic_map)
+
 
 class ImportPatientsTestCase(TestCase):
     fixtures = ['clinics', 'users']
@@ -685,6 +779,183 @@ class ImportVisitsTestCase(TestCase):
             self.assertEquals(v.date,date(2014, 12, 11))
             self.assertEquals(v.status, 's')
 
+    def test_batched_visit_import(self):
+        from txtalert.core.wrhi_automation import (VisitInc, process_visits,
+                                                   MISSED_VISIT)
+        clinic = Clinic.objects.get(name='Test Clinic')
+        ClinicNameMapping.objects.create(
+            wrhi_clinic_name='Test_Clinic_External',
+            clinic=clinic
+        )
+        owner = User.objects.get(username='admin')
+        te_ids = ['ES0004%s' % i for i in range(5)]
+        for te_id in te_ids:
+            Patient.objects.create(owner=owner, te_id=te_id)
+
+        rows = [VisitInc({
+            "Ptd_No": te_id,
+            "Visit_date": "2014-08-12T00:00:00",
+            "Next_tcb": "2014-09-12T00:00:00",
+            "Facility_name": "TEST_CLINIC_EXTERNAL",
+        }) for te_id in te_ids]
+        # a savepoint for the patients, mappings & visits, a savepoint for
+        # the insert, the inserted pks, the history, the counters and the
+        # risk profiles, no matter how many rows there are
+        with self.assertNumQueries(15):
+            new_visits = process_visits(rows, MISSED_VISIT)
+        self.assertEquals(len(new_visits), len(te_ids))
+
+        for te_id in te_ids:
+            v = Visit.objects.get(patient__te_id=te_id)
+            self.assertEquals(v.date, date(2014, 8, 12))
+            self.assertEquals(v.status, 'm')
+            self.assertEquals(v.wrhi_orig_date, date(2014, 8, 12))
+            self.assertEquals(v.history.get().history_type, '+')
+            self.assertEquals(v.patient.missed_visits, 1)
+            self.assertEquals(v.patient.risk_profile, 1.0)
+
+        # the next run matches them
+        self.assertEquals(process_visits(rows, MISSED_VISIT), [])
+        self.assertEquals(Visit.objects.filter(
+            patient__te_id__in=te_ids).count(), len(te_ids))
+
+    def test_batched_visit_import_failed_insert(self):
+        from txtalert.core.wrhi_automation import (VisitInc, process_visits,
+                                                   MISSED_VISIT)
+        clinic = Clinic.objects.get(name='Test Clinic')
+        ClinicNameMapping.objects.create(
+            wrhi_clinic_name='Test_Clinic_External',
+            clinic=clinic
+        )
+        patient = Patient.objects.create(
+            owner=User.objects.get(username='admin'), te_id='ES00044')
+        visit = Visit.objects.create(patient=patient, clinic=clinic,
+                                     date=date(2014, 8, 12), status='s')
+        rows = [VisitInc({
+            "Ptd_No": "ES00044",
+            "Visit_date": "2014-08-12T00:00:00",
+            "Next_tcb": "2014-09-12T00:00:00",
+            "Facility_name": "TEST_CLINIC_EXTERNAL",
+        })]
+        with patch.object(Visit.objects, 'bulk_create',
+                          side_effect=DatabaseError('gone away')):
+            self.assertRaises(DatabaseError, process_visits, rows,
+                              MISSED_VISIT)
+        # the missed visit is kept, the next visit wasn't created
+        self.assertEquals(Visit.objects.get(pk=visit.pk).status, 'm')
+        self.assertFalse(Visit.objects.filter(
+            patient=patient, date=date(2014, 9, 12)).exists())
+
+    def test_batched_visit_import_concurrent_insert(self):
+        from txtalert.core.wrhi_automation import (VisitInc, process_visits,
+                                                   MISSED_VISIT)
+        clinic = Clinic.objects.get(name='Test Clinic')
+        ClinicNameMapping.objects.create(
+            wrhi_clinic_name='Test_Clinic_External',
+            clinic=clinic
+        )
+        owner = User.objects.get(username='admin')
+        patient = Patient.objects.create(owner=owner, te_id='ES00044')
+        other = Patient.objects.create(owner=owner, te_id='ES00045')
+        rows = [VisitInc({
+            "Ptd_No": "ES00044",
+            "Visit_date": "2014-08-12T00:00:00",
+            "Facility_name": "TEST_CLINIC_EXTERNAL",
+        })]
+        bulk_create = Visit.objects.bulk_create
+        concurrent = []
+
+        def insert_concurrently(*args, **kwargs):
+            # another import inserts visits while this one runs
+            concurrent.extend([
+                Visit.objects.create(patient=other, clinic=clinic,
+                                     date=date(2014, 8, 12), status='s'),
+                Visit.objects.create(patient=patient, clinic=clinic,
+                                     date=date(2014, 8, 13), status='s')])
+            return bulk_create(*args, **kwargs)
+
+        with patch.object(Visit.objects, 'bulk_create',
+                          side_effect=insert_concurrently):
+            [new_visit] = process_visits(rows, MISSED_VISIT)
+        self.assertNotIn(new_visit.pk, [visit.pk for visit in concurrent])
+        inserted = Visit.objects.get(pk=new_visit.pk)
+        self.assertEquals((inserted.patient, inserted.date),
+                          (patient, date(2014, 8, 12)))
+        self.assertEquals(inserted.history.get().history_type, '+')
+
+    def test_incremental_visit_import(self):
+        from txtalert.apps.general.settings.models import Setting
+        from txtalert.core.wrhi_automation import (import_visits,
+            VISIT_TYPES, VISIT_WINDOW, VISIT_WINDOW_OVERLAP,
+            LAST_VISIT_IMPORT, COMING_VISIT)
+        group = Group.objects.create(name='WRHI')
+        User.objects.get(username='admin').groups.add(group)
+        calls = []
+
+        def fetch_visit_data(endpoint, visit_type, date_from, date_to,
+                             session):
+            calls.append((visit_type, date_from, date_to))
+            return []
+
+        with patch('txtalert.core.wrhi_automation.fetch_visit_data',
+                   side_effect=fetch_visit_data):
+            import_visits('test', workers=3)
+            self.assertEquals(sorted(visit_type for visit_type, _, _ in calls),
+                              VISIT_TYPES)
+            _, date_from, date_to = calls[0]
+            self.assertEquals(date_to - date_from, VISIT_WINDOW * 2)
+
+            last_import = Setting.objects.get(name=LAST_VISIT_IMPORT)
+            last_import_date = date_to - VISIT_WINDOW
+            self.assertEquals(last_import.text_value,
+                              last_import_date.isoformat())
+
+            # the next import starts where this one left off for the coming
+            # visits, the missed & done visits are always fetched in full
+            del calls[:]
+            import_visits('test', workers=3)
+            for visit_type, date_from, date_to in calls:
+                if visit_type == COMING_VISIT:
+                    self.assertEquals(date_from,
+                                      last_import_date - VISIT_WINDOW_OVERLAP)
+                else:
+                    self.assertEquals(date_to - date_from, VISIT_WINDOW * 2)
+
+    def test_late_missed_visit_import(self):
+        from txtalert.core.wrhi_automation import import_visits, MISSED_VISIT
+        group = Group.objects.create(name='WRHI')
+        User.objects.get(username='admin').groups.add(group)
+        clinic = Clinic.objects.get(name='Test Clinic')
+        ClinicNameMapping.objects.create(
+            wrhi_clinic_name='Test_Clinic_External',
+            clinic=clinic
+        )
+        patient = Patient.objects.create(
+            owner=User.objects.get(username='admin'), te_id='ES00044')
+        visit_date = date.today() - timedelta(days=10)
+        visit = Visit.objects.create(patient=patient, clinic=clinic,
+                                     date=visit_date, status='s')
+        missed = []
+
+        def fetch_visit_data(endpoint, visit_type, date_from, date_to,
+                             session):
+            # the feed only has the rows within the dates asked for
+            if visit_type != MISSED_VISIT:
+                return []
+            return [row for row in missed
+                    if date_from.date() <= visit_date <= date_to.date()]
+
+        with patch('txtalert.core.wrhi_automation.fetch_visit_data',
+                   side_effect=fetch_visit_data):
+            import_visits('test')
+            # entered more than a day after the visit and the last import
+            missed.append({
+                "Ptd_No": "ES00044",
+                "Visit_date": visit_date.strftime('%Y-%m-%dT00:00:00'),
+                "Facility_name": "TEST_CLINIC_EXTERNAL",
+            })
+            import_visits('test')
+        self.assertEquals(Visit.objects.get(pk=visit.pk).status, 'm')
 
     def test_fetch_visit_data(self):
         with patch('requests.get') as mock_get:
@@ -24,6 +24,14 @@ def normalize_msisdn(raw):
         return raw
     return '27' + raw
 
+def national_number(msisdn):
+    """The last 9 digits of an MSISDN, the same for 27761234567,
+    +27761234567 and 0761234567. None for shortcodes & special numbers."""
+    digits = ''.join([c for c in (msisdn or '') if c.isdigit()])
+    if len(digits) < 9:
+        return None
+    return digits[-9:]
+
 class MuninCommand(BaseCommand):
     def handle(self, *args, **kwargs):
         if args and args[0] == "config":
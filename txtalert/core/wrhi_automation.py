@@ -1,10 +1,15 @@
-from txtalert.core.models import Patient, ClinicNameMapping, MSISDN, Visit
+from txtalert.core.models import Patient, MSISDN, Visit
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import transaction
+from django.utils import timezone
 from datetime import datetime, timedelta
 from dateutil.parser import parse as date_util_parse
 from txtalert.apps.general.settings.models import Setting
+from txtalert.core.signals import queue_visit_counts
+from txtalert.core.caches import clinic_names
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 import requests
 import logging
 import re
@@ -16,6 +21,29 @@ COMING_VISIT = 1
 MISSED_VISIT = 2
 DONE_VISIT = 3
 
+VISIT_FEEDS = {
+    COMING_VISIT: 'ComingVisits',
+    MISSED_VISIT: 'MissedVisits',
+    DONE_VISIT: 'DoneVisits',
+}
+# the order the visit feeds are processed in
+VISIT_TYPES = [COMING_VISIT, MISSED_VISIT, DONE_VISIT]
+
+# the visits are fetched for this far back & ahead of today
+VISIT_WINDOW = timedelta(weeks=3)
+# unless the visits were imported successfully since, then they're only
+# fetched from then on, less this overlap for rows that came in late
+VISIT_WINDOW_OVERLAP = timedelta(days=1)
+# the feeds fetched from the last successful import on, missed & done
+# visits are entered days after the visit date and always fetched for the
+# whole VISIT_WINDOW
+INCREMENTAL_VISIT_TYPES = [COMING_VISIT]
+# the Setting the start of the last successful visit import is kept in
+LAST_VISIT_IMPORT = 'WRHI_LAST_VISIT_IMPORT'
+
+# the number of values per `__in` lookup when loading a batch of visits
+BATCH_CHUNK_SIZE = 500
+
 
 class VisitInc:
     ptd_no = None
@@ -94,29 +122,19 @@ class VisitInc:
 
 
 def map_clinic(clinic_name):
-    clinic_map = ClinicNameMapping.objects.select_related().filter(wrhi_clinic_name__iexact=clinic_name).first()
-
-    if clinic_map:
-        return clinic_map
-    else:
-        return None
+    return clinic_names.get(clinic_name)
 
 
-def fetch_visit_data(endpoint, visit_type):
-    if visit_type == COMING_VISIT:
-        func = 'ComingVisits'
-    elif visit_type == MISSED_VISIT:
-        func = 'MissedVisits'
-    elif visit_type == DONE_VISIT:
-        func = 'DoneVisits'
-    else:
+def fetch_visit_data(endpoint, visit_type, date_from=None, date_to=None,
+                     session=None):
+    if visit_type not in VISIT_FEEDS:
         raise Exception('Incorrect type specified expecting 1,2 or 3 got %s'
                         % visit_type)
+    func = VISIT_FEEDS[visit_type]
 
     date_now = datetime.now()
-    three_weeks = timedelta(weeks=3)
-    date_from = date_now - three_weeks
-    date_to = date_now + three_weeks
+    date_from = date_from or date_now - VISIT_WINDOW
+    date_to = date_to or date_now + VISIT_WINDOW
 
     logger.info('Fetch %s data for %s - %s' % (func, date_from, date_to))
 
@@ -124,7 +142,7 @@ def fetch_visit_data(endpoint, visit_type):
         '?dateFrom=' + date_from.strftime('%Y_%m_%d') + \
         '&dateTo=' + date_to.strftime('%Y_%m_%d')
 
-    result = requests.get(url)
+    result = (session or requests).get(url)
 
     if result.status_code == 200:
         return result.json()
@@ -132,6 +150,70 @@ def fetch_visit_data(endpoint, visit_type):
         result.raise_for_status()
 
 
+def fetch_all_visit_data(endpoint, windows, workers=1):
+    """Fetch the data of all the VISIT_TYPES over one session, concurrently
+    if there's more than one worker. `windows` has the (date_from, date_to)
+    to fetch per visit type. Returns a (visit_type, data, error) tuple per
+    visit type, in order."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max(workers, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def fetch(visit_type):
+        date_from, date_to = windows[visit_type]
+        try:
+            return visit_type, fetch_visit_data(endpoint, visit_type,
+                                                date_from, date_to,
+                                                session), None
+        except Exception as ex:
+            return visit_type, None, ex
+
+    try:
+        if workers > 1:
+            pool = ThreadPool(min(workers, len(VISIT_TYPES)))
+            try:
+                return pool.map(fetch, VISIT_TYPES)
+            finally:
+                pool.close()
+                pool.join()
+        return map(fetch, VISIT_TYPES)
+    finally:
+        session.close()
+
+
+def visit_window(date_now, visit_type=COMING_VISIT):
+    """The dates to fetch the visits of the type for, from the last
+    successful import on if that was less than VISIT_WINDOW ago and the
+    type is one of the INCREMENTAL_VISIT_TYPES."""
+    date_from = date_now - VISIT_WINDOW
+    if visit_type not in INCREMENTAL_VISIT_TYPES:
+        return date_from, date_now + VISIT_WINDOW
+    setting = Setting.objects.filter(name=LAST_VISIT_IMPORT).first()
+    if setting and setting.text_value:
+        try:
+            last_import = date_util_parse(setting.text_value)
+        except (ValueError, OverflowError):
+            last_import = None
+        if last_import:
+            date_from = max(date_from, last_import - VISIT_WINDOW_OVERLAP)
+    return date_from, date_now + VISIT_WINDOW
+
+
+def save_last_visit_import(owner, date_now):
+    setting = Setting.objects.filter(name=LAST_VISIT_IMPORT).first()
+    if setting is None:
+        group = owner.groups.first()
+        if group is None:
+            logger.warning('wrhi_automation::save_last_visit_import: %s has '
+                           'no group to keep the last visit import for, '
+                           'the next import fetches all visits' % owner)
+            return
+        setting = Setting(name=LAST_VISIT_IMPORT, type='t', group=group)
+    setting.text_value = date_now.isoformat()
+    setting.save()
+
+
 def check_orig_date(patient, clinic, date):
     # Check to see if the new
     visits = Visit.objects.filter(
@@ -345,45 +427,305 @@ def process_visit(v, visit_type):
                        % (visit_type, v.ptd_no, v.facility_name, traceback.format_exc()))
 
 
-def import_visits(endpoint):
-    logger.info('wrhi_automation::import_visits: Started')
-    owner = User.objects.filter(username=settings.WRHI_IMPORT_USER).first()
+def in_chunks(queryset, field, values):
+    """Filter the queryset on `field__in` per chunk of values"""
+    values = list(values)
+    for offset in range(0, len(values), BATCH_CHUNK_SIZE):
+        for result in queryset.filter(**{
+                '%s__in' % field: values[offset:offset + BATCH_CHUNK_SIZE]}):
+            yield result
+
+
+def as_date(d):
+    if isinstance(d, datetime):
+        return d.date()
+    return d
+
+
+class VisitBatch(object):
+    """Reconciles the rows of a visit feed in memory the way `process_visit`
+    does against the database. The patients and the visits the rows refer
+    to are loaded up front, the clinics come from the `clinic_names` cache. Changed visits are
+    saved as they change, new visits are inserted by `save`."""
+
+    def __init__(self, rows):
+        te_ids = set(v.ptd_no for v in rows if v.ptd_no is not None)
+        # the first one, like `.first()` would find
+        self.patients = {}
+        for patient in in_chunks(Patient.all_objects.all(), 'te_id', te_ids):
+            self.patients.setdefault(patient.te_id, patient)
+        patients_by_pk = dict((patient.pk, patient)
+                              for patient in self.patients.values())
+        fields = [field.attname for field in Visit._meta.concrete_fields]
+        self.visits = {}
+        rows = in_chunks(Visit.objects.order_by('date', 'pk')
+                         .values_list(*fields), 'patient',
+                         patients_by_pk.keys())
+        for row in rows:
+            row = dict(zip(fields, row))
+            # give it its patient, saves looking it up when the Visit is
+            # initialized
+            row['patient'] = patients_by_pk[row.pop('patient_id')]
+            visit = Visit(**row)
+            visit._state.adding = False
+            visit._state.db = Visit.objects.db
+            self.visits.setdefault((visit.patient_id, visit.clinic_id),
+                                   []).append(visit)
+        self.new_visits = []
+
+    def create_visit(self, patient, clinic, date=None, status=None):
+        """Queue a new visit unless one exists already, like
+        `create_visit`"""
+        date = as_date(date)
+        visits = self.visits.setdefault((patient.pk, clinic.pk), [])
+        if any(visit.wrhi_orig_date == date for visit in visits):
+            return
+        if any(date is None or visit.date == date for visit in visits):
+            return
+        if date is None:
+            raise ValueError('A visit needs a date')
+        visit = Visit(patient=patient, clinic=clinic, date=date,
+                      status=status or '', wrhi_orig_date=date)
+        visits.append(visit)
+        self.new_visits.append(visit)
+        logger.info("Visit created.")
+        return visit
+
+    def save_visit(self, visit):
+        # the new ones are inserted by `save`
+        if visit.pk is not None:
+            with transaction.atomic():
+                visit.save()
+
+    def process(self, v, visit_type):
+        try:
+            self.reconcile(v, visit_type)
+        except Exception:
+            logger.warning('wrhi_automation::process_visit: Failed to process '
+                           'visit of type %s for Ptd_No %s Clinic %s. '
+                           'Reason : %s'
+                           % (visit_type, v.ptd_no, v.facility_name,
+                              traceback.format_exc()))
+
+    def reconcile(self, v, visit_type):
+        if v.ptd_no is None:
+            logger.warning('wrhi_automation::process_visit: Visit has no '
+                           'Ptd_No - skipping visit')
+            return
+
+        db_patient = self.patients.get(v.ptd_no)
+
+        if db_patient is None:
+            logger.warning('wrhi_automation::process_visit: Can''t find '
+                           'Patient with Ptd_No %s - skipping visit'
+                           % v.ptd_no)
+            return
+
+        if db_patient.deleted:
+            logger.warning('wrhi_automation::process_visit: Patient '
+                           'with Ptd_No %s has been deleted - '
+                           'skipping visit' % v.ptd_no)
+            return
+
+        db_clinic = map_clinic(v.facility_name)
+
+        if db_clinic is None:
+            logger.warning('wrhi_automation::process_visit: Clinic mapping'
+                           ' failed for wrhi clinic %s - skipping visit'
+                           % v.facility_name)
+            return
+
+        clinic = db_clinic.clinic
+        # the visits created while processing this row aren't matched
+        visits = list(self.visits.get((db_patient.pk, clinic.pk), []))
+        found_visit = False
+
+        if visits:
+            if visit_type == COMING_VISIT:
+                search_date = v.get_visit_date()
 
-    if owner is None:
-        logger.error('Configuration error. WRHI_IMPORT_USER has not been set')
-        return
+                if search_date is None:
+                    search_date = v.get_next_tcb()
+            else:
+                search_date = v.get_visit_date()
 
-    data = None
+            if search_date is None:
+                logger.warning('wrhi_automation::process_visit: '
+                               'search_date is empty for Visit Type %s '
+                               'and Ptd_no %s - skipping visit'
+                               % (visit_type, v.ptd_no))
+                return
 
-    try:
-        data = fetch_visit_data(endpoint, COMING_VISIT)
-    except Exception as ex:
-        logger.warning('wrhi_automation::import_visits: Failed to fetch '
-                       'coming visit data. Reason: %s' % ex)
+            search_date = search_date.date()
 
-    if data:
-        for row in data:
-            process_visit(VisitInc(row), COMING_VISIT)
+            for visit in visits:
+                if visit.date != search_date:
+                    continue
+                found_visit = True
 
-    try:
-        data = fetch_visit_data(endpoint, MISSED_VISIT)
-    except Exception as ex:
-        logger.warning('wrhi_automation::import_visits: Failed to fetch '
-                       'missed visit data. Reason: %s' % ex)
+                if visit_type == COMING_VISIT:
+                    next_visit_date = v.get_next_tcb()
 
-    if data:
-        for row in data:
-            process_visit(VisitInc(row), MISSED_VISIT)
+                    if next_visit_date:
+                        logger.info("Attempting to create visit for %s @ %s on %s"
+                                    % (db_patient.te_id, clinic.name, next_visit_date))
+                        self.create_visit(db_patient, clinic,
+                                          next_visit_date, 's')
+                elif visit_type == MISSED_VISIT:
+                    if visit.status != 'm':
+                        visit.status = 'm'
+                        self.save_visit(visit)
 
-    try:
-        data = fetch_visit_data(endpoint, DONE_VISIT)
-    except Exception as ex:
-        logger.warning('wrhi_automation::import_visits: Failed to fetch '
-                       'done visit data. Reason: %s' % ex)
+                        res_date = v.get_next_tcb()
+
+                        if res_date:
+                            logger.info("Attempting to create visit for %s @ %s on %s"
+                                        % (db_patient.te_id, clinic.name, res_date))
+                            self.create_visit(db_patient, clinic, res_date,
+                                              's')
+                elif visit_type == DONE_VISIT:
+                    if visit.status != 'a':
+                        attended_early = v.status.lower() == 'ae'
+                        visit.status = 'a'
+
+                        # if the patient attended early adjust the internal
+                        # visit date
+                        if attended_early:
+                            return_date = v.get_return_date()
+
+                            if return_date:
+                                visit.date = return_date.date()
+
+                        self.save_visit(visit)
+
+                        next_visit_date = v.get_next_tcb()
+
+                        if next_visit_date:
+                            logger.info("Attempting to create visit for %s @ %s on %s"
+                                        % (db_patient.te_id, clinic.name, next_visit_date))
+                            self.create_visit(db_patient, clinic,
+                                              next_visit_date, 's')
+
+        if not found_visit:
+            visit_date2 = None
+            if visit_type == COMING_VISIT:
+                visit_date = v.get_visit_date()
+                visit_date2 = v.get_next_tcb()
+
+                if visit_date is None:
+                    visit_date = visit_date2
+            else:
+                visit_date = v.get_visit_date()
+
+            vt = {
+                COMING_VISIT: 's',
+                MISSED_VISIT: 'm',
+                DONE_VISIT: 'a',
+            }.get(visit_type)
+
+            logger.info("Attempting to create visit for %s @ %s on %s"
+                        % (db_patient.te_id, clinic.name, visit_date))
+            self.create_visit(db_patient, clinic, visit_date, vt)
+
+            if visit_type == COMING_VISIT and visit_date2:
+                # because the query in COMING_VISITS looks at visit_date
+                # and next_tcb we might have two none existing visits
+                logger.info("Attempting to create visit for %s @ %s on %s"
+                            % (db_patient.te_id, clinic.name, visit_date2))
+                self.create_visit(db_patient, clinic, visit_date2, vt)
+
+    def save(self):
+        """Insert the new visits with their historical records and count
+        them for their patients. Returns the new visits."""
+        if not self.new_visits:
+            return []
+        Visit.objects.bulk_create(self.new_visits,
+                                  batch_size=BATCH_CHUNK_SIZE)
+        # bulk_create doesn't give them their primary keys, a patient has
+        # one new visit per clinic & date at most and the visits the
+        # patients had already are known
+        new_visits = dict(((visit.patient_id, visit.clinic_id, visit.date),
+                           visit) for visit in self.new_visits)
+        known = set(visit.pk for visits in self.visits.values()
+                    for visit in visits if visit.pk is not None)
+        inserted = in_chunks(Visit.objects.order_by('pk').values_list(
+            'pk', 'patient', 'clinic', 'date'), 'patient',
+            set(visit.patient_id for visit in self.new_visits))
+        for pk, patient_id, clinic_id, date in inserted:
+            visit = new_visits.get((patient_id, clinic_id, date))
+            if visit is not None and pk not in known:
+                visit.pk = pk
+                visit._state.adding = False
+                visit._state.db = Visit.objects.db
+
+        # created, like the save of a new visit
+        history_date = timezone.now()
+        fields = [field.attname for field in Visit._meta.concrete_fields]
+        Visit.history.model.objects.bulk_create([
+            Visit.history.model(history_type='+', history_date=history_date,
+                                **dict((field, getattr(visit, field))
+                                       for field in fields))
+            for visit in self.new_visits], batch_size=BATCH_CHUNK_SIZE)
+        queue_visit_counts(self.new_visits)
+        return self.new_visits
+
+
+def process_visits(rows, visit_type):
+    """Process all the VisitInc rows of a feed as one batch, see
+    `VisitBatch`. Returns the new visits. The changes to the existing
+    visits are committed before the new ones are inserted, they're kept
+    if the insert fails."""
+    with transaction.atomic():
+        batch = VisitBatch(rows)
+        for v in rows:
+            batch.process(v, visit_type)
+    with transaction.atomic():
+        return batch.save()
+
+
+def import_visits(endpoint, workers=1, full=False):
+    """Import the visit feeds, fetched concurrently with more than one
+    worker. Unless `full` is set only the visits since the last successful
+    import are fetched for the INCREMENTAL_VISIT_TYPES, see
+    `visit_window`."""
+    logger.info('wrhi_automation::import_visits: Started')
+    # the mappings are only cleared by the process that changes them, start
+    # every import afresh in a long lived worker
+    clinic_names.clear()
+    owner = User.objects.filter(username=settings.WRHI_IMPORT_USER).first()
+
+    if owner is None:
+        logger.error('Configuration error. WRHI_IMPORT_USER has not been set')
+        return
+
+    date_now = datetime.now()
+    windows = {}
+    for visit_type in VISIT_TYPES:
+        if full:
+            windows[visit_type] = (date_now - VISIT_WINDOW,
+                                   date_now + VISIT_WINDOW)
+        else:
+            windows[visit_type] = visit_window(date_now, visit_type)
+
+    complete = True
+    for visit_type, data, ex in fetch_all_visit_data(endpoint, windows,
+                                                     workers):
+        if ex is not None:
+            complete = False
+            logger.warning('wrhi_automation::import_visits: Failed to fetch '
+                           '%s data. Reason: %s' % (VISIT_FEEDS[visit_type],
+                                                    ex))
+        elif data:
+            try:
+                process_visits([VisitInc(row) for row in data], visit_type)
+            except Exception:
+                # fetched again by the next import
+                complete = False
+                logger.exception('wrhi_automation::import_visits: Failed to '
+                                 'process %s data' % VISIT_FEEDS[visit_type])
 
-    if data:
-        for row in data:
-            process_visit(VisitInc(row), DONE_VISIT)
+    if complete:
+        save_last_visit_import(owner, date_now)
 
     logger.info('wrhi_automation::import_visits: Completed')
 
@@ -454,6 +796,7 @@ def update_patient(clinic, patient, owner_user, wrhi_msisdn_override):
 
 def import_patients(endpoint):
     logger.info('wrhi_automation::import_patients: Started')
+    clinic_names.clear()
     try:
         data = fetch_patient_data(endpoint)
     except Exception as ex:
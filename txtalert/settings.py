@@ -205,6 +205,26 @@ CACHES = {
 
 SMS_GATEWAY_CLASS = 'txtalert.apps.gateway.backends.dummy'
 
+# How long, in seconds, the Google Docs importer keeps spreadsheet keys and
+# worksheet rows in the cache. Cached rows are only used while the
+# worksheet's updated timestamp is unchanged.
+GOOGLEDOC_CACHE_TIMEOUT = 60 * 60 * 6
+
+# The number of SendSMS records the Vumi Go backend writes per bulk insert
+VUMIGO_SEND_CHUNK_SIZE = 500
+# The number of messages the Vumi Go backend sends in parallel and the
+# maximum number of messages it sends per second (None for no limit)
+VUMIGO_SEND_CONCURRENCY = 1
+VUMIGO_SEND_RATE_LIMIT = None
+
+# Queue delivery receipts in Redis and write them in batches with a Celery
+# task API_EVENTS_FLUSH_INTERVAL seconds after the first one came in instead
+# of during the request. Only the latest event per message is written,
+# events that fail to write are retried on the next flush.
+API_EVENTS_QUEUE = False
+API_EVENTS_FLUSH_INTERVAL = 2
+API_EVENTS_REDIS_URL = BROKER_URL
+
 BOOKING_TOOL_RISK_LEVELS = {
     # pc is for patient count
     'high': lambda pc: pc > 100,
@@ -21,4 +21,10 @@ def wrhi_qa_schedule():
 
 @task
 def wrhi_prod_schedule():
-    management.call_command('import_wrhi_data', endpoint='prod')
\ No newline at end of file
+    management.call_command('import_wrhi_data', endpoint='prod')
+
+
+@task
+def flush_receipts():
+    from txtalert.apps.api.receipts import receipt_queue
+    receipt_queue.flush()